@@ -0,0 +1,53 @@
+import os
+import time
+import argparse
+import tempfile
+from src.main import delta_sync_file, DELTA_BLOCK_SIZE
+
+
+# ------------------------------------------------------------------------------------
+# Typical modifications of a large file which was already synced once
+def modifications(base):
+    middle = len(base) // 2
+    return {
+        "append_line": base + b"one more log line\n",
+        "change_page": base[:middle] + os.urandom(4096) + base[middle + 4096:],
+        "insert_bytes": base[:middle] + b"inserted" + base[middle:],
+        "delete_bytes": base[:middle] + base[middle + 100:],
+        "truncate_half": base[:middle],
+    }
+
+# ------------------------------------------------------------------------------------
+# Benchmark of delta transfer, prints bytes written against file size for every modification
+def run_benchmark(size_mb, block_size):
+    base = os.urandom(size_mb * 1024 * 1024)
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_path = os.path.join(temp_dir, "source.bin")
+        destination_path = os.path.join(temp_dir, "destination.bin")
+        for name, content in modifications(base).items():
+            with open(destination_path, 'wb') as f:
+                f.write(base)
+            with open(source_path, 'wb') as f:
+                f.write(content)
+            start_time = time.perf_counter()
+            bytes_written = delta_sync_file(source_path, destination_path, block_size)
+            elapsed_time = time.perf_counter() - start_time
+            results.append((name, len(content), bytes_written, elapsed_time))
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog="bench_delta", description="Bytes written by delta transfer.")
+    parser.add_argument("--size_mb", help="Size of generated test file in MiB.", type=int, default=256)
+    parser.add_argument("--block_size", help="Delta block size in bytes.", type=int, default=DELTA_BLOCK_SIZE)
+    args = parser.parse_args()
+
+    for name, file_size, bytes_written, elapsed_time in run_benchmark(args.size_mb, args.block_size):
+        written = "full copy" if bytes_written is None else f"{bytes_written} B ({bytes_written / file_size:.2%})"
+        print(f"{name:<14} size {file_size} B, written {written}, {elapsed_time:.2f} s")
+
+# ------------------------------------------------------------------------------------
+# Run from repository root: python -m benchmarks.bench_delta --size_mb 256
+# ------------------------------------------------------------------------------------
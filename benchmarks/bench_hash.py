@@ -0,0 +1,43 @@
+import os
+import time
+import argparse
+import tempfile
+from src.main import file_digest, HASH_ALGORITHMS, HASH_METHODS
+
+
+# ------------------------------------------------------------------------------------
+# Micro-benchmark of hashing backends, prints throughput of every algorithm and method
+def run_benchmark(size_mb, repeat):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "bench.bin")
+        with open(file_path, 'wb') as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        results = []
+        for algorithm in HASH_ALGORITHMS:
+            for method in HASH_METHODS:
+                # Best of several runs, the first one also warms up the page cache
+                best = min(timed_digest(file_path, algorithm, method) for _ in range(repeat))
+                results.append((algorithm, method, size_mb / 1024 / best))
+        return results
+
+def timed_digest(file_path, algorithm, method):
+    start_time = time.perf_counter()
+    file_digest(file_path, algorithm, method)
+    return time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog="bench_hash", description="Hashing throughput of every backend.")
+    parser.add_argument("--size_mb", help="Size of generated test file in MiB.", type=int, default=256)
+    parser.add_argument("--repeat", help="Number of runs of every backend, the best one is reported.", type=int, default=3)
+    args = parser.parse_args()
+
+    for algorithm, method, throughput in run_benchmark(args.size_mb, args.repeat):
+        print(f"{algorithm:<8} {method:<9} {throughput:6.2f} GB/s")
+
+# ------------------------------------------------------------------------------------
+# Run from repository root: python -m benchmarks.bench_hash --size_mb 256
+# ------------------------------------------------------------------------------------
@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+from types import SimpleNamespace
+from src.main import command_line_arguments_wrapper, COMPARE_STRATEGIES
+
+
+# ------------------------------------------------------------------------------------
+# Tree shapes: number of directories and files, nesting and file sizes, scaled by --scale
+SHAPES = {
+    "tiny": {"dirs": 20, "files_per_dir": 100, "depth": 1, "min_size": 0, "max_size": 4 * 1024},
+    "deep": {"dirs": 200, "files_per_dir": 5, "depth": 40, "min_size": 1024, "max_size": 16 * 1024},
+    "wide": {"dirs": 1, "files_per_dir": 5000, "depth": 1, "min_size": 0, "max_size": 2 * 1024},
+    "huge": {"dirs": 1, "files_per_dir": 4, "depth": 1, "min_size": 32 * 1024 * 1024, "max_size": 64 * 1024 * 1024},
+}
+RUNS = ("initial", "unchanged", "churn")
+PHASES = ("scan", "hash", "copy", "move", "delete", "index", "wait", "cycle")
+
+# ------------------------------------------------------------------------------------
+# Synthetic trees, the same seed always produces the same paths and contents
+def random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+def generate_tree(root, shape, rng, scale):
+    directories = []
+    for index in range(max(1, int(shape["dirs"] * scale))):
+        # Directories are chained up to depth levels, so deep shape builds long paths
+        parent = directories[index - 1] if index % shape["depth"] else root
+        directory = os.path.join(parent, f"dir_{index:05d}")
+        os.makedirs(directory)
+        directories.append(directory)
+    files = []
+    for directory in directories:
+        for index in range(max(1, int(shape["files_per_dir"] * scale))):
+            file_path = os.path.join(directory, f"file_{index:05d}.bin")
+            with open(file_path, 'wb') as f:
+                f.write(random_bytes(rng, rng.randint(shape["min_size"], shape["max_size"])))
+            files.append(file_path)
+    return files
+
+def apply_churn(files, shape, rng, churn):
+    """Modify, add and delete churn share of files (one third each) and return the new file list."""
+    changed = rng.sample(files, int(len(files) * churn))
+    modified, added, deleted = changed[0::3], changed[1::3], changed[2::3]
+    for file_path in modified:
+        with open(file_path, 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(rng.randint(0, size) if size else 0)
+            f.write(random_bytes(rng, 64))
+    for file_path in added:
+        with open(file_path + ".new", 'wb') as f:
+            f.write(random_bytes(rng, rng.randint(shape["min_size"], shape["max_size"])))
+    for file_path in deleted:
+        os.remove(file_path)
+    deleted = set(deleted)
+    return [path for path in files if path not in deleted] + [path + ".new" for path in added]
+
+# ------------------------------------------------------------------------------------
+# Runs initial, unchanged and churn cycles on every shape and collects phase times and counts
+def run_cycle(one_way_synchronization, source_dir, destination_dir):
+    one_way_synchronization(source_dir, destination_dir)
+    cycle_stats = one_way_synchronization.cycle_stats
+    return {
+        "phases": {phase: round(cycle_stats.durations.get(phase, 0.0), 6) for phase in PHASES},
+        "counts": dict(cycle_stats.counts),
+        "bytes": sum(cycle_stats.bytes.values()),
+    }
+
+def run_shape(name, shape, options, seed, scale, churn):
+    rng = random.Random(f"{seed}:{name}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_dir = os.path.join(temp_dir, "source")
+        destination_dir = os.path.join(temp_dir, "destination")
+        os.makedirs(source_dir)
+        files = generate_tree(source_dir, shape, rng, scale)
+        args = SimpleNamespace(source_dir_path=source_dir, destination_dir_path=destination_dir,
+                               log_path=os.path.join(temp_dir, "bench.log"), filter_hidden_dirs_files=False,
+                               log_summary=True, **options)
+        one_way_synchronization = command_line_arguments_wrapper(args)
+        results = {"files": len(files)}
+        try:
+            results["initial"] = run_cycle(one_way_synchronization, source_dir, destination_dir)
+            results["unchanged"] = run_cycle(one_way_synchronization, source_dir, destination_dir)
+            apply_churn(files, shape, rng, churn)
+            results["churn"] = run_cycle(one_way_synchronization, source_dir, destination_dir)
+        finally:
+            # Worker and hashing pools and index of every shape are closed before the next one starts
+            one_way_synchronization.shutdown()
+        shutil.rmtree(destination_dir)
+    return results
+
+def run_benchmark(shapes, options, seed, scale, churn):
+    return {
+        "config": {"seed": seed, "scale": scale, "churn": churn, "options": options,
+                   "python": platform.python_version(), "platform": platform.platform()},
+        "results": {name: run_shape(name, SHAPES[name], options, seed, scale, churn) for name in shapes},
+    }
+
+# ------------------------------------------------------------------------------------
+# Compares phase times with stored baseline, small absolute differences are treated as noise
+def compare_with_baseline(current, baseline, tolerance, min_delta):
+    regressions = []
+    for name, runs in current["results"].items():
+        for run in RUNS:
+            baseline_phases = baseline.get("results", {}).get(name, {}).get(run, {}).get("phases", {})
+            for phase, seconds in runs[run]["phases"].items():
+                if phase not in baseline_phases:
+                    continue
+                reference = baseline_phases[phase]
+                if seconds > reference * (1 + tolerance) and seconds - reference > min_delta:
+                    regressions.append((name, run, phase, reference, seconds))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog="bench_sync", description="Per-phase timing of synchronization cycles on synthetic trees.")
+    parser.add_argument("--shapes", help="Tree shapes to run.", nargs="+", choices=sorted(SHAPES), default=sorted(SHAPES))
+    parser.add_argument("--seed", help="Seed of generated trees and churn.", type=int, default=0)
+    parser.add_argument("--scale", help="Multiplier of number of directories and files of every shape.", type=float, default=1.0)
+    parser.add_argument("--churn", help="Share of files modified, added or deleted before the churn cycle.", type=float, default=0.1)
+    parser.add_argument("--workers", help="Number of sync worker threads.", type=int, default=1)
+    parser.add_argument("--compare", help="Compare strategy of modified files.", choices=COMPARE_STRATEGIES, default="hash")
+    parser.add_argument("--state_index", help="Run with persistent state index.", action="store_true")
+    parser.add_argument("--output", help="Path of JSON results file (printed to stdout by default).", type=str)
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against.", type=str)
+    parser.add_argument("--tolerance", help="Allowed relative slowdown of a phase against baseline.", type=float, default=0.2)
+    parser.add_argument("--min_delta", help="Slowdowns below this many seconds are ignored as noise.", type=float, default=0.01)
+    args = parser.parse_args()
+
+    options = {"workers": args.workers, "compare": args.compare, "state_index": args.state_index}
+    start_time = time.perf_counter()
+    current = run_benchmark(args.shapes, options, args.seed, args.scale, args.churn)
+    current["config"]["elapsed"] = round(time.perf_counter() - start_time, 3)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(current, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(current, baseline, args.tolerance, args.min_delta)
+        for name, run, phase, reference, seconds in regressions:
+            print(f"REGRESSION {name}/{run}/{phase}: {reference:.3f} s -> {seconds:.3f} s", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+# ------------------------------------------------------------------------------------
+# Run from repository root: python -m benchmarks.bench_sync --output results.json
+# Compare with stored baseline: python -m benchmarks.bench_sync --baseline baseline.json
+# ------------------------------------------------------------------------------------
@@ -1,4 +1,5 @@
 import os
+import sys
 import filecmp
 import shutil
 import time
@@ -7,65 +8,429 @@ import logging
 import signal
 import hashlib
 import stat
+import sqlite3
+import json
+import threading
+import select
+import struct
+import ctypes
+import ctypes.util
+import mmap
+import zlib
+import tempfile
+import errno
+import re
+import queue
+import logging.handlers
+import contextlib
+import cProfile
+import pstats
+import array
+import bisect
+import itertools
+import multiprocessing
+import http.server
+from collections import OrderedDict, Counter
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
 # ------------------------------------------------------------------------------------
-# Wrapper around filecmp.dircmp to ignore hidden and system files/folders
-class DirComparisonNoHidden(filecmp.dircmp):
-    def __init__(self, a, b, ignore=None, hide=None, *, shallow=True):
-        # Initialize the parent class with hidden files/folders ignored
-        super().__init__(a, b, ignore=ignore, hide=hide)
-        # Filter out all hidden files and directories across all subdirectories
-        self.left_list = [item for item in self.left_list if not is_hidden(os.path.join(a, item))]
-        self.right_list = [item for item in self.right_list if not is_hidden(os.path.join(b, item))]
-        # Update common sets to exclude hidden items
-        self.common = [item for item in self.common if not is_hidden(os.path.join(a, item))]
-        self.common_dirs = [item for item in self.common_dirs if not is_hidden(os.path.join(a, item))]
-        self.common_files = [item for item in self.common_files if not is_hidden(os.path.join(a, item))]
-        self.common_funny = [item for item in self.common_funny if not is_hidden(os.path.join(a, item))]
-    def phase3(self):
-        """
-        Override to filter hidden files in subdirectories.
-        """
-        self.subdirs = {
-            item: DirComparisonNoHidden(os.path.join(self.left, item),
-            os.path.join(self.right, item), self.ignore, self.hide)
-            for item in self.common_dirs if not is_hidden(os.path.join(self.left, item))
-            }
-        
-# ------------------------------------------------------------------------------------
-# ------------------------------------------------------------------------------------
-# Wrapper around filecmp.dircmp to include all hidden and system files/folders
-class DirComparisonWithHidden(filecmp.dircmp):
-    def __init__(self, a, b, ignore=None, hide=None, *, shallow=True):
-        # Initialize the parent class without excluding hidden files or directories
-        super().__init__(a, b, ignore=ignore, hide=[])
-        # Include hidden files and directories by using the original left and right lists
-        self.left_list = list(os.listdir(a))
-        self.right_list = list(os.listdir(b))
-        # Update common sets to include hidden items as well
-        self.common = [item for item in self.left_list if item in self.right_list]
-        self.common_dirs = [item for item in self.common if os.path.isdir(os.path.join(a, item))]
-        self.common_files = [item for item in self.common if os.path.isfile(os.path.join(a, item))]
-        self.common_funny = [item for item in self.common if item not in self.common_dirs and item not in self.common_files]
-    def phase3(self):
-        """
-        Override to include hidden files in subdirectories.
-        """
-        self.subdirs = {
-            item: DirComparisonWithHidden(os.path.join(self.left, item),
-            os.path.join(self.right, item), self.ignore, self.hide) for item in self.common_dirs
-        }
-        
+# Include/exclude rules with gitignore syntax, compiled once into a single matcher
+class FilterRules:
+    """
+    Rules are matched against paths relative to source root ('dir/name'), the last matching rule wins
+    and rules starting with '!' include entries again. Pattern without '/' matches name at any depth,
+    trailing '/' matches directories only, '**' matches any number of directories.
+    With hidden=True rules for hidden entries and filecmp.DEFAULT_IGNORES come first.
+    """
+    def __init__(self, patterns=(), hidden=False):
+        self.patterns = [*((".*", *filecmp.DEFAULT_IGNORES) if hidden else ()), *patterns]
+        self.negated = {}
+        alternatives = []
+        # Alternatives are tried in order, so reversed rules make the last matching rule win
+        for number, pattern in reversed(list(enumerate(self.patterns))):
+            negated, expression = self.translate(pattern)
+            self.negated[f"rule{number}"] = negated
+            alternatives.append(f"(?P<rule{number}>{expression})")
+        self.regex = re.compile("|".join(alternatives), re.DOTALL) if alternatives else None
+        self.fingerprint = "\n".join(self.patterns)
+
+    @classmethod
+    def from_file(cls, path, hidden=False):
+        """Load patterns from file, blank lines and lines starting with '#' are skipped."""
+        with open(path, 'r') as rules_file:
+            lines = [re.sub(r"(?<!\\)\s+$", "", line.rstrip("\n")) for line in rules_file]
+        return cls([line for line in lines if line and not line.startswith("#")], hidden=hidden)
+
+    @staticmethod
+    def translate(pattern):
+        """Return (negated, regular expression) of one gitignore pattern."""
+        negated = pattern.startswith("!")
+        if negated or pattern.startswith(("\\!", "\\#")):
+            pattern = pattern[1:]
+        directory_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        expression, position = [], 0
+        while position < len(pattern):
+            char = pattern[position]
+            if pattern.startswith("**/", position):
+                expression.append("(?:.*/)?")
+                position += 3
+                continue
+            if pattern.startswith("**", position):
+                # Trailing '**' matches everything inside, but not the directory itself
+                expression.append(".+" if position + 2 == len(pattern) else ".*")
+                position += 2
+                continue
+            if char == "*":
+                expression.append("[^/]*")
+            elif char == "?":
+                expression.append("[^/]")
+            elif char == "[" and (end := pattern.find("]", position + 2)) != -1:
+                content = pattern[position + 1:end]
+                if content.startswith("!"):
+                    content = "^" + content[1:]
+                expression.append("[" + content.replace("\\", "\\\\") + "]")
+                position = end
+            elif char == "\\" and position + 1 < len(pattern):
+                position += 1
+                expression.append(re.escape(pattern[position]))
+            else:
+                expression.append(re.escape(char))
+            position += 1
+        return negated, ("" if anchored else "(?:.*/)?") + "".join(expression) + ("/" if directory_only else "/?")
+
+    def __bool__(self):
+        return self.regex is not None
+
+    def excluded(self, rel_path, is_dir=False):
+        if self.regex is None:
+            return False
+        match = self.regex.fullmatch(rel_path + "/" if is_dir else rel_path)
+        return match is not None and not self.negated[match.lastgroup]
+
+    def excluded_directory(self, rel_path):
+        """True when directory or any of its parents is excluded (traversal never enters them)."""
+        parts = rel_path.split("/") if rel_path else []
+        return any(self.excluded("/".join(parts[:depth]), True) for depth in range(1, len(parts) + 1))
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Listing of one side of a compared directory, kept compact instead of a dict of os.DirEntry objects
+class DirListing:
+    """
+    Sorted names with parallel arrays: type bits from scandir (DIR and FILE follow symlinks like filecmp,
+    LINK_DIR does not) and the stat fields sync uses (mode, inode, size, mtime). Stat follows symlinks like
+    DirEntry.stat() and is taken on first use, so a listing costs its names and a few dozen bytes per entry.
+    """
+    TYPE_DIR, TYPE_FILE, TYPE_LINK_DIR = 1, 2, 4
+
+    def __init__(self, path, entries=()):
+        """entries: (name, type bits) of entries listed in path."""
+        entries = sorted(entries)
+        self.path = path
+        self.names = [name for name, _ in entries]
+        self.types = bytearray(types for _, types in entries)
+        self.stated = bytearray(len(entries))
+        self.modes = array.array("L", [0]) * len(entries)
+        self.inodes = array.array("Q", [0]) * len(entries)
+        self.sizes = array.array("q", [0]) * len(entries)
+        self.mtimes = array.array("q", [0]) * len(entries)
+
+    @staticmethod
+    def entry_type(entry):
+        types = 0
+        try:
+            if entry.is_dir():
+                types |= DirListing.TYPE_DIR
+            elif entry.is_file():
+                types |= DirListing.TYPE_FILE
+            if entry.is_dir(follow_symlinks=False):
+                types |= DirListing.TYPE_LINK_DIR
+        except OSError:
+            pass
+        return types
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self.find(name) >= 0
+
+    def find(self, name):
+        """Return position of name or -1."""
+        position = bisect.bisect_left(self.names, name)
+        return position if position < len(self.names) and self.names[position] == name else -1
+
+    def position(self, name):
+        position = self.find(name)
+        if position < 0:
+            raise KeyError(name)
+        return position
+
+    def is_dir(self, name, follow_symlinks=True):
+        return bool(self.types[self.position(name)] & (self.TYPE_DIR if follow_symlinks else self.TYPE_LINK_DIR))
+
+    def is_file(self, name):
+        return bool(self.types[self.position(name)] & self.TYPE_FILE)
+
+    def stat(self, name):
+        return self.stat_at(self.position(name))
+
+    def stat_at(self, position):
+        """Return stat_result with mode, inode, size and mtime of entry (other fields are 0), OSError when it is gone."""
+        if not self.stated[position]:
+            result = os.stat(os.path.join(self.path, self.names[position]))
+            self.modes[position], self.inodes[position] = result.st_mode, result.st_ino
+            self.sizes[position], self.mtimes[position] = result.st_size, result.st_mtime_ns
+            self.stated[position] = 1
+            return result
+        mtime_ns = self.mtimes[position]
+        return os.stat_result((self.modes[position], self.inodes[position], 0, 0, 0, 0, self.sizes[position],
+                               0, mtime_ns / 1e9, 0), {"st_mtime_ns": mtime_ns})
+
+# Single pass directory comparison, replacement of filecmp.dircmp based wrappers
+class DirComparisonScan:
+    """
+    Lists each side once with os.scandir and joins both sorted listings.
+    Provides the same results as filecmp.dircmp (left_only, right_only, common_dirs,
+    common_files, common_funny, diff_files, same_files, funny_files), shallow mode only:
+    files with equal type, size and mtime are the same, everything else is left for hashing.
+    Listings are kept as DirListing (left_listing, right_listing) and results as one category byte
+    per source entry, result lists are built from them when read.
+    Rules filter only the source side (rel_path is path of compared directory relative to source root),
+    so excluded entries present in destination end up in right_only and get removed.
+    With b=None destination does not exist yet and every source entry is in left_only.
+    Unfinished copies (partial and checkpoint files) in destination are collected in partial_files instead,
+    unless source has an entry of the same name, which is then synced like any other. Reserved names (trash in destination root) are left out of both sides.
+    """
+    LEFT_ONLY, COMMON_DIR, SAME_FILE, DIFF_FILE, FUNNY_FILE, COMMON_FUNNY = range(6)
+
+    def __init__(self, a, b, rules=None, rel_path="", reserved=()):
+        self.left = a
+        self.right = b
+        self.partial_files = []
+        self.left_listing = left = DirListing(a, self.scan(a, rules, rel_path, reserved=reserved))
+        partial_entries = []
+        right_entries = self.scan(b, partial_entries=partial_entries, reserved=reserved) if b is not None else []
+        for name, types in partial_entries:
+            if name in left:
+                right_entries.append((name, types))
+            else:
+                self.partial_files.append(name)
+        self.right_listing = right = DirListing(b, right_entries)
+        self.categories = bytearray(len(left))
+        self.right_common = bytearray(len(right))
+        kinds = DirListing.TYPE_DIR | DirListing.TYPE_FILE
+        for position, name in enumerate(left.names):
+            right_position = right.find(name)
+            if right_position < 0:
+                continue
+            self.right_common[right_position] = 1
+            left_kind = left.types[position] & kinds
+            if left_kind != right.types[right_position] & kinds or not left_kind:
+                self.categories[position] = self.COMMON_FUNNY
+            elif left_kind == DirListing.TYPE_DIR:
+                self.categories[position] = self.COMMON_DIR
+            else:
+                try:
+                    left_stat, right_stat = left.stat_at(position), right.stat_at(right_position)
+                except OSError:
+                    self.categories[position] = self.FUNNY_FILE
+                    continue
+                same = (left_stat.st_size, left_stat.st_mtime_ns) == (right_stat.st_size, right_stat.st_mtime_ns)
+                self.categories[position] = self.SAME_FILE if same else self.DIFF_FILE
+
+    @classmethod
+    def scan(cls, path, rules=None, rel_path="", partial_entries=None, reserved=()):
+        """Return (name, type bits) of listed entries."""
+        prefix = rel_path + "/" if rel_path else ""
+        listing = []
+        THROTTLE.metadata()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if partial_entries is not None and partial_target_name(entry.name) is not None:
+                    partial_entries.append((entry.name, DirListing.entry_type(entry)))
+                    continue
+                if entry.name in reserved:
+                    continue
+                types = DirListing.entry_type(entry)
+                if rules and rules.excluded(prefix + entry.name, bool(types & DirListing.TYPE_DIR)):
+                    continue
+                listing.append((entry.name, types))
+        return listing
+
+    def category(self, name):
+        """Category of source entry name, None when source has no such entry."""
+        position = self.left_listing.find(name)
+        return self.categories[position] if position >= 0 else None
+
+    def select(self, *categories):
+        return [name for name, category in zip(self.left_listing.names, self.categories) if category in categories]
+
+    @property
+    def left_list(self):
+        return self.left_listing.names
+
+    @property
+    def right_list(self):
+        return self.right_listing.names
+
+    @property
+    def left_only(self):
+        return self.select(self.LEFT_ONLY)
+
+    @property
+    def right_only(self):
+        return [name for name, common in zip(self.right_listing.names, self.right_common) if not common]
+
+    @property
+    def common(self):
+        return self.select(self.COMMON_DIR, self.SAME_FILE, self.DIFF_FILE, self.FUNNY_FILE, self.COMMON_FUNNY)
+
+    @property
+    def common_dirs(self):
+        return self.select(self.COMMON_DIR)
+
+    @property
+    def common_files(self):
+        return self.select(self.SAME_FILE, self.DIFF_FILE, self.FUNNY_FILE)
+
+    @property
+    def common_funny(self):
+        return self.select(self.COMMON_FUNNY)
+
+    @property
+    def same_files(self):
+        return self.select(self.SAME_FILE)
+
+    @property
+    def diff_files(self):
+        return self.select(self.DIFF_FILE)
+
+    @property
+    def funny_files(self):
+        return self.select(self.FUNNY_FILE)
+
+# Existence, mtimes and comparison of one source directory and its destination listing
+def scan_directory(source_dir, listed_dir, rules=None, rel_path="", recorded=None, stat_entries=False, reserved=()):
+    """
+    Return (source stat or None when source is missing, listed stat or None when destination is missing,
+    comparison). Comparison is None when recorded (source_mtime_ns, destination_mtime_ns) of state index
+    still matches, the directory then does not need to be listed. With stat_entries stat of source entries
+    is cached ahead (files, and directories too when recorded index state is used), so callers do not wait for it.
+    """
+    try:
+        source_stat = os.stat(source_dir)
+    except FileNotFoundError:
+        return None, None, None
+    try:
+        listed_stat = os.stat(listed_dir)
+    except FileNotFoundError:
+        listed_stat = None
+    if listed_stat is not None and recorded is not None and \
+            tuple(recorded) == (source_stat.st_mtime_ns, listed_stat.st_mtime_ns):
+        return source_stat, listed_stat, None
+    comparison = DirComparisonScan(source_dir, listed_dir if listed_stat is not None else None, rules=rules, rel_path=rel_path,
+                                   reserved=reserved)
+    if stat_entries:
+        listing = comparison.left_listing
+        for position, types in enumerate(listing.types):
+            try:
+                if types & DirListing.TYPE_FILE or recorded is not None:
+                    listing.stat_at(position)
+            except OSError:
+                pass
+    return source_stat, listed_stat, comparison
+
 # ------------------------------------------------------------------------------------
+# Listing of directories ahead of the planning traversal on a pool of threads
+class ScanPrefetcher:
+    """
+    Directories near the top of the traversal stack are scanned by scan threads while the traversal
+    plans directories one by one in its own order, so the plan is identical to the serial one.
+    Directories of all subtrees wait in one shared queue and every idle thread takes the next one,
+    a huge subtree keeps all threads busy instead of one. At most limit scans run ahead.
+    reset() drops prefetched results, destination may change when the plan is executed.
+    """
+    def __init__(self, workers, limit=None):
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="sync_scan")
+        self.limit = limit or workers * 8
+        self.pending = {}
+
+    def submit(self, key, func, *args):
+        if len(self.pending) < self.limit:
+            self.pending[key] = self.pool.submit(func, *args)
+
+    def take(self, key):
+        """Wait for result of prefetched scan of key."""
+        return self.pending.pop(key).result()
+
+    def reset(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+
+    def shutdown(self):
+        self.reset()
+        self.pool.shutdown(wait=True)
+
 # ------------------------------------------------------------------------------------
-# Logger
-def setup_logger(log_path):
+# ------------------------------------------------------------------------------------
+# Queue handler which never blocks the sync thread, records are dropped when the queue is full
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue, listener):
+        super().__init__(log_queue)
+        self.listener = listener
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Wait until listener wrote every queued record (called at the end of each cycle)."""
+        self.queue.join()
+
+    def close(self):
+        # Listener writes remaining records before its handlers are closed, the stop sentinel waits for room in queue
+        if self.listener._thread is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+        super().close()
+
+# Listener of bounded queue, stop() waits for room for its sentinel instead of failing with queue.Full
+class LogQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+# ------------------------------------------------------------------------------------
+# Logger, console and file handlers run on a QueueListener thread
+def setup_logger(log_path, max_bytes=0, backups=0, queue_size=10000, name="sync_logger"):
     
-    logger = logging.getLogger("sync_logger")
+    logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
-    # create file handler which logs even debug messages
-    fh = logging.FileHandler(log_path)
+    # loggers of daemon jobs ("sync_logger.<job>") write only into their own log file
+    logger.propagate = name == "sync_logger"
+    # close pipeline of previous setup, otherwise every message would be written twice
+    for handler in logger.handlers[:]:
+        if isinstance(handler, BoundedQueueHandler):
+            logger.removeHandler(handler)
+            handler.close()
+    # create file handler which logs even debug messages, rotating when max_bytes is set
+    if max_bytes:
+        fh = logging.handlers.RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backups)
+    else:
+        fh = logging.FileHandler(log_path)
     fh.setLevel(logging.DEBUG)
     # create console handler to write messages into console 
     ch = logging.StreamHandler()
@@ -74,9 +439,11 @@ def setup_logger(log_path):
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     ch.setFormatter(formatter)
     fh.setFormatter(formatter)
-    # add the handlers to logger
-    logger.addHandler(ch)
-    logger.addHandler(fh)
+    # add the handlers to listener and bounded queue handler to logger
+    log_queue = queue.Queue(maxsize=queue_size)
+    listener = LogQueueListener(log_queue, ch, fh, respect_handler_level=True)
+    logger.addHandler(BoundedQueueHandler(log_queue, listener))
+    listener.start()
     
     return logger
 
@@ -89,13 +456,981 @@ def setup_logger(log_path):
     
 # ------------------------------------------------------------------------------------ 
 # ------------------------------------------------------------------------------------
-# Digest generator function 
-def md5_digest(file_paths, chunk_size=4096):
-    md5_hash = hashlib.md5()
-    with open(file_paths, 'rb') as bin_files:
-        while chunk := bin_files.read(chunk_size):
-            md5_hash.update(chunk)
-    return md5_hash.hexdigest()
+# Counters of one synchronization cycle: number of events and bytes per kind, time per phase
+class CycleStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = Counter()
+            self.bytes = Counter()
+            self.durations = Counter()
+            self.observed = Counter()
+            self.started = time.monotonic()
+
+    def observe(self, name, value=1):
+        """Count work which is not an event of the summary line (entries stat'd, directories listed, bytes hashed)."""
+        with self.lock:
+            self.observed[name] += value
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """Add time spent in block to phase, operations running in parallel add up their own time."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            with self.lock:
+                self.durations[phase] += elapsed_time
+
+    def add(self, kind, nbytes=0):
+        with self.lock:
+            self.counts[kind] += 1
+            self.bytes[kind] += nbytes
+
+    def summary(self):
+        with self.lock:
+            events = ", ".join(f"{count} {kind.replace('_', ' ')}" for kind, count in sorted(self.counts.items()))
+            return f"{events}; {sum(self.bytes.values())} bytes written in {time.monotonic() - self.started:.2f} s"
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Totals of all cycles exposed in Prometheus text format and as JSON status
+class SyncMetrics:
+    """
+    Fed by CycleStats of every finished cycle. Counters only grow, cycle and phase durations
+    are kept as cumulative histograms, so an alert can compare cycle time with sync period.
+    """
+    PREFIX = "owfs"
+    BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+    PHASES = ("scan", "hash", "copy", "move", "delete", "index", "wait")
+    COUNTERS = {
+        "cycles": "Number of finished synchronization cycles.",
+        "entries_stated": "Number of source and destination entries listed or stat'd.",
+        "directories_listed": "Number of source and destination directories listed.",
+        "bytes_hashed": "Number of bytes read for hashing.",
+        "bytes_copied": "Number of bytes written to destination.",
+        "files_deleted": "Number of files and directories removed from destination.",
+        "failed_operations": "Number of operations which failed and are retried next cycle.",
+        "dedup_bytes_saved": "Number of bytes not copied because the content was already in destination.",
+        "dedup_seconds_avoided": "Estimated seconds of copying avoided by deduplication.",
+        "log_records_dropped": "Number of log records dropped because the log queue was full.",
+    }
+
+    def __init__(self, sync_period=None):
+        self.sync_period = sync_period
+        self.lock = threading.Lock()
+        self.totals = Counter()
+        self.events = Counter()
+        self.histograms = {}
+        self.last_cycle = {}
+        self.schedule = {}
+
+    def set_schedule(self, interval, next_run):
+        with self.lock:
+            self.schedule = {"interval": interval, "next_run": next_run}
+
+    def observe_duration(self, name, seconds):
+        buckets, total, count = self.histograms.get(name, ([0] * len(self.BUCKETS), 0.0, 0))
+        buckets = [number + (seconds <= bound) for number, bound in zip(buckets, self.BUCKETS)]
+        self.histograms[name] = (buckets, total + seconds, count + 1)
+
+    def record_cycle(self, cycle_stats, failed_operations=0):
+        with cycle_stats.lock:
+            counts, written = Counter(cycle_stats.counts), sum(cycle_stats.bytes.values())
+            durations, observed = Counter(cycle_stats.durations), Counter(cycle_stats.observed)
+        with self.lock:
+            self.totals.update({"cycles": 1, "bytes_copied": written, "failed_operations": failed_operations,
+                                "files_deleted": counts["files_removed"] + counts["directories_removed"]})
+            self.totals.update(observed)
+            self.events.update(counts)
+            self.observe_duration("cycle", durations["cycle"])
+            for phase in self.PHASES:
+                self.observe_duration(phase, durations[phase])
+            self.last_cycle = {"finished": time.time(), "duration": durations["cycle"],
+                               "phases": {phase: durations[phase] for phase in self.PHASES},
+                               "events": dict(counts), "bytes_copied": written, "bytes_hashed": observed["bytes_hashed"]}
+
+    def status(self):
+        with self.lock:
+            return {"sync_period": self.sync_period, "totals": {name: self.totals[name] for name in self.COUNTERS},
+                    "events": dict(self.events), "last_cycle": dict(self.last_cycle), "schedule": dict(self.schedule)}
+
+    def write_status(self, path):
+        """Replace JSON status file atomically, readers never see a half written file."""
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as status_file:
+            json.dump(self.status(), status_file, indent=2, sort_keys=True)
+        os.replace(temp_path, path)
+
+    def prometheus_text(self):
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {self.PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {self.PREFIX}_{name} {kind}")
+            lines.extend(f"{self.PREFIX}_{name}{suffix} {value}" for suffix, value in samples)
+
+        def histogram_samples(histogram, label=""):
+            buckets, total, count = histogram
+            prefix = label + "," if label else ""
+            samples = [(f'_bucket{{{prefix}le="{bound}"}}', number) for bound, number in zip(self.BUCKETS, buckets)]
+            samples.append((f'_bucket{{{prefix}le="+Inf"}}', count))
+            suffix = f"{{{label}}}" if label else ""
+            return samples + [("_sum" + suffix, total), ("_count" + suffix, count)]
+
+        with self.lock:
+            for name, help_text in self.COUNTERS.items():
+                metric(f"{name}_total", "counter", help_text, [("", self.totals[name])])
+            metric("events_total", "counter", "Number of synchronization events per kind.",
+                   [(f'{{kind="{kind}"}}', count) for kind, count in sorted(self.events.items())])
+            if "cycle" in self.histograms:
+                metric("cycle_duration_seconds", "histogram", "Duration of synchronization cycles.",
+                       histogram_samples(self.histograms["cycle"]))
+                metric("phase_duration_seconds", "histogram", "Time spent in each phase of a cycle, summed over workers.",
+                       [sample for phase in self.PHASES for sample in histogram_samples(self.histograms[phase], f'phase="{phase}"')])
+                metric("last_cycle_duration_seconds", "gauge", "Duration of the last cycle.", [("", self.last_cycle["duration"])])
+                metric("last_cycle_timestamp_seconds", "gauge", "Unix time when the last cycle finished.", [("", self.last_cycle["finished"])])
+            if self.schedule:
+                metric("sync_interval_seconds", "gauge", "Current interval between cycle starts.", [("", self.schedule["interval"])])
+                metric("next_run_timestamp_seconds", "gauge", "Unix time of the next scheduled cycle.", [("", self.schedule["next_run"])])
+            if self.sync_period is not None:
+                metric("sync_period_seconds", "gauge", "Configured period of synchronization.", [("", self.sync_period)])
+        return "\n".join(lines) + "\n"
+
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Interval between cycle starts adapted to change rate and cycle duration
+class AdaptiveScheduler:
+    """
+    Cycles run one after another, never overlapping. A cycle which changed something shortens
+    the interval towards min_interval, an idle one stretches it towards max_interval, and the interval
+    never drops below twice the duration of the last cycle (capped at max_interval). Next run is counted from the start of previous cycle,
+    so the period does not drift, and a cycle which overran its interval is followed right away
+    instead of by a burst of missed runs. wait() returns False as soon as stop() was called.
+    """
+    SPEED_UP = 0.5
+    SLOW_DOWN = 1.5
+
+    def __init__(self, min_interval, max_interval=None, stopping=None):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval or min_interval, min_interval)
+        self.interval = min_interval
+        self.stopping = stopping or threading.Event()
+        self.next_run = time.monotonic() + self.interval
+
+    def update(self, started, duration, changes):
+        """Plan next run after cycle which started at started (time.monotonic) and made changes."""
+        interval = self.interval * (self.SPEED_UP if changes else self.SLOW_DOWN)
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        # Synchronization takes at most half of the time, unless a single cycle is longer than half of max_interval
+        self.interval = max(interval, min(2 * duration, self.max_interval))
+        self.next_run = max(started + self.interval, time.monotonic())
+
+    def next_run_timestamp(self):
+        return time.time() + max(self.next_run - time.monotonic(), 0)
+
+    def wait(self):
+        return not self.stopping.wait(max(self.next_run - time.monotonic(), 0))
+
+    def stop(self):
+        self.stopping.set()
+
+# Local HTTP endpoint serving /metrics in Prometheus text format and /status as JSON from a daemon thread
+def start_metrics_server(metrics, host="127.0.0.1", port=9108):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = metrics.prometheus_text().encode(), "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == "/status":
+                body, content_type = json.dumps(metrics.status(), sort_keys=True).encode(), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics_server", daemon=True).start()
+    return server
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Profiles of the next cycles, armed at start (--profile) or at runtime (SIGUSR1)
+class CycleProfiler:
+    """
+    While nothing is armed the only cost is one check of remaining per cycle. Sample mode records stacks
+    of all threads every interval seconds, cprofile mode traces every call of the cycle thread
+    (worker threads are not traced). Every profiled cycle writes <name>.collapsed, one
+    'frame;frame;frame count' line per stack (input of flamegraph.pl or speedscope), and <name>.top.txt
+    with functions taking most time. cprofile mode also writes <name>.pstats, its collapsed stacks are
+    caller;callee pairs weighted by microseconds spent in callee, the profiler does not keep longer stacks.
+    """
+    MODES = ("sample", "cprofile")
+    TOP = 30
+
+    def __init__(self, directory, logger, cycles=0, mode="sample", interval=0.005):
+        self.directory = directory
+        self.logger = logger
+        self.cycles = max(cycles, 1)
+        self.remaining = cycles
+        self.mode = mode
+        self.interval = interval
+        self.profiled = 0
+
+    def request(self, cycles=None):
+        """Profile next cycles (safe to call from signal handler)."""
+        self.remaining = cycles or self.cycles
+
+    @staticmethod
+    def label(filename, lineno, function):
+        return f"{function} ({os.path.basename(filename)}:{lineno})"
+
+    @contextlib.contextmanager
+    def cycle(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.profiled += 1
+        name = os.path.join(self.directory, f"cycle-{time.strftime('%Y%m%d-%H%M%S')}-{self.profiled}")
+        profile = self.trace if self.mode == "cprofile" else self.sample
+        try:
+            with profile(name):
+                yield
+        finally:
+            self.remaining = max(self.remaining - 1, 0)
+            self.logger.info(f"Cycle profile written: {name}.*, {self.remaining} more cycles will be profiled.")
+
+    @contextlib.contextmanager
+    def trace(self, name):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(name + ".pstats")
+            with open(name + ".top.txt", 'w') as top_file:
+                pstats.Stats(profile, stream=top_file).sort_stats("cumulative").print_stats(self.TOP)
+            stacks = Counter()
+            for function, (_, _, total_time, _, callers) in pstats.Stats(profile).stats.items():
+                if not callers:
+                    stacks[self.label(*function)] += round(total_time * 1e6)
+                for caller, (_, _, caller_time, _) in callers.items():
+                    stacks[f"{self.label(*caller)};{self.label(*function)}"] += round(caller_time * 1e6)
+            self.write_collapsed(name, stacks)
+
+    @contextlib.contextmanager
+    def sample(self, name):
+        stacks = Counter()
+        stopping = threading.Event()
+
+        def sampler():
+            own_ident = threading.get_ident()
+            while not stopping.wait(self.interval):
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    frames = []
+                    while frame is not None:
+                        code = frame.f_code
+                        frames.append(self.label(code.co_filename, code.co_firstlineno, code.co_name))
+                        frame = frame.f_back
+                    stacks[";".join([names.get(ident, str(ident)), *reversed(frames)])] += 1
+
+        thread = threading.Thread(target=sampler, name="cycle_profiler", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopping.set()
+            thread.join()
+            self.write_collapsed(name, stacks)
+            own_samples, total_samples = Counter(), Counter()
+            for stack, count in stacks.items():
+                frames = stack.split(";")[1:]
+                if frames:
+                    own_samples[frames[-1]] += count
+                for frame in set(frames):
+                    total_samples[frame] += count
+            with open(name + ".top.txt", 'w') as top_file:
+                top_file.write(f"{sum(stacks.values())} samples every {self.interval} s\n")
+                for title, counter in (("Own samples", own_samples), ("Total samples", total_samples)):
+                    top_file.write(f"\n{title}:\n")
+                    top_file.writelines(f"{count:10d}  {frame}\n" for frame, count in counter.most_common(self.TOP))
+
+    @staticmethod
+    def write_collapsed(name, stacks):
+        with open(name + ".collapsed", 'w') as collapsed_file:
+            collapsed_file.writelines(f"{stack} {count}\n" for stack, count in sorted(stacks.items()) if count)
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Token bucket limiting rate of bytes or operations, shared by all threads
+class TokenBucket:
+    """
+    Up to rate tokens are added per second and at most burst of them are kept. consume() sleeps
+    until enough tokens are available, a request larger than burst is let through and paid back
+    afterwards, so large chunks are limited on average. rate 0 means unlimited.
+    """
+    def __init__(self, rate=0, burst=None):
+        self.lock = threading.Lock()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate or 0
+            self.burst = burst or self.rate
+            self.tokens = self.burst
+            self.updated = time.monotonic()
+
+    def consume(self, amount=1):
+        """Take amount tokens, return number of seconds spent waiting."""
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+# Limits of read and write bandwidth and metadata operations, changed at runtime from limits file
+class IOThrottle:
+    """
+    Limits are bytes per second for read and write and operations per second for metadata
+    (directory listing, create, rename, unlink, mkdir). load() reads them from a JSON file with keys
+    read_bytes_per_second, write_bytes_per_second and metadata_ops_per_second, missing keys keep their value.
+    """
+    LIMIT_KEYS = ("read_bytes_per_second", "write_bytes_per_second", "metadata_ops_per_second")
+
+    def __init__(self):
+        self.buckets = {key: TokenBucket() for key in self.LIMIT_KEYS}
+        self.lock = threading.Lock()
+        self.waited = 0.0
+
+    def configure(self, **limits):
+        for key, rate in limits.items():
+            if key not in self.buckets:
+                raise ValueError(f"Unknown throttle limit: {key}")
+            if rate is not None:
+                self.buckets[key].set_rate(rate)
+
+    def limits(self):
+        return {key: bucket.rate for key, bucket in self.buckets.items()}
+
+    def load(self, path):
+        with open(path, 'r') as limits_file:
+            self.configure(**json.load(limits_file))
+
+    def limited(self, key):
+        return bool(self.buckets[key].rate)
+
+    def consume(self, key, amount):
+        waited = self.buckets[key].consume(amount)
+        if waited:
+            with self.lock:
+                self.waited += waited
+
+    def read(self, nbytes):
+        self.consume("read_bytes_per_second", nbytes)
+
+    def write(self, nbytes):
+        self.consume("write_bytes_per_second", nbytes)
+
+    def metadata(self, operations=1):
+        self.consume("metadata_ops_per_second", operations)
+
+# Throttle shared by every copy, hash and delete of the process
+THROTTLE = IOThrottle()
+
+# ------------------------------------------------------------------------------------
+# Idle I/O scheduling class and lower CPU priority (Linux), both are inherited by threads and processes started later
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+SYS_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "i686": 289, "armv7l": 314, "ppc64le": 273, "s390x": 282}
+
+def set_idle_io_priority():
+    """Move calling process into idle I/O class, it gets disk time only when nobody else needs it."""
+    syscall_number = SYS_IOPRIO_SET.get(os.uname().machine) if hasattr(os, "uname") else None
+    if syscall_number is None:
+        raise OSError(errno.ENOSYS, "ioprio_set is not available on this platform")
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+def lower_thread_priority(nice):
+    """Add nice to CPU priority of calling thread (per thread on Linux, whole process elsewhere)."""
+    if not nice:
+        return
+    if hasattr(os, "uname") and os.uname().sysname == "Linux":
+        thread_id = threading.get_native_id()
+        os.setpriority(os.PRIO_PROCESS, thread_id, os.getpriority(os.PRIO_PROCESS, thread_id) + nice)
+    elif hasattr(os, "nice"):
+        os.nice(nice)
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Persistent LRU cache of file digests keyed by stat signature
+class HashCache:
+    """
+    Maps (device, inode, size, mtime_ns, algorithm) to hex digest, so a file is hashed again
+    only when its stat signature changes. Least recently used entries are evicted above max_entries.
+    """
+    def __init__(self, path=None, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path, 'r') as cache_file:
+                for *key, digest in json.load(cache_file):
+                    self.entries[tuple(key)] = digest
+            while len(self.entries) > max_entries:
+                self.entries.popitem(last=False)
+
+    @staticmethod
+    def key(stat_result, algorithm):
+        return (stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns, algorithm)
+
+    def get(self, key):
+        with self.lock:
+            digest = self.entries.get(key)
+            if digest is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return digest
+
+    def put(self, key, digest):
+        with self.lock:
+            self.entries[key] = digest
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save(self):
+        """Write cache atomically, so an interrupted save never leaves a truncated file."""
+        if not self.path:
+            return
+        with self.lock:
+            rows = [[*key, digest] for key, digest in self.entries.items()]
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w') as cache_file:
+            json.dump(rows, cache_file)
+        os.replace(temporary_path, self.path)
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Digest generator functions
+HASH_ALGORITHMS = ("md5", "sha256", "blake2b")
+HASH_METHODS = ("auto", "readinto", "mmap")
+
+def file_digest(file_path, algorithm="md5", method="auto", buffer_size=1024 * 1024):
+    """
+    Hex digest of file. 'auto' uses hashlib.file_digest when available, 'readinto' reads into one
+    reused buffer without allocating bytes per chunk, 'mmap' hashes memory mapped file at once.
+    """
+    # With read limit every chunk goes through the shared throttle, so only readinto can be used
+    throttled = THROTTLE.limited("read_bytes_per_second")
+    with open(file_path, 'rb') as bin_files:
+        if method == "auto" and hasattr(hashlib, "file_digest") and not throttled:
+            return hashlib.file_digest(bin_files, algorithm).hexdigest()
+        file_hash = hashlib.new(algorithm)
+        if method == "mmap" and os.fstat(bin_files.fileno()).st_size > 0 and not throttled:
+            with mmap.mmap(bin_files.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                file_hash.update(mapped)
+            return file_hash.hexdigest()
+        buffer = bytearray(buffer_size)
+        view = memoryview(buffer)
+        while size := bin_files.readinto(buffer):
+            THROTTLE.read(size)
+            file_hash.update(view[:size])
+    return file_hash.hexdigest()
+
+# Initializer of hashing processes, they start without state of the parent process, so settings are passed in.
+# Read limit of hashed files is paid by the parent before submitting, the process itself is not throttled
+def init_hash_process(nice, idle_io):
+    THROTTLE.configure(read_bytes_per_second=0, write_bytes_per_second=0, metadata_ops_per_second=0)
+    if idle_io:
+        try:
+            set_idle_io_priority()
+        except OSError:
+            pass
+    lower_thread_priority(nice)
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Configurable digest layer with optional cache and process pool for large files
+class DigestBackend:
+    """
+    Hashes files with configured algorithm and method. Cache is consulted before reading a file,
+    files of at least parallel_threshold bytes are hashed in a process pool when processes > 0,
+    so both sides of a large pair are read at the same time. Pool processes are started by forkserver
+    (spawn where it is not available), a fork of this threaded process could inherit a held lock.
+    """
+    def __init__(self, algorithm="md5", method="auto", cache=None, processes=0,
+                 parallel_threshold=64 * 1024 * 1024, buffer_size=1024 * 1024, nice=0, idle_io=False):
+        if algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.method = method
+        self.cache = cache
+        self.parallel_threshold = parallel_threshold
+        self.buffer_size = buffer_size
+        self.pool = None
+        if processes:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context(start_method),
+                                            initializer=init_hash_process, initargs=(nice, idle_io))
+        self.lock = threading.Lock()
+        self.bytes_hashed = 0
+
+    def submit(self, file_path):
+        """Return callable producing digest of file, large files start hashing in the pool right away."""
+        file_stat = os.stat(file_path)
+        key = HashCache.key(file_stat, self.algorithm)
+        if self.cache is not None and (digest := self.cache.get(key)) is not None:
+            return lambda: digest
+        with self.lock:
+            self.bytes_hashed += file_stat.st_size
+        if self.pool is not None and file_stat.st_size >= self.parallel_threshold:
+            # Read limit is paid here before hashing starts, pool processes do not throttle (init_hash_process)
+            THROTTLE.read(file_stat.st_size)
+            future = self.pool.submit(file_digest, file_path, self.algorithm, self.method, self.buffer_size)
+            return lambda: self.store(key, future.result())
+        return lambda: self.store(key, file_digest(file_path, self.algorithm, self.method, self.buffer_size))
+
+    def store(self, key, digest):
+        if self.cache is not None:
+            self.cache.put(key, digest)
+        return digest
+
+    def digest(self, file_path):
+        return self.submit(file_path)()
+
+    def digest_pair(self, source_path, destination_path):
+        source_result = self.submit(source_path)
+        destination_result = self.submit(destination_path)
+        return source_result(), destination_result()
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Early-exit streaming comparison of two files
+COMPARE_STRATEGIES = ("hash", "stream")
+
+def files_differ(first_path, second_path, block_size=1024 * 1024):
+    """
+    Read both files in lockstep into two reused buffers and stop at the first differing block.
+    Different sizes are reported without reading any data.
+    """
+    if os.stat(first_path).st_size != os.stat(second_path).st_size:
+        return True
+    first_buffer, second_buffer = bytearray(block_size), bytearray(block_size)
+    first_view, second_view = memoryview(first_buffer), memoryview(second_buffer)
+    with open(first_path, 'rb') as first_file, open(second_path, 'rb') as second_file:
+        while True:
+            first_size = first_file.readinto(first_buffer)
+            second_size = second_file.readinto(second_buffer)
+            THROTTLE.read(first_size + second_size)
+            if first_size != second_size or first_view[:first_size] != second_view[:second_size]:
+                return True
+            if not first_size:
+                return False
+
+
+# Digest generator function kept for MD5 callers, optional cache is consulted before reading the file
+def md5_digest(file_paths, chunk_size=1024 * 1024, cache=None):
+    return DigestBackend("md5", method="readinto", cache=cache, buffer_size=chunk_size).digest(file_paths)
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Block level delta transfer of large modified files (rsync algorithm)
+DELTA_BLOCK_SIZE = 64 * 1024
+
+def weak_checksum(block):
+    """Adler-32 checksum split into (a, b) halves, computed by zlib and rolled forward in roll_checksum."""
+    checksum = zlib.adler32(block)
+    return checksum & 0xffff, checksum >> 16
+
+def roll_checksum(a, b, out_byte, in_byte, block_size):
+    """Move Adler-32 window one byte forward: drop out_byte, append in_byte."""
+    a = (a - out_byte + in_byte) % 65521
+    b = (b - block_size * out_byte + a - 1) % 65521
+    return a, b
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+def block_signatures(data, block_size):
+    """Map weak checksum of every full block of destination to {strong checksum: offset}."""
+    signatures = {}
+    for offset in range(0, len(data) - block_size + 1, block_size):
+        block = data[offset:offset + block_size]
+        a, b = weak_checksum(block)
+        signatures.setdefault(a | b << 16, {}).setdefault(strong_checksum(block), offset)
+    return signatures
+
+def delta_instructions(source, destination, block_size, max_literal_ratio, max_unmatched_blocks=8):
+    """
+    Return list of (source_offset, destination_offset, length) ranges, destination_offset is None
+    for literal data, or None when more than max_literal_ratio of source is literal.
+    Blocks at the same offset are compared directly, rolling checksum is used only after a mismatch.
+    Rolling runs byte by byte in Python, after max_unmatched_blocks consecutive blocks without a match
+    only whole blocks are looked up until data matches again, so a rewritten file gives up quickly.
+    """
+    signatures = block_signatures(destination, block_size)
+    size, literal_limit = len(source), max_literal_ratio * len(source)
+    instructions, literal_start, literal_bytes, position, unmatched = [], 0, 0, 0, 0
+
+    def add_match(position, offset):
+        nonlocal literal_bytes
+        if literal_start < position:
+            instructions.append((literal_start, None, position - literal_start))
+            literal_bytes += position - literal_start
+        instructions.append((position, offset, block_size))
+
+    while position + block_size <= size:
+        if position + block_size <= len(destination) and \
+                source[position:position + block_size] == destination[position:position + block_size]:
+            add_match(position, position)
+            position = literal_start = position + block_size
+            unmatched = 0
+            continue
+        a, b = weak_checksum(source[position:position + block_size])
+        # Roll over at most one block looking for data shifted by insertions or deletions
+        rolling = unmatched < max_unmatched_blocks
+        roll_end = min(size - block_size, position + block_size) if rolling else position
+        while True:
+            candidates = signatures.get(a | b << 16)
+            if candidates:
+                offset = candidates.get(strong_checksum(source[position:position + block_size]))
+                if offset is not None:
+                    add_match(position, offset)
+                    position = literal_start = position + block_size
+                    unmatched = 0
+                    break
+            if position >= roll_end:
+                # Whole blocks are looked up at offsets of destination blocks, where unshifted data lies
+                position = position + 1 if rolling else (position // block_size + 1) * block_size
+                unmatched += 1
+                break
+            a, b = roll_checksum(a, b, source[position], source[position + block_size], block_size)
+            position += 1
+        if literal_bytes + (position - literal_start) > literal_limit:
+            return None
+    if literal_start < size:
+        instructions.append((literal_start, None, size - literal_start))
+    return instructions
+
+def delta_sync_file(source_path, destination_path, block_size=DELTA_BLOCK_SIZE, max_literal_ratio=0.5):
+    """
+    Update destination to the content of source rewriting only changed ranges.
+    When every unchanged block stays at its offset the literal ranges are written in place,
+    otherwise destination is rebuilt into a temp file from its own blocks and source literals.
+    Return number of bytes written or None when a plain copy is cheaper or destination is hard linked
+    (patching it in place would change every link).
+    """
+    source_size, destination_stat = os.stat(source_path).st_size, os.stat(destination_path)
+    destination_size = destination_stat.st_size
+    if source_size == 0 or destination_size == 0 or destination_stat.st_nlink > 1:
+        return None
+    THROTTLE.read(source_size + destination_size)
+    with open(source_path, 'rb') as source_file, open(destination_path, 'rb') as destination_file, \
+            mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ) as source, \
+            mmap.mmap(destination_file.fileno(), 0, access=mmap.ACCESS_READ) as destination:
+        instructions = delta_instructions(source, destination, block_size, max_literal_ratio)
+        if instructions is None:
+            return None
+        if all(offset is None or offset == start for start, offset, _ in instructions):
+            bytes_written = 0
+            with open(destination_path, 'r+b') as target:
+                for start, offset, length in instructions:
+                    if offset is None:
+                        THROTTLE.write(length)
+                        target.seek(start)
+                        bytes_written += target.write(source[start:start + length])
+                target.truncate(len(source))
+        else:
+            descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(destination_path), prefix=".delta-")
+            try:
+                with os.fdopen(descriptor, 'wb') as target:
+                    for start, offset, length in instructions:
+                        THROTTLE.write(length)
+                        target.write(source[start:start + length] if offset is None
+                                     else destination[offset:offset + length])
+                os.replace(temporary_path, destination_path)
+            except BaseException:
+                os.remove(temporary_path)
+                raise
+            bytes_written = len(source)
+    shutil.copystat(source_path, destination_path)
+    return bytes_written
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Zero-copy file copy engine: reflink, copy_file_range, sendfile, buffered copy in this order
+FICLONE = 0x40049409
+COPY_BUFFER_SIZE = 1024 * 1024
+# Errors meaning that the method is not supported for this pair of files, next method is tried
+COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP,
+                        errno.EBADF, errno.ENOTTY, errno.EPERM}
+
+def copy_file_data(source_fd, destination_fd, size):
+    """Copy content between open descriptors, return name of method which was used."""
+    if fcntl is not None and size:
+        try:
+            fcntl.ioctl(destination_fd, FICLONE, source_fd)
+            THROTTLE.metadata()
+            return "reflink"
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method):
+            continue
+        copied = 0
+        try:
+            while True:
+                if method == "copy_file_range":
+                    sent = os.copy_file_range(source_fd, destination_fd, COPY_BUFFER_SIZE * 8)
+                else:
+                    sent = os.sendfile(destination_fd, source_fd, None, COPY_BUFFER_SIZE * 8)
+                if not sent:
+                    break
+                copied += sent
+                THROTTLE.read(sent)
+                THROTTLE.write(sent)
+            # Some file systems report end of file right away for files with data, like shutil the next method is tried
+            if copied or not size:
+                return method
+        except OSError as e:
+            # Method may fail only before any data was written, afterwards the error is real
+            if copied or e.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(source_fd, 'rb', closefd=False) as source_file, open(destination_fd, 'wb', closefd=False) as destination_file:
+        while length := source_file.readinto(buffer):
+            THROTTLE.read(length)
+            THROTTLE.write(length)
+            destination_file.write(view[:length])
+    return "buffered"
+
+def copy_file(source_path, destination_path, resumable_threshold=None):
+    """
+    Replacement of shutil.copy2 which avoids user space buffers where the platform allows.
+    Metadata is preserved the same way as copy2 does. Return name of method which copied the data.
+    Files of at least resumable_threshold bytes are copied by resumable_copy.
+    """
+    if os.path.isdir(destination_path):
+        destination_path = os.path.join(destination_path, os.path.basename(source_path))
+    resumable_threshold = RESUMABLE_COPY_THRESHOLD if resumable_threshold is None else resumable_threshold
+    if resumable_threshold and os.stat(source_path).st_size >= resumable_threshold:
+        return resumable_copy(source_path, destination_path)
+    # Hard linked destination (deduplicated copy) is unlinked first, truncating it would change every link
+    try:
+        if os.lstat(destination_path).st_nlink > 1:
+            os.unlink(destination_path)
+    except FileNotFoundError:
+        pass
+    THROTTLE.metadata()
+    with open(source_path, 'rb') as source_file, open(destination_path, 'wb') as destination_file:
+        method = copy_file_data(source_file.fileno(), destination_file.fileno(),
+                                os.fstat(source_file.fileno()).st_size)
+    shutil.copystat(source_path, destination_path)
+    return method
+
+# Destination made a hard link or reflink of a file with the same content
+DEDUP_METHODS = ("off", "hardlink", "reflink")
+
+def link_duplicate(blob_path, source_path, destination_path, method="hardlink"):
+    """
+    Replace destination atomically with a hard link or reflink of blob_path. Reflink is a file
+    of its own and gets metadata of source, hard link shares inode and metadata with blob_path.
+    OSError when the file system can not do it (other file system, no reflink support, link limit).
+    """
+    THROTTLE.metadata()
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(destination_path), prefix=".dedup-")
+    try:
+        if method == "reflink":
+            if fcntl is None:
+                raise OSError(errno.EOPNOTSUPP, "Reflink is not supported on this platform")
+            with open(blob_path, 'rb') as blob_file:
+                fcntl.ioctl(descriptor, FICLONE, blob_file.fileno())
+            os.close(descriptor)
+            descriptor = None
+            shutil.copystat(source_path, temporary_path)
+        else:
+            os.close(descriptor)
+            descriptor = None
+            os.unlink(temporary_path)
+            os.link(blob_path, temporary_path)
+        os.replace(temporary_path, destination_path)
+    except BaseException:
+        if descriptor is not None:
+            os.close(descriptor)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temporary_path)
+        raise
+
+# ------------------------------------------------------------------------------------
+# Crash-safe copy of large files: temp file next to destination, checkpoints of verified offsets, atomic rename
+RESUMABLE_COPY_THRESHOLD = 64 * 1024 * 1024
+COPY_CHECKPOINT_INTERVAL = 64 * 1024 * 1024
+CHECKPOINT_VERIFY_SIZE = 64 * 1024
+PARTIAL_SUFFIX = ".owfs-partial"
+CHECKPOINT_SUFFIX = ".owfs-checkpoint"
+
+def partial_paths(destination_path):
+    """Return (partial file, checkpoint file) of destination, hidden names in the same directory."""
+    directory, name = os.path.split(destination_path)
+    return os.path.join(directory, f".{name}{PARTIAL_SUFFIX}"), os.path.join(directory, f".{name}{CHECKPOINT_SUFFIX}")
+
+def partial_target_name(name):
+    """Return name of file whose unfinished copy is stored under name, None for any other name."""
+    for suffix in (PARTIAL_SUFFIX, CHECKPOINT_SUFFIX):
+        if name.startswith(".") and name.endswith(suffix) and len(name) > len(suffix) + 1:
+            return name[1:-len(suffix)]
+    return None
+
+def copy_range(source_fd, destination_fd, offset, length):
+    """
+    Copy length bytes at offset between descriptors with copy_file_range, or pread/pwrite where unsupported.
+    Return name of method which was used.
+    """
+    start, end = offset, offset + length
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < end:
+                sent = os.copy_file_range(source_fd, destination_fd, min(end - offset, COPY_BUFFER_SIZE * 8), offset, offset)
+                if not sent and offset == start:
+                    # Nothing copied at all may be a file system without support, pread tells whether data is there
+                    break
+                if not sent:
+                    raise EOFError("Source file was truncated during copy")
+                offset += sent
+                THROTTLE.read(sent)
+                THROTTLE.write(sent)
+            if offset == end:
+                return "copy_file_range"
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+    while offset < end:
+        data = os.pread(source_fd, min(COPY_BUFFER_SIZE, end - offset), offset)
+        if not data:
+            raise EOFError("Source file was truncated during copy")
+        THROTTLE.read(len(data))
+        THROTTLE.write(len(data))
+        os.pwrite(destination_fd, data, offset)
+        offset += len(data)
+    return "pread/pwrite"
+
+def tail_digest(fd, offset):
+    """Digest of CHECKPOINT_VERIFY_SIZE bytes before offset, proves that both files agree up to the checkpoint."""
+    start = max(offset - CHECKPOINT_VERIFY_SIZE, 0)
+    return hashlib.blake2b(os.pread(fd, offset - start, start), digest_size=16).hexdigest()
+
+def read_checkpoint(checkpoint_path, source_stat):
+    try:
+        with open(checkpoint_path, 'r') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get("source") != [source_stat.st_size, source_stat.st_mtime_ns, source_stat.st_ino]:
+        return None
+    return checkpoint
+
+def write_checkpoint(checkpoint_path, source_stat, offset, digest):
+    temporary_path = checkpoint_path + ".tmp"
+    with open(temporary_path, 'w') as checkpoint_file:
+        json.dump({"source": [source_stat.st_size, source_stat.st_mtime_ns, source_stat.st_ino],
+                   "offset": offset, "digest": digest}, checkpoint_file)
+    os.replace(temporary_path, checkpoint_path)
+
+def resumable_copy(source_path, destination_path, checkpoint_interval=None):
+    """
+    Copy into a partial file in the destination directory and rename it over destination when finished,
+    so destination never holds a truncated file. After every checkpoint_interval bytes data is flushed,
+    the tail is compared with source and the offset is recorded in a checkpoint file. A copy interrupted
+    by a crash resumes from the last checkpoint when the source did not change meanwhile.
+    """
+    checkpoint_interval = checkpoint_interval or COPY_CHECKPOINT_INTERVAL
+    partial_path, checkpoint_path = partial_paths(destination_path)
+    THROTTLE.metadata()
+    with open(source_path, 'rb') as source_file:
+        source_fd = source_file.fileno()
+        source_stat = os.fstat(source_fd)
+        size = source_stat.st_size
+        offset = 0
+        checkpoint = read_checkpoint(checkpoint_path, source_stat) if os.path.exists(partial_path) else None
+        if checkpoint is not None:
+            destination_fd = os.open(partial_path, os.O_RDWR)
+            offset = checkpoint["offset"]
+            # Partial data is trusted only when its tail still matches the recorded digest and the source
+            if offset > size or tail_digest(destination_fd, offset) != checkpoint["digest"] or \
+                    tail_digest(source_fd, offset) != checkpoint["digest"]:
+                offset = 0
+        else:
+            destination_fd = os.open(partial_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        method = "resumed" if offset else "copy_file_range"
+        try:
+            if not offset and fcntl is not None and size:
+                try:
+                    fcntl.ioctl(destination_fd, FICLONE, source_fd)
+                    offset, method = size, "reflink"
+                except OSError as e:
+                    if e.errno not in COPY_FALLBACK_ERRNOS:
+                        raise
+            if offset < size and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(destination_fd, offset, size - offset)
+                except OSError as e:
+                    if e.errno not in COPY_FALLBACK_ERRNOS:
+                        raise
+            while offset < size:
+                length = min(checkpoint_interval, size - offset)
+                range_method = copy_range(source_fd, destination_fd, offset, length)
+                if method != "resumed":
+                    method = range_method
+                os.fsync(destination_fd)
+                offset += length
+                digest = tail_digest(destination_fd, offset)
+                if digest != tail_digest(source_fd, offset):
+                    raise OSError(errno.EIO, f"Verification of copied data failed at offset {offset}", destination_path)
+                write_checkpoint(checkpoint_path, source_stat, offset, digest)
+            os.ftruncate(destination_fd, size)
+            os.fsync(destination_fd)
+        finally:
+            os.close(destination_fd)
+    shutil.copystat(source_path, partial_path)
+    os.replace(partial_path, destination_path)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return method
 
 # ------------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------------
@@ -111,103 +1446,1834 @@ def remove_readonly(func, path, _):
     os.chmod(path, stat.S_IWRITE)  
     func(path)  # Retry the deletion
     
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Remove directory tree with explicit stack, so deep trees never reach the recursion limit
+DIR_FD_REMOVE = os.scandir in os.supports_fd and os.unlink in os.supports_dir_fd
+
+def remove_tree(path, stopping=None, pace=None):
+    """
+    Entries are unlinked relative to an open descriptor of their directory where supported (unlinkat),
+    so long paths are not resolved again for every file. pace() is called before every removal.
+    Return False when stopping was set before the whole tree was removed.
+    """
+    stack = [(path, False)]
+    while stack:
+        if stopping is not None and stopping.is_set():
+            return False
+        directory, emptied = stack.pop()
+        THROTTLE.metadata()
+        if emptied:
+            os.rmdir(directory)
+            continue
+        stack.append((directory, True))
+        directory_fd = os.open(directory, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)) if DIR_FD_REMOVE else None
+        try:
+            with os.scandir(directory if directory_fd is None else directory_fd) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((os.path.join(directory, entry.name), False))
+                        continue
+                    THROTTLE.metadata()
+                    if pace is not None:
+                        pace()
+                    try:
+                        if directory_fd is not None:
+                            os.unlink(entry.name, dir_fd=directory_fd)
+                        else:
+                            os.unlink(entry.path)
+                    except PermissionError:
+                        remove_readonly(os.unlink, os.path.join(directory, entry.name), None)
+        finally:
+            if directory_fd is not None:
+                os.close(directory_fd)
+    return True
+
+# ------------------------------------------------------------------------------------
+# Trash inside destination root: removed trees disappear with one rename and are deleted in background
+TRASH_NAME = ".owfs-trash"
+
+def trash_path(destination_dir):
+    """Hidden directory in destination root, on the same file system even when destination is a mount point."""
+    return os.path.join(os.path.normpath(os.path.abspath(destination_dir)), TRASH_NAME)
+
+class TrashReaper:
+    """
+    discard() renames directory into trash, which is atomic and instant on the same file system,
+    and a background thread deletes trash contents at most rate entries per second (0 is unlimited,
+    the shared metadata limit applies as well). Trees left in trash by a stop or crash are deleted
+    after the next start. discard() returns False when rename is not possible (tree on another mounted
+    file system), the caller then removes the tree in place.
+    """
+    def __init__(self, trash_dir, logger, rate=0):
+        self.trash_dir = trash_dir
+        self.logger = logger
+        self.bucket = TokenBucket(rate, max(rate, 1)) if rate else None
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        # Shared by worker threads, next() of a count is atomic
+        self.sequence = itertools.count(1)
+        self.reaped = 0
+        self.warned = False
+        self.thread = threading.Thread(target=self.run, name="trash_reaper", daemon=True)
+        self.thread.start()
+
+    def discard(self, path):
+        try:
+            os.makedirs(self.trash_dir, exist_ok=True)
+            os.rename(path, os.path.join(self.trash_dir, f"{time.time_ns()}-{next(self.sequence)}"))
+        except OSError as e:
+            if not self.warned:
+                self.warned = True
+                self.logger.warning(f"Trash {self.trash_dir} not usable for {path}, removing in place: {e}.")
+            else:
+                self.logger.debug(f"Trash not used for {path}: {e}.")
+            return False
+        self.wake.set()
+        return True
+
+    def pace(self):
+        if self.bucket is not None:
+            self.bucket.consume()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wake.clear()
+            try:
+                names = sorted(os.listdir(self.trash_dir))
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                try:
+                    if not remove_tree(os.path.join(self.trash_dir, name), stopping=self.stopping, pace=self.pace):
+                        return
+                    self.reaped += 1
+                except OSError as e:
+                    self.logger.error(f"Trash entry {name} not deleted: {e}.")
+            if names:
+                self.logger.debug(f"Trash emptied, {self.reaped} trees deleted so far.")
+            # Failed entries are tried again after the next discard or restart
+            self.wake.wait()
+
+    def shutdown(self):
+        self.stopping.set()
+        self.wake.set()
+        self.thread.join()
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Function for reading optional command line arguments
+def get_option(args, name, default=None):
+    """Return optional argument or default when args object (argparse.Namespace or similar) does not have it."""
+    return getattr(args, name, default)
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Stat signature used for detecting changed files between cycles
+def stat_signature(stat_result):
+    return (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino)
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Persistent index of the last successful synchronization state
+class SyncStateIndex:
+    """
+    SQLite file with stat signatures, directory mtimes and content hashes of synced entries.
+    Paths are stored relative to the source root with '/' as separator, root is ''.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                rel_path TEXT PRIMARY KEY, parent TEXT NOT NULL, name TEXT NOT NULL,
+                is_dir INTEGER NOT NULL, size INTEGER, mtime_ns INTEGER, ino INTEGER, digest TEXT);
+            CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+            CREATE INDEX IF NOT EXISTS entries_ino ON entries (ino);
+            CREATE TABLE IF NOT EXISTS directories (
+                rel_path TEXT PRIMARY KEY, source_mtime_ns INTEGER NOT NULL,
+                destination_mtime_ns INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+
+    @staticmethod
+    def join(parent, name):
+        return f"{parent}/{name}" if parent else name
+
+    def directory_state(self, rel_path):
+        """Return (source_mtime_ns, destination_mtime_ns) recorded for directory or None."""
+        return self.connection.execute(
+            "SELECT source_mtime_ns, destination_mtime_ns FROM directories WHERE rel_path = ?",
+            (rel_path,)).fetchone()
+
+    def children(self, rel_path):
+        """Return (name, is_dir, size, mtime_ns, ino, digest) rows recorded under directory."""
+        return self.connection.execute(
+            "SELECT name, is_dir, size, mtime_ns, ino, digest FROM entries WHERE parent = ?",
+            (rel_path,)).fetchall()
+
+    def forget(self, rel_path):
+        """Remove entry and whole recorded subtree below it."""
+        if not rel_path:
+            self.clear()
+            return
+        # Every descendant key lies between 'path/' and 'path0' ('0' follows '/' in ASCII)
+        for table in ("entries", "directories"):
+            self.connection.execute(f"DELETE FROM {table} WHERE rel_path = ? OR (rel_path >= ? AND rel_path < ?)",
+                                    (rel_path, rel_path + "/", rel_path + "0"))
+
+    def entries_by_inode(self, ino):
+        """Return (rel_path, is_dir, size, mtime_ns) of entries which had inode in the last cycle."""
+        return self.connection.execute("SELECT rel_path, is_dir, size, mtime_ns FROM entries WHERE ino = ?",
+                                       (ino,)).fetchall()
+
+    def move(self, old_rel_path, new_rel_path):
+        """Move recorded entry with its whole subtree to a new path."""
+        self.forget(new_rel_path)
+        old_length = len(old_rel_path)
+        subtree = (old_rel_path + "/", old_rel_path + "0")
+        for table in ("entries", "directories"):
+            self.connection.execute(f"UPDATE {table} SET rel_path = ? || substr(rel_path, ?) "
+                                    f"WHERE rel_path >= ? AND rel_path < ?", (new_rel_path, old_length + 1, *subtree))
+        self.connection.execute("UPDATE entries SET parent = ? || substr(parent, ?) "
+                                "WHERE parent = ? OR (parent >= ? AND parent < ?)",
+                                (new_rel_path, old_length + 1, old_rel_path, *subtree))
+        parent, _, name = new_rel_path.rpartition("/")
+        self.connection.execute("UPDATE entries SET rel_path = ?, parent = ?, name = ? WHERE rel_path = ?",
+                                (new_rel_path, parent, name, old_rel_path))
+        self.connection.execute("UPDATE directories SET rel_path = ? WHERE rel_path = ?", (new_rel_path, old_rel_path))
+
+    def record_directory(self, rel_path, source_mtime_ns, destination_mtime_ns, entries, digests=None):
+        """
+        Replace recorded listing of directory with entries: (name, is_dir, stat_result).
+        Subtrees of children which disappeared from the listing are forgotten.
+        """
+        digests = digests or {}
+        previous = {row[0]: row for row in self.children(rel_path)}
+        current = {name for name, _, _ in entries}
+        for name in previous.keys() - current:
+            self.forget(self.join(rel_path, name))
+        rows = []
+        for name, is_dir, stat_result in entries:
+            digest = digests.get(name)
+            old = previous.get(name)
+            # Keep previous digest while file signature is unchanged
+            if digest is None and old is not None and not is_dir and tuple(old[2:5]) == stat_signature(stat_result):
+                digest = old[5]
+            rows.append((self.join(rel_path, name), rel_path, name, int(is_dir),
+                         stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, digest))
+        self.connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?)",
+                                (rel_path, source_mtime_ns, destination_mtime_ns))
+
+    def update_entry(self, rel_path, stat_result, digest=None):
+        """Refresh stat signature (and optionally digest) of a single file."""
+        self.connection.execute("UPDATE entries SET size = ?, mtime_ns = ?, ino = ?, digest = ? WHERE rel_path = ?",
+                                (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, digest, rel_path))
+
+    def ensure_settings(self, **settings):
+        """Clear index when it was built with different settings (e.g. hidden files filtering)."""
+        stored = dict(self.connection.execute("SELECT key, value FROM settings"))
+        expected = {key: str(value) for key, value in settings.items()}
+        if stored != expected:
+            self.clear()
+            self.connection.execute("DELETE FROM settings")
+            self.connection.executemany("INSERT INTO settings VALUES (?, ?)", expected.items())
+            self.commit()
+            return False
+        return True
+
+    def verify(self, source_root, destination_root):
+        """
+        Compare index with disk and return list of relative paths which disagree.
+        Files are checked by stat signature in source and by size in destination.
+        """
+        mismatches = []
+        for rel_path, is_dir, size, mtime_ns, ino in self.connection.execute(
+                "SELECT rel_path, is_dir, size, mtime_ns, ino FROM entries ORDER BY rel_path"):
+            source_path = os.path.join(source_root, *rel_path.split("/"))
+            destination_path = os.path.join(destination_root, *rel_path.split("/"))
+            try:
+                source_stat = os.stat(source_path)
+                destination_stat = os.stat(destination_path)
+            except OSError:
+                mismatches.append(rel_path)
+                continue
+            if is_dir:
+                if not (stat.S_ISDIR(source_stat.st_mode) and stat.S_ISDIR(destination_stat.st_mode)):
+                    mismatches.append(rel_path)
+            elif stat_signature(source_stat) != (size, mtime_ns, ino) or destination_stat.st_size != size:
+                mismatches.append(rel_path)
+        return mismatches
+
+    def invalidate_directory(self, rel_path):
+        """Drop recorded directory state so the next cycle compares it in full."""
+        self.connection.execute("DELETE FROM directories WHERE rel_path = ?", (rel_path,))
+
+    def clear(self):
+        self.connection.execute("DELETE FROM entries")
+        self.connection.execute("DELETE FROM directories")
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Persistent content-address table of files written into destination, used by deduplicating copy
+class ContentStore:
+    """
+    SQLite file with path, size, mtime and digest of destination files. Files are grouped by size first,
+    digest of a recorded file is computed only when a new file of the same size shows up, after that
+    files of the same content are looked up by (size, algorithm, digest) through the index.
+    A row is trusted only while size and mtime of its file did not change, and its digest only for the same algorithm.
+    Hard links made by deduplication are recorded with stat of their source, so later cycles do not compare them again.
+    Shared by worker threads.
+    """
+    # Rows without digest of algorithm are fetched and hashed in batches of this size
+    BATCH_SIZE = 16
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS contents (
+                path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, algorithm TEXT, digest TEXT);
+            CREATE INDEX IF NOT EXISTS contents_size ON contents (size, algorithm, digest);
+            CREATE TABLE IF NOT EXISTS links (
+                path TEXT PRIMARY KEY, source_size INTEGER NOT NULL, source_mtime_ns INTEGER NOT NULL,
+                ino INTEGER NOT NULL, mtime_ns INTEGER NOT NULL);
+        """)
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+
+    def has_size(self, size):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM contents WHERE size = ? LIMIT 1", (size,)).fetchone() is not None
+
+    def matches(self, size, algorithm, digest):
+        """Return (path, mtime_ns) of recorded files of size whose digest of algorithm is digest."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT path, mtime_ns FROM contents WHERE size = ? AND algorithm = ? AND digest = ?",
+                (size, algorithm, digest)).fetchall()
+
+    def unhashed(self, size, algorithm):
+        """Return up to BATCH_SIZE paths of recorded files of size without digest of algorithm."""
+        with self.lock:
+            return [row[0] for row in self.connection.execute(
+                "SELECT path FROM contents WHERE size = ? AND (digest IS NULL OR algorithm IS NOT ?) LIMIT ?",
+                (size, algorithm, self.BATCH_SIZE))]
+
+    def record(self, path, stat_result, algorithm=None, digest=None):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO contents VALUES (?, ?, ?, ?, ?)",
+                                    (path, stat_result.st_size, stat_result.st_mtime_ns,
+                                     algorithm if digest is not None else None, digest))
+
+    def record_link(self, path, source_stat, destination_stat):
+        """Remember that path is a hard link with content of a source file with source_stat."""
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?)",
+                                    (path, source_stat.st_size, source_stat.st_mtime_ns,
+                                     destination_stat.st_ino, destination_stat.st_mtime_ns))
+
+    def linked(self, path, source_stat, destination_stat):
+        """True when path is still the hard link recorded for the unchanged source file."""
+        with self.lock:
+            row = self.connection.execute("SELECT source_size, source_mtime_ns, ino, mtime_ns FROM links WHERE path = ?",
+                                          (path,)).fetchone()
+        return row == (source_stat.st_size, source_stat.st_mtime_ns, destination_stat.st_ino, destination_stat.st_mtime_ns)
+
+    def forget(self, path):
+        with self.lock:
+            self.connection.execute("DELETE FROM contents WHERE path = ?", (path,))
+            self.connection.execute("DELETE FROM links WHERE path = ?", (path,))
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# View of one planned operation, fields are read from columns of the plan on access
+class PlanOperation:
+    """
+    Created only while an operation is ordered, batched or executed, the plan itself keeps no objects
+    per operation. Source and destination paths are joined from directory table and name when asked for.
+    """
+    __slots__ = ("plan", "index")
+
+    def __init__(self, plan, index):
+        self.plan = plan
+        self.index = index
+
+    @property
+    def kind(self):
+        return SyncPlan.KINDS[self.plan.kinds[self.index]]
+
+    @property
+    def name(self):
+        return self.get("name") or self.plan.name(self.index)
+
+    @property
+    def source(self):
+        directory = self.plan.source_dirs[self.index]
+        if directory < 0:
+            return None
+        return os.path.join(self.plan.directories[directory], self.get("source_name") or self.plan.name(self.index))
+
+    @property
+    def destination(self):
+        return os.path.join(self.plan.directories[self.plan.destination_dirs[self.index]], self.plan.name(self.index))
+
+    @property
+    def key(self):
+        return self.plan.keys[self.index]
+
+    @property
+    def size(self):
+        return self.plan.sizes[self.index]
+
+    @property
+    def inode(self):
+        return self.plan.inodes[self.index]
+
+    def get(self, field, default=None):
+        if field in SyncPlan.FLAGS:
+            return bool(self.plan.flags[self.index] & (1 << SyncPlan.FLAGS.index(field)))
+        return self.plan.fields.get(self.index, {}).get(field, default)
+
+    def to_dict(self):
+        fields = {field: value for field, value in self.plan.fields.get(self.index, {}).items()
+                  if field not in ("name", "source_name")}
+        return {"kind": self.kind, "source": self.source, "destination": self.destination, "name": self.name,
+                "key": self.key, "size": self.size, "inode": self.inode,
+                **{flag: True for flag in SyncPlan.FLAGS if self.get(flag)}, **fields}
+
+# Operations of one phase: indices into plan columns, iterating yields PlanOperation views
+class PlanPhase:
+    __slots__ = ("plan", "indices")
+
+    def __init__(self, plan, indices):
+        self.plan = plan
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        return (PlanOperation(self.plan, index) for index in self.indices)
+
+# ------------------------------------------------------------------------------------
+# Complete list of operations of one cycle, built before anything in destination is changed
+class SyncPlan:
+    """
+    Operations are stored column-wise, so plans of huge trees stay small: kind, flags, directory indices,
+    size and inode in typed arrays, names encoded back to back in one bytearray and parent directories
+    once in a directory table. One operation takes about 60 bytes instead of a dict with two full paths
+    (about 600 bytes). Rare fields (keys of moves, digests of refreshes, source name of a renamed entry)
+    are kept in a sparse dict. to_dict() turns operations into plain dicts, so the plan can be dumped
+    as JSON for a dry run. phases() orders them for throughput:
+    moves first, then deletes to free space, then directory creation parents first,
+    then file operations with small files grouped together, each group sorted by inode.
+    """
+    SMALL_FILE_SIZE = 64 * 1024
+    SMALL_FILE_BATCH = 64
+    KINDS = ("move", "remove", "mkdir", "copy", "update", "refresh")
+    FILE_KINDS = ("copy", "update", "refresh")
+    FLAGS = ("tree_root", "in_tree", "is_dir")
+
+    def __init__(self):
+        self.generation = 0
+        self.reset()
+
+    def reset(self):
+        self.kinds = array.array("B")
+        self.flags = array.array("B")
+        self.source_dirs = array.array("i")
+        self.destination_dirs = array.array("i")
+        self.sizes = array.array("q")
+        self.inodes = array.array("Q")
+        self.name_offsets = array.array("Q", [0])
+        self.names = bytearray()
+        self.keys = []
+        self.fields = {}
+        self.directories = []
+        self.directory_index = {}
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __iter__(self):
+        return (PlanOperation(self, index) for index in range(len(self)))
+
+    def directory(self, path):
+        """Return index of directory path in directory table."""
+        index = self.directory_index.get(path)
+        if index is None:
+            index = self.directory_index[path] = len(self.directories)
+            self.directories.append(path)
+        return index
+
+    def name(self, index):
+        return os.fsdecode(bytes(self.names[self.name_offsets[index]:self.name_offsets[index + 1]]))
+
+    def add(self, kind, source, destination, name, key=None, size=0, inode=0, **fields):
+        destination_parent, destination_name = os.path.split(destination)
+        if source is not None:
+            source_parent, source_name = os.path.split(source)
+            if source_name != destination_name:
+                fields["source_name"] = source_name
+        if name != destination_name:
+            fields["name"] = name
+        flags = 0
+        for bit, flag in enumerate(self.FLAGS):
+            if fields.pop(flag, False):
+                flags |= 1 << bit
+        if fields:
+            self.fields[len(self)] = fields
+        self.kinds.append(self.KINDS.index(kind))
+        self.flags.append(flags)
+        self.source_dirs.append(self.directory(source_parent) if source is not None else -1)
+        self.destination_dirs.append(self.directory(destination_parent))
+        self.sizes.append(size)
+        self.inodes.append(inode)
+        self.names += os.fsencode(destination_name)
+        self.name_offsets.append(len(self.names))
+        self.keys.append(key)
+
+    def clear(self):
+        """Drop operations, generation tells traversal that everything planned before was executed."""
+        self.reset()
+        self.generation += 1
+
+    def take(self):
+        """Move operations into a new plan and clear this one."""
+        taken = SyncPlan()
+        taken.__dict__.update({name: value for name, value in self.__dict__.items() if name != "generation"})
+        self.clear()
+        return taken
+
+    def phases(self):
+        """Yield (phase, operations) in execution order, operations of one phase are independent of each other."""
+        by_kind = {}
+        for index, kind in enumerate(self.kinds):
+            by_kind.setdefault(self.KINDS[kind], array.array("l")).append(index)
+        yield "move", PlanPhase(self, by_kind.get("move", ()))
+        yield "remove", PlanPhase(self, by_kind.get("remove", ()))
+        yield "mkdir", PlanPhase(self, sorted(by_kind.get("mkdir", ()),
+                                              key=lambda index: self.directories[self.destination_dirs[index]].count(os.sep)))
+        files = [index for kind in self.FILE_KINDS for index in by_kind.get(kind, ())]
+        files.sort(key=lambda index: (self.sizes[index] >= self.SMALL_FILE_SIZE, self.inodes[index]))
+        yield "files", PlanPhase(self, array.array("l", files))
+
+    def batches(self, operations):
+        """Group consecutive small files into batches run by one worker, large files run one by one."""
+        batch = []
+        for operation in operations:
+            if operation.size >= self.SMALL_FILE_SIZE:
+                if batch:
+                    yield batch
+                    batch = []
+                yield [operation]
+                continue
+            batch.append(operation)
+            if len(batch) == self.SMALL_FILE_BATCH:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def summary(self, throughput=None):
+        """Counts per kind, bytes to copy and bytes to check; with throughput (bytes/s) also estimated duration."""
+        counts = Counter(self.KINDS[kind] for kind in self.kinds)
+        bytes_to_copy = sum(size for kind, size in zip(self.kinds, self.sizes) if self.KINDS[kind] == "copy")
+        bytes_to_check = sum(size for kind, size in zip(self.kinds, self.sizes) if self.KINDS[kind] in ("update", "refresh"))
+        summary = {"operations": dict(counts), "bytes_to_copy": bytes_to_copy, "bytes_to_check": bytes_to_check}
+        if throughput:
+            summary["estimated_seconds"] = round((bytes_to_copy + bytes_to_check) / throughput, 3)
+        return summary
+
+    def to_dict(self, throughput=None):
+        return {"summary": self.summary(throughput),
+                "operations": [operation.to_dict() for _, operations in self.phases() for operation in operations]}
+
+    def dump(self, path, throughput=None):
+        with open(path, 'w') as plan_file:
+            json.dump(self.to_dict(throughput), plan_file, indent=2)
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Executor of copy, hash-compare and delete operations of one cycle
+class SyncExecutor:
+    """
+    With one worker operations run inline, otherwise in a thread pool whose queue depth is bounded,
+    so directory scanning never runs far ahead of copying.
+    Failure of one operation is logged and remembered by its key instead of aborting the cycle.
+    A pool shared by several executors (daemon jobs) is used as it is and never shut down here,
+    queue depth then is the quota of one job, so a huge job can not fill the pool queue for the others.
+    """
+    def __init__(self, logger, workers=1, queue_depth=None, nice=0, pool=None):
+        self.logger = logger
+        self.workers = max(1, workers)
+        self.shared_pool = pool is not None
+        if pool is None and self.workers > 1:
+            pool = ThreadPoolExecutor(self.workers, thread_name_prefix="sync_worker", initializer=lower_thread_priority,
+                                      initargs=(nice,))
+        self.pool = pool
+        self.slots = threading.BoundedSemaphore(queue_depth or self.workers * 4)
+        self.condition = threading.Condition()
+        self.active = 0
+        self.failed_keys = set()
+        self.failures = 0
+
+    def submit(self, func, *args, key=None):
+        if self.pool is None:
+            self.run(func, args, key)
+            return
+        self.slots.acquire()
+        with self.condition:
+            self.active += 1
+        self.pool.submit(self.run_and_release, func, args, key)
+
+    def run(self, func, args, key):
+        try:
+            func(*args)
+        except Exception as e:
+            self.logger.error(f"Error syncing: {e}")
+            with self.condition:
+                self.failed_keys.add(key)
+                self.failures += 1
+
+    def run_and_release(self, func, args, key):
+        try:
+            self.run(func, args, key)
+        finally:
+            self.slots.release()
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def drain(self):
+        """Wait until every submitted operation finished."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.active == 0)
+
+    def shutdown(self):
+        if self.pool is not None and not self.shared_pool:
+            self.pool.shutdown(wait=True)
+
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Linux inotify watcher of the whole source tree (ctypes only, no third party packages)
+class InotifyWatcher:
+    """
+    Collects directories affected by changes in the source tree.
+    Bursts of events are debounced and coalesced into a set of directory paths,
+    None is returned when the kernel event queue overflowed and a full scan is needed.
+    Directories which could not be watched (ENOSPC when fs.inotify.max_user_watches is exceeded)
+    are collected in failures with their errno, changes inside them would go unnoticed.
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                  IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, root, rules=None):
+        self.root = root
+        self.rules = rules
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available on this platform")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.watches = {}
+        self.failures = {}
+        self.add_tree(root)
+
+    def add_tree(self, path):
+        """Watch directory and all its subdirectories."""
+        for root, dirs, _ in os.walk(path):
+            if self.rules:
+                dirs[:] = [name for name in dirs if not self.excluded(os.path.join(root, name), True)]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), self.WATCH_MASK)
+            if wd >= 0:
+                self.watches[wd] = root
+            elif ctypes.get_errno() not in (errno.ENOENT, errno.ENOTDIR):
+                # Directory removed meanwhile is reported by its parent, anything else is a blind spot
+                self.failures[root] = ctypes.get_errno()
+
+    def excluded(self, path, is_dir):
+        return self.rules.excluded(os.path.relpath(path, self.root).replace(os.sep, "/"), is_dir)
+
+    def remove_tree(self, path):
+        """Stop watching directory moved away, its watches would report stale paths."""
+        for wd, watched in list(self.watches.items()):
+            if watched == path or watched.startswith(path + os.sep):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def rebuild(self):
+        """Drop all watches and subscribe to the current tree again (after queue overflow)."""
+        for wd in list(self.watches):
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.watches.clear()
+        self.failures.clear()
+        self.add_tree(self.root)
+
+    def read_events(self, changed):
+        """Read pending events into set of changed directories, return False on queue overflow."""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return True
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + self.EVENT_HEADER.size:offset + self.EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += self.EVENT_HEADER.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                return False
+            directory = self.watches.get(wd)
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if directory is None or (self.rules and name and
+                                     self.excluded(os.path.join(directory, name), bool(mask & self.IN_ISDIR))):
+                continue
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                changed.add(os.path.dirname(directory))
+                continue
+            changed.add(directory)
+            # New subdirectories are watched right away, files created later inside them raise own events
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.add_tree(os.path.join(directory, name))
+            elif mask & self.IN_ISDIR and mask & self.IN_MOVED_FROM:
+                self.remove_tree(os.path.join(directory, name))
+        return True
+
+    def wait_for_changes(self, timeout=None, debounce=0.2, max_delay=2.0):
+        """
+        Block until something changes, then keep collecting until no event arrived for debounce seconds
+        (at most max_delay seconds). Return set of changed directories, empty set on timeout, None on overflow.
+        """
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        deadline = time.monotonic() + max_delay
+        while True:
+            if not self.read_events(changed):
+                return None
+            remaining = min(debounce, deadline - time.monotonic())
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                break
+        root_parent = os.path.dirname(self.root)
+        return {path for path in changed if path != root_parent}
+
+    def close(self):
+        os.close(self.fd)
+
 # ------------------------------------------------------------------------------------ 
 
 """ Wrapper function over functionality of program.
     Convinient way for testing porpuses by excluding argparse objects from testing module."""
 
-def command_line_arguments_wrapper(args):
+def command_line_arguments_wrapper(args, pool=None, logger_name="sync_logger"):
     
     SOURCE_DIR_PATH = args.source_dir_path
     DESTINATION_DIR_PATH = args.destination_dir_path
     OPTIONAL_FILTERING_IS_ON = args.filter_hidden_dirs_files
     LOG_PATH = args.log_path
-    logger = setup_logger(LOG_PATH)
+    LOG_SUMMARY = get_option(args, "log_summary", False)
+    STATE_INDEX_IS_ON = get_option(args, "state_index", False)
+    COMPARE_STRATEGY = get_option(args, "compare", "hash") or "hash"
+    DELTA_THRESHOLD = get_option(args, "delta_threshold", 0) or 0
+    DETECT_MOVES = get_option(args, "detect_moves", False)
+    MOVE_MIN_SIZE = get_option(args, "move_min_size", 1024 * 1024)
+    DELTA_BLOCK_SIZE_OPTION = get_option(args, "delta_block_size", DELTA_BLOCK_SIZE) or DELTA_BLOCK_SIZE
+    MAX_INFLIGHT_DIRS = get_option(args, "max_inflight_dirs", 1000) or 1000
+    RESUMABLE_THRESHOLD = get_option(args, "resumable_threshold", RESUMABLE_COPY_THRESHOLD)
+    logger = setup_logger(LOG_PATH, max_bytes=get_option(args, "log_max_bytes", 0) or 0,
+                          backups=get_option(args, "log_backups", 0) or 0,
+                          queue_size=get_option(args, "log_queue_size", 10000) or 10000, name=logger_name)
+
+    """ Optional include/exclude rules: hidden files and directories and gitignore-style patterns from file.
+        Entries which became excluded are removed from destination during the cycle, everything else stays in place."""
+
+    exclude_from = get_option(args, "exclude_from")
+    if exclude_from:
+        rules = FilterRules.from_file(exclude_from, hidden=bool(OPTIONAL_FILTERING_IS_ON))
+    else:
+        rules = FilterRules(hidden=bool(OPTIONAL_FILTERING_IS_ON))
+
+
+    """ Optional persistent state index of the last successful cycle.
+        Directories whose mtime did not change are synced from recorded entries without listing both sides."""
+
+    state_index = None
+    if STATE_INDEX_IS_ON:
+        index_path = get_option(args, "state_index_path") or os.path.splitext(LOG_PATH)[0] + ".index.sqlite"
+        state_index = SyncStateIndex(index_path)
+        if not state_index.ensure_settings(source=os.path.abspath(SOURCE_DIR_PATH),
+                                           destination=os.path.abspath(DESTINATION_DIR_PATH),
+                                           rules=rules.fingerprint,
+                                           hash=get_option(args, "hash", "md5") or "md5"):
+            logger.info(f"State index initialized: {index_path}.")
+        if get_option(args, "rebuild_index", False):
+            state_index.clear()
+            state_index.commit()
+            logger.warning(f"State index cleared, it will be rebuilt during next cycle: {index_path}.")
+        elif get_option(args, "verify_index", False):
+            mismatches = state_index.verify(SOURCE_DIR_PATH, DESTINATION_DIR_PATH)
+            for rel_path in mismatches:
+                logger.warning(f"State index mismatch: {rel_path}.")
+            if mismatches:
+                state_index.clear()
+                state_index.commit()
+                logger.warning(f"State index cleared after {len(mismatches)} mismatches, it will be rebuilt.")
+            else:
+                logger.info(f"State index verified: {index_path}.")
+    elif DETECT_MOVES:
+        logger.warning("Move detection without --state_index matches only renamed files of at least "
+                       f"{MOVE_MIN_SIZE} bytes inside one directory, moved directories are copied again.")
+
+
+    # Path of directory relative to source root in state index and rules format, None when outside of root
+    def relative_key(source_dir):
+        rel_path = os.path.relpath(source_dir, SOURCE_DIR_PATH)
+        if rel_path == os.curdir:
+            return ""
+        if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+            return None
+        return rel_path.replace(os.sep, "/")
+
+
+    """ Optional persistent cache of file digests, files are hashed again only when their stat signature changes."""
+
+    hash_cache = None
+    if get_option(args, "hash_cache", False):
+        hash_cache = HashCache(get_option(args, "hash_cache_path") or os.path.splitext(LOG_PATH)[0] + ".hashes.json",
+                               max_entries=get_option(args, "hash_cache_size", 100000) or 100000)
+
+
+    """ Optional deduplication of new and changed files. Files are grouped by size and then by digest,
+        content already in destination is linked (hard link or reflink) instead of copied again."""
+
+    DEDUP = get_option(args, "dedup", "off") or "off"
+    DEDUP_MIN_SIZE = get_option(args, "dedup_min_size", 64 * 1024) or 0
+    content_store = None
+    if DEDUP != "off":
+        content_store = ContentStore(get_option(args, "dedup_table_path") or os.path.splitext(LOG_PATH)[0] + ".dedup.sqlite")
+    # Copy throughput of previous cycles (bytes/s), used to estimate time saved by deduplication
+    copy_throughput = 0.0
+    # Log records dropped on full log queue which were already reported
+    log_records_dropped = 0
+
+
+    """ Optional throttling of read and write bandwidth and metadata operations, shared by all workers.
+        Limits file is read again when it changes (checked before every cycle) or on SIGHUP.
+        Idle I/O class and nice level are set before worker threads and processes are started, they inherit them."""
+
+    THROTTLE.configure(read_bytes_per_second=get_option(args, "read_limit", 0) or 0,
+                       write_bytes_per_second=get_option(args, "write_limit", 0) or 0,
+                       metadata_ops_per_second=get_option(args, "metadata_limit", 0) or 0)
+    LIMITS_FILE = get_option(args, "limits_file")
+    limits_file_mtime = None
+
+    def reload_limits(force=False):
+        nonlocal limits_file_mtime
+        try:
+            mtime = os.stat(LIMITS_FILE).st_mtime_ns
+            if not force and mtime == limits_file_mtime:
+                return
+            limits_file_mtime = mtime
+            THROTTLE.load(LIMITS_FILE)
+            logger.info(f"Throttle limits loaded: {THROTTLE.limits()}.")
+        except (OSError, ValueError, TypeError) as e:
+            logger.error(f"Throttle limits file {LIMITS_FILE} not loaded: {e}.")
+
+    if LIMITS_FILE:
+        reload_limits()
+    if get_option(args, "idle_io", False):
+        try:
+            set_idle_io_priority()
+        except OSError as e:
+            logger.warning(f"Idle I/O priority is not available: {e}.")
+    HASH_NICE = get_option(args, "hash_nice", 0) or 0
+
+
+    digest_backend = DigestBackend(get_option(args, "hash", "md5") or "md5",
+                                   method=get_option(args, "hash_method", "auto") or "auto", cache=hash_cache,
+                                   processes=get_option(args, "hash_processes", 0) or 0,
+                                   parallel_threshold=get_option(args, "hash_parallel_threshold", 64 * 1024 * 1024),
+                                   nice=HASH_NICE, idle_io=bool(get_option(args, "idle_io", False)))
+
 
-    """ Optional conditions for destination directory DELETION in case it exists.
-        Writing all volume of sorce folder without hidden files into absolute new folder."""
+    # Optional fast delete: removed directories are renamed into trash and deleted by background reaper
+    reaper = None
+    if get_option(args, "fast_delete", False):
+        reaper = TrashReaper(trash_path(DESTINATION_DIR_PATH), logger, rate=get_option(args, "trash_rate", 0) or 0)
 
-    if OPTIONAL_FILTERING_IS_ON:
-        if os.path.exists(DESTINATION_DIR_PATH):
+
+    # Optional parallel listing of directories ahead of traversal, mostly for network file systems
+    SCAN_WORKERS = get_option(args, "scan_workers", 0) or 0
+    scanner = ScanPrefetcher(SCAN_WORKERS) if SCAN_WORKERS > 0 else None
+
+
+    executor = SyncExecutor(logger, workers=get_option(args, "workers", 1) or 1,
+                            queue_depth=get_option(args, "queue_depth"), nice=HASH_NICE, pool=pool)
+    if executor.pool is None:
+        # Single worker hashes on the calling thread
+        lower_thread_priority(HASH_NICE)
+    # Work finished only after executor is drained: index records, digests of fast path, dir metadata
+    pending_records = []
+    # With move detection deletions wait until traversal ends, so stale entries can still be renamed.
+    # Oldest ones are planned right away when there are more than MAX_PENDING_DELETIONS of them
+    pending_deletions = {}
+    MAX_PENDING_DELETIONS = MAX_INFLIGHT_DIRS * 100
+    index_updates = []
+    # Directories of copied trees planned since the last flush, their metadata is copied after the flush
+    copied_directories = []
+    # Plan of current cycle, old destination paths of planned moves and digests computed per directory
+    plan = SyncPlan()
+    planned_moves = set()
+    directory_digests = {}
+    cycle_stats = CycleStats()
+    # Set by SIGTERM handler, running cycle stops at the next directory
+    stop_requested = threading.Event()
+
+
+    """ Optional metrics of all cycles: local HTTP endpoint in Prometheus text format and JSON status file."""
+
+    metrics = SyncMetrics(sync_period=get_option(args, "sync_period"))
+    STATUS_FILE = get_option(args, "status_file")
+    metrics_port = get_option(args, "metrics_port", 0)
+    metrics_server = None
+    if metrics_port:
+        metrics_server = start_metrics_server(metrics, get_option(args, "metrics_host", "127.0.0.1") or "127.0.0.1", metrics_port)
+        logger.info(f"Metrics served on http://{metrics_server.server_address[0]}:{metrics_server.server_address[1]}/metrics.")
+
+
+    """ Optional profiling of next cycles, armed by --profile at start or by SIGUSR1 at runtime."""
+
+    profiler = CycleProfiler(get_option(args, "profile_dir") or os.path.splitext(LOG_PATH)[0] + ".profiles", logger,
+                             cycles=get_option(args, "profile", 0) or 0,
+                             mode=get_option(args, "profile_mode", "sample") or "sample",
+                             interval=get_option(args, "profile_interval", 0.005) or 0.005)
+
+
+    # Add event to cycle summary, return True when it should also be logged one line per file
+    def count_event(kind, nbytes=0):
+        cycle_stats.add(kind, nbytes)
+        return not LOG_SUMMARY
+
+
+    # Operations executed by SyncExecutor, each one handles a single file or directory
+    def copy_file_operation(sorce_file, destination_file, file_name):
+        source_hash = None
+        if content_store is not None:
+            linked, source_hash = copy_deduplicated(sorce_file, destination_file, file_name)
+            if linked:
+                return
+        with cycle_stats.timed("copy"):
+            method = copy_file(sorce_file, destination_file, RESUMABLE_THRESHOLD)
+        destination_stat = os.stat(destination_file)
+        if content_store is not None:
+            content_store.record(destination_file, destination_stat, digest_backend.algorithm, source_hash)
+        if count_event("files_copied", destination_stat.st_size):
+            logger.info(f"File copied: {file_name} to --> {destination_file}.")
+            logger.debug(f"Copy method: {method} for --> {destination_file}.")
+
+    # Link destination to a recorded file with the same content, return (linked, digest of source or None)
+    def copy_deduplicated(sorce_file, destination_file, file_name):
+        source_stat = os.stat(sorce_file)
+        source_size = source_stat.st_size
+        if source_size < DEDUP_MIN_SIZE:
+            return False, None
+        if not content_store.has_size(source_size):
+            return False, None
+        with cycle_stats.timed("hash"):
+            source_hash = digest_backend.digest(sorce_file)
+            blob_path = find_blob(source_size, source_hash, destination_file)
+        if blob_path is None:
+            return False, source_hash
+        try:
+            with cycle_stats.timed("copy"):
+                link_duplicate(blob_path, sorce_file, destination_file, DEDUP)
+        except OSError as e:
+            logger.debug(f"Deduplication not possible for {destination_file}: {e}.")
+            return False, source_hash
+        destination_stat = os.stat(destination_file)
+        content_store.record(destination_file, destination_stat, digest_backend.algorithm, source_hash)
+        if DEDUP == "hardlink":
+            content_store.record_link(destination_file, source_stat, destination_stat)
+        cycle_stats.observe("dedup_bytes_saved", source_size)
+        if count_event("files_deduplicated"):
+            logger.info(f"File deduplicated: {file_name} to --> {destination_file} ({DEDUP} of {blob_path}).")
+        return True, source_hash
+
+    # Recorded file with digest of source, rows are verified by stat and recorded files of the same size
+    # without digest are hashed (and recorded) only until a match shows up. Return None when there is none
+    def find_blob(size, source_hash, destination_file):
+        algorithm = digest_backend.algorithm
+        for blob_path, mtime_ns in content_store.matches(size, algorithm, source_hash):
+            if blob_path == destination_file:
+                continue
             try:
-                shutil.rmtree(DESTINATION_DIR_PATH, onexc=remove_readonly)
-                logger.warning(f"Directory removed: <-- {DESTINATION_DIR_PATH}")
-            except Exception as e:
-                logger.error(f"Error deleting: {e} --> {DESTINATION_DIR_PATH}")  
-                     
-                     
-    # Directory synchronization function
-    def one_way_synchronization(source_dir, destination_dir):
+                blob_stat = os.stat(blob_path)
+            except FileNotFoundError:
+                content_store.forget(blob_path)
+                continue
+            if (blob_stat.st_size, blob_stat.st_mtime_ns) == (size, mtime_ns):
+                return blob_path
+            digest = digest_backend.digest(blob_path)
+            content_store.record(blob_path, blob_stat, algorithm, digest)
+            if digest == source_hash and blob_stat.st_size == size:
+                return blob_path
+        while blob_paths := content_store.unhashed(size, algorithm):
+            for blob_path in blob_paths:
+                try:
+                    blob_stat = os.stat(blob_path)
+                except FileNotFoundError:
+                    content_store.forget(blob_path)
+                    continue
+                digest = digest_backend.digest(blob_path)
+                content_store.record(blob_path, blob_stat, algorithm, digest)
+                if digest == source_hash and blob_stat.st_size == size and blob_path != destination_file:
+                    return blob_path
+        return None
+
+    # Update of existing destination file, large files are patched with block level delta
+    def replace_file_operation(sorce_file, destination_file, file_name):
+        source_size = os.stat(sorce_file).st_size
+        if DELTA_THRESHOLD and source_size >= DELTA_THRESHOLD:
+            with cycle_stats.timed("copy"):
+                bytes_written = delta_sync_file(sorce_file, destination_file, DELTA_BLOCK_SIZE_OPTION)
+            if bytes_written is not None:
+                if count_event("files_patched", bytes_written):
+                    logger.info(f"File patched: {file_name} to --> {destination_file} "
+                                f"({bytes_written} of {source_size} bytes written).")
+                return
+        copy_file_operation(sorce_file, destination_file, file_name)
+
+    def update_file_operation(sorce_file, destination_file, file_name, digests):
+
+        """ For large datasets also enshure data integrity by comparing hashes of the files.
+            Hash comparison is efficient for detecting changes in large files,
+            as it can detect changes even when file metadata (such as modification time or size) might not reflect a difference."""
+
+        if COMPARE_STRATEGY == "stream":
+            with cycle_stats.timed("hash"):
+                differ = files_differ(sorce_file, destination_file)
+            if differ:
+                replace_file_operation(sorce_file, destination_file, file_name)
+            return
+        with cycle_stats.timed("hash"):
+            source_hash, destination_hash = digest_backend.digest_pair(sorce_file, destination_file)
+        digests[file_name] = source_hash
+        if source_hash != destination_hash:
+            replace_file_operation(sorce_file, destination_file, file_name)
+
+    def refresh_file_operation(sorce_file, destination_file, file_name, entry_key, digest):
+        # Destination still holds the recorded content, so only the source has to be hashed
+        source_stat = os.stat(sorce_file)
+        if COMPARE_STRATEGY == "stream":
+            with cycle_stats.timed("hash"):
+                differ = files_differ(sorce_file, destination_file)
+            if differ:
+                replace_file_operation(sorce_file, destination_file, file_name)
+            index_updates.append((entry_key, source_stat, None))
+            return
+        with cycle_stats.timed("hash"):
+            source_hash = digest_backend.digest(sorce_file)
+        if source_hash != digest:
+            replace_file_operation(sorce_file, destination_file, file_name)
+        index_updates.append((entry_key, source_stat, source_hash))
+
+    def remove_operation(destination_file, file_name, is_dir):
+        with cycle_stats.timed("delete"):
+            if is_dir:
+                # Owner keeps read and search permission, reaper lists the tree after it is moved into trash
+                os.chmod(destination_file, stat.S_IRWXU)
+                if reaper is None or not reaper.discard(destination_file):
+                    remove_tree(destination_file)
+            else:
+                THROTTLE.metadata()
+                # Mode is changed only when needed, a hard linked file shares it with its other links
+                try:
+                    os.remove(destination_file)
+                except PermissionError:
+                    remove_readonly(os.remove, destination_file, None)
+        if is_dir:
+            if count_event("directories_removed"):
+                logger.warning(f"Directory removed: {file_name} from <-- {destination_file}.")
+        else:
+            if count_event("files_removed"):
+                logger.warning(f"File removed: {file_name} from <-- {destination_file}.")
+
 
-        if not os.path.exists(source_dir):
+    # Names excluded by rules inside directory copied as a whole
+    def excluded_names(directory, names):
+        cycle_stats.observe("directories_listed")
+        cycle_stats.observe("entries_stated", len(names))
+        if not rules:
+            return []
+        prefix = relative_key(directory)
+        prefix = prefix + "/" if prefix else ""
+        return [name for name in names if rules.excluded(prefix + name, os.path.isdir(os.path.join(directory, name)))]
+
+    # Copy of file inside directory which exists only in source, counted apart from single files
+    def copy_tree_file_operation(sorce_file, destination_file):
+        source_hash = None
+        if content_store is not None:
+            linked, source_hash = copy_deduplicated(sorce_file, destination_file, os.path.basename(destination_file))
+            if linked:
+                return
+        with cycle_stats.timed("copy"):
+            copy_file(sorce_file, destination_file, RESUMABLE_THRESHOLD)
+        destination_stat = os.stat(destination_file)
+        if content_store is not None:
+            content_store.record(destination_file, destination_stat, digest_backend.algorithm, source_hash)
+        count_event("files_copied_in_directories", destination_stat.st_size)
+
+    def make_directory_operation(sorce_file, destination_file, file_name, tree_root=False, in_tree=False):
+        THROTTLE.metadata()
+        os.makedirs(destination_file, exist_ok=True)
+        if tree_root:
+            if count_event("directories_copied"):
+                logger.info(f"Directory copied: {file_name} to --> {destination_file}.")
+        elif not in_tree:
+            logger.info(f"Created directory in --> {destination_file}.")
+
+    def move_operation(old_destination, destination_file, old_key, new_key):
+        THROTTLE.metadata()
+        with cycle_stats.timed("move"):
+            # Moves run before directories are created, target may be inside a directory copied in this plan
+            os.makedirs(os.path.dirname(destination_file), exist_ok=True)
+            os.rename(old_destination, destination_file)
+        if count_event("entries_moved"):
+            logger.info(f"Moved: {old_destination} to --> {destination_file}.")
+        if state_index is not None and old_key is not None and new_key is not None:
+            state_index.move(old_key, new_key)
+
+    # Plan copy of directory which exists only in source, its subdirectories are planned one by one from traversal stack
+    # With state index operations of every copied directory use its own key and its listing is recorded
+    # after execution, so the next cycle does not compare the copied tree again
+    def plan_directory_copy(sorce_file, destination_file, file_name, key):
+        key = relative_key(sorce_file) if state_index is not None else key
+        plan.add("mkdir", sorce_file, destination_file, file_name, key=key, tree_root=True)
+        return (plan_copied_directory, (sorce_file, destination_file, key))
+
+    def plan_copied_directory(root, target, key):
+        THROTTLE.metadata()
+        if state_index is not None and key is not None:
+            # Directory mtime is taken before listing, so changes made meanwhile are seen next cycle
+            source_mtime_ns = os.stat(root).st_mtime_ns
+        with os.scandir(root) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        excluded = set(excluded_names(root, [entry.name for entry in entries]))
+        sub_dirs = []
+        recorded_entries = []
+        for entry in entries:
+            if entry.name in excluded:
+                continue
+            if state_index is not None and key is not None:
+                try:
+                    entry_stat = entry.stat()
+                    if stat.S_ISDIR(entry_stat.st_mode) or stat.S_ISREG(entry_stat.st_mode):
+                        recorded_entries.append((entry.name, stat.S_ISDIR(entry_stat.st_mode), entry_stat))
+                except OSError:
+                    pass
+            target_path = os.path.join(target, entry.name)
+            moved = DETECT_MOVES and state_index is not None and move_into_copied_tree(entry, target_path, key)
+            if moved:
+                if moved is not True:
+                    sub_dirs.append(moved)
+                continue
+            if entry.is_dir():
+                sub_key = SyncStateIndex.join(key, entry.name) if state_index is not None and key is not None else key
+                plan.add("mkdir", entry.path, target_path, entry.name, key=sub_key, in_tree=True)
+                sub_dirs.append((plan_copied_directory, (entry.path, target_path, sub_key)))
+            elif entry.is_file():
+                entry_stat = entry.stat()
+                plan.add("copy", entry.path, target_path, entry.name, key=key,
+                         size=entry_stat.st_size, inode=entry_stat.st_ino, in_tree=True)
+        # All entries of the directory are created by this plan, later ones do not change its metadata
+        copied_directories.append((root, target))
+        if state_index is not None and key is not None:
+            pending_records.append((target, key, source_mtime_ns, recorded_entries, directory_digests.setdefault(key, {})))
+        return sub_dirs
+
+
+    # Find destination entry left behind by a rename in source by inode history of state index
+    def find_moved_by_inode(source_stat):
+        """Return (old destination path, old index key) or None when nothing was moved."""
+        is_dir = stat.S_ISDIR(source_stat.st_mode)
+        for old_rel_path, old_is_dir, _, _ in state_index.entries_by_inode(source_stat.st_ino):
+            old_parts = old_rel_path.split("/")
+            # Old source path has to be gone, otherwise its destination counterpart is not stale
+            if bool(old_is_dir) != is_dir or os.path.lexists(os.path.join(SOURCE_DIR_PATH, *old_parts)):
+                continue
+            old_destination = os.path.join(DESTINATION_DIR_PATH, *old_parts)
+            if old_destination not in planned_moves and os.path.isdir(old_destination) == is_dir and \
+                    os.path.lexists(old_destination):
+                return old_destination, old_rel_path
+        return None
+
+    # Find destination entry left behind by a rename in source: by inode history, or by size and hash
+    def find_moved_entry(comparison, file_name, destination_dir, rel_path):
+        """Return (old destination path, old index key or None) or None when nothing was moved."""
+        try:
+            source_stat = comparison.left_listing.stat(file_name)
+        except OSError:
+            return None
+        is_dir = stat.S_ISDIR(source_stat.st_mode)
+        if rel_path is not None:
+            moved = find_moved_by_inode(source_stat)
+            if moved is not None:
+                return moved
+        if is_dir or source_stat.st_size < MOVE_MIN_SIZE:
+            return None
+        source_hash = None
+        for right_name in comparison.right_only:
+            candidate = os.path.join(destination_dir, right_name)
+            if candidate not in pending_deletions or comparison.right_listing.is_dir(right_name, follow_symlinks=False) or \
+                    comparison.right_listing.stat(right_name).st_size != source_stat.st_size:
+                continue
+            source_hash = source_hash or digest_backend.digest(os.path.join(comparison.left, file_name))
+            if digest_backend.digest(os.path.join(comparison.right, right_name)) == source_hash:
+                return candidate, None
+        return None
+
+    # Plan rename of stale destination entry to the new name instead of deleting and copying it again,
+    # return False when nothing was moved or traversal stack item comparing content of moved directory
+    def move_entry(comparison, file_name, source_dir, destination_dir, rel_path):
+        with cycle_stats.timed("move"):
+            moved = find_moved_entry(comparison, file_name, destination_dir, rel_path)
+        if moved is None:
+            return False
+        return plan_move(moved, os.path.join(source_dir, file_name), comparison.left_listing.stat(file_name),
+                         os.path.join(destination_dir, file_name), rel_path,
+                         SyncStateIndex.join(rel_path, file_name) if rel_path is not None else None)
+
+    # Entry of directory which exists only in source (copied tree) may have been moved there from elsewhere,
+    # only inode history can tell, there is no destination listing to compare with
+    def move_into_copied_tree(entry, target_path, key):
+        try:
+            source_stat = entry.stat()
+        except OSError:
+            return False
+        with cycle_stats.timed("move"):
+            moved = find_moved_by_inode(source_stat)
+        if moved is None:
+            return False
+        return plan_move(moved, entry.path, source_stat, target_path, key, relative_key(entry.path))
+
+    def plan_move(moved, source_path, source_stat, destination_file, key, new_key):
+        old_destination, old_rel_path = moved
+        name = os.path.basename(source_path)
+        pending_deletions.pop(old_destination, None)
+        planned_moves.add(old_destination)
+        plan.add("move", old_destination, destination_file, name, key=key, old_key=old_rel_path, new_key=new_key)
+        # Content of moved entry may have changed as well, it is compared at its old place
+        if stat.S_ISDIR(source_stat.st_mode):
+            return (plan_directory, (source_path, destination_file, True, old_destination, plan.generation))
+        if old_rel_path is not None:
+            plan.add("update", source_path, destination_file, name, key=key,
+                     size=source_stat.st_size, inode=source_stat.st_ino)
+        return True
+
+
+    # Sync directory whose listing did not change since last cycle using recorded index entries
+    def sync_unchanged_directory(source_dir, destination_dir, listed_dir, rel_path, recursive):
+        """Return None when disk disagrees with the index and full comparison is needed, otherwise subdirectories."""
+        sub_dirs = []
+        changed = []
+        with cycle_stats.timed("scan"):
+            recorded_children = state_index.children(rel_path)
+            for name, is_dir, size, mtime_ns, ino, digest in recorded_children:
+                try:
+                    source_stat = os.stat(os.path.join(source_dir, name))
+                except FileNotFoundError:
+                    return None
+                if bool(is_dir) != stat.S_ISDIR(source_stat.st_mode):
+                    return None
+                if is_dir:
+                    sub_dirs.append(name)
+                elif stat_signature(source_stat) != (size, mtime_ns, ino):
+                    changed.append((name, source_stat, digest))
+        cycle_stats.observe("entries_stated", len(recorded_children))
+
+        for name, source_stat, digest in changed:
+            plan.add("refresh", os.path.join(source_dir, name), os.path.join(destination_dir, name), name, key=rel_path,
+                     size=source_stat.st_size, inode=source_stat.st_ino, entry_key=SyncStateIndex.join(rel_path, name),
+                     digest=digest)
+        return [(plan_directory, (os.path.join(source_dir, sub_dir), os.path.join(destination_dir, sub_dir), True,
+                                  os.path.join(listed_dir, sub_dir), plan.generation))
+                for sub_dir in (sub_dirs if recursive else ())]
+
+
+    # Source entries recorded in index for a planned directory: (name, is_dir, stat_result).
+    # Taken when the directory is planned, so its comparison is not kept until the plan is executed
+    def index_entries(comparison):
+        entries = []
+        for position, name in enumerate(comparison.left_list):
+            try:
+                source_stat = comparison.left_listing.stat_at(position)
+            except OSError:
+                continue
+            if stat.S_ISDIR(source_stat.st_mode) or stat.S_ISREG(source_stat.st_mode):
+                entries.append((name, stat.S_ISDIR(source_stat.st_mode), source_stat))
+        return entries
+
+    # Record listing of synced directory into state index, after its plan was executed
+    def record_directory(destination_dir, rel_path, source_mtime_ns, entries, digests):
+        state_index.record_directory(rel_path, source_mtime_ns, os.stat(destination_dir).st_mtime_ns,
+                                     entries, digests)
+
+
+    # Directory planning function, with recursive=False only entries of directory itself are synced.
+    # Destination is listed at listed_dir, which differs from destination_dir only inside a planned move
+    # until that move is executed (plan generation changed). Returns traversal stack items of subdirectories
+    def plan_directory(source_dir, destination_dir, recursive=True, listed_dir=None, generation=None):
+
+        listed_dir = listed_directory(destination_dir, listed_dir, generation)
+        tree_key = relative_key(source_dir)
+        with cycle_stats.timed("scan"):
+            source_stat, listed_stat, comparison = directory_scan(source_dir, listed_dir, tree_key)
+        if source_stat is None:
+            if pool is not None:
+                # Daemon job fails only its own cycle, other jobs keep running
+                raise FileNotFoundError(errno.ENOENT, "Source directory does not exist", source_dir)
             logger.error(f"Source directory: {source_dir} does not exist. Enter a valid path and run the script again.")
             os.kill(os.getpid(), signal.SIGINT)
-        if not os.path.exists(destination_dir):
+        # Created destination is recorded in index as well, once its plan was executed
+        rel_path = tree_key if state_index is not None else None
+        if listed_stat is None:
             logger.warning(f"Destination directory: {destination_dir} does not exit.")
-            os.makedirs(destination_dir)
-            logger.info(f"Created directory in --> {destination_dir}.")
+            plan.add("mkdir", source_dir, destination_dir, os.path.basename(destination_dir), key=rel_path)
+            listed_dir = None
+
+        if rel_path is not None:
+            # Directory mtime is taken before listing, so changes made meanwhile are seen next cycle
+            source_mtime_ns = source_stat.st_mtime_ns
+            if comparison is None:
+                sub_dirs = sync_unchanged_directory(source_dir, destination_dir, listed_dir, rel_path, recursive)
+                if sub_dirs is not None:
+                    return sub_dirs
 
 
-        """ Create objects for storing and comparing source and destination folder.
+        """ Create object for storing and comparing source and destination folder.
             Also optional for excluding all HIDDEN files and folders from comparison object."""
 
-        comparison = None
+        if comparison is None:
+            with cycle_stats.timed("scan"):
+                comparison = DirComparisonScan(source_dir, listed_dir, rules=rules, rel_path=tree_key or "",
+                                               reserved=reserved_names(listed_dir))
+        cycle_stats.observe("directories_listed", 2 if listed_dir is not None else 1)
+        cycle_stats.observe("entries_stated", len(comparison.left_listing) + len(comparison.right_listing))
+        sub_dirs = []
 
-        if OPTIONAL_FILTERING_IS_ON:
-            comparison = DirComparisonNoHidden(source_dir, destination_dir)
-        else:
-            comparison = DirComparisonWithHidden(source_dir, destination_dir)
+        # Entries already planned to be moved away show up as right_only of their old directory
+        right_only = [name for name in comparison.right_only if os.path.join(listed_dir, name) not in planned_moves]
+        if DETECT_MOVES:
+            for file_name in right_only:
+                pending_deletions[os.path.join(destination_dir, file_name)] = (
+                    file_name, comparison.right_listing.is_dir(file_name, follow_symlinks=False), rel_path)
 
         # Sync files that are presented only in source folder
         for file_name in comparison.left_only:
             sorce_file = os.path.join(source_dir, file_name)
             destination_file = os.path.join(destination_dir, file_name)
-            if os.path.isdir(sorce_file):
-                shutil.copytree(sorce_file, destination_file)
-                logger.info(f"Directory copied: {file_name} to --> {destination_file}.")
-            else:
-                shutil.copy2(sorce_file, destination_file)
-                logger.info(f"File copied: {file_name} to --> {destination_file}.")
+            moved = DETECT_MOVES and move_entry(comparison, file_name, source_dir, destination_dir, rel_path)
+            if moved:
+                if moved is not True:
+                    sub_dirs.append(moved)
+                continue
+            if comparison.left_listing.is_dir(file_name):
+                sub_dirs.append(plan_directory_copy(sorce_file, destination_file, file_name, rel_path))
+            elif comparison.left_listing.is_file(file_name):
+                left_stat = comparison.left_listing.stat(file_name)
+                plan.add("copy", sorce_file, destination_file, file_name, key=rel_path,
+                         size=left_stat.st_size, inode=left_stat.st_ino)
 
 
         # Sync files that are presented in both directories but differ, based on file Meta Data 
         for file_name in comparison.diff_files:
-            sorce_file = os.path.join(source_dir, file_name)
-            destination_file = os.path.join(destination_dir, file_name)
+            left_stat = comparison.left_listing.stat(file_name)
+            # Hard link made by deduplication has mtime of the file it links to, it is not compared while unchanged
+            if content_store is not None and DEDUP == "hardlink" and content_store.linked(
+                    os.path.join(destination_dir, file_name), left_stat, comparison.right_listing.stat(file_name)):
+                continue
+            plan.add("update", os.path.join(source_dir, file_name), os.path.join(destination_dir, file_name), file_name,
+                     key=rel_path, size=left_stat.st_size, inode=left_stat.st_ino)
 
-            """ For large datasets also enshure data integrity by comparing hashes of the files.
-                Hash comparison is efficient for detecting changes in large files,
-                as it can detect changes even when file metadata (such as modification time or size) might not reflect a difference."""
 
-            source_hash = md5_digest(sorce_file)
-            destination_hash = md5_digest(destination_file)
-            if source_hash != destination_hash:
-                shutil.copy2(sorce_file, destination_file)
-                logger.info(f"File copied: {file_name} to --> {destination_file}.")
+        # All subdirectories in source and destination folders are planned next from traversal stack
+        for sub_dir in comparison.common_dirs if recursive else ():
+            sub_dirs.append((plan_directory, (os.path.join(source_dir, sub_dir), os.path.join(destination_dir, sub_dir),
+                                              True, os.path.join(listed_dir, sub_dir), plan.generation)))
 
 
-        # Recursive sync all subdirectories in source and destination folders
-        for sub_dir in comparison.common_dirs:
-            one_way_synchronization(os.path.join(source_dir, sub_dir), os.path.join(destination_dir, sub_dir))
+        # Unfinished copies are kept for resuming, unless their file is gone from source or already synced
+        for file_name in comparison.partial_files:
+            target_name = partial_target_name(file_name)
+            if comparison.category(target_name) in (None, DirComparisonScan.SAME_FILE):
+                plan.add("remove", None, os.path.join(destination_dir, file_name), file_name, key=rel_path, is_dir=False)
 
+        # Delete files and folders that are in destination folder only (at the end of cycle with move detection)
+        for file_name in right_only if not DETECT_MOVES else ():
+            plan.add("remove", None, os.path.join(destination_dir, file_name), file_name, key=rel_path,
+                     is_dir=comparison.right_listing.is_dir(file_name, follow_symlinks=False))
 
-        # Delete files and folders that are in destination folder only
-        for file_name in comparison.right_only:
-            destination_file = os.path.join(destination_dir, file_name)
-            if os.path.isdir(destination_file):
-                os.chmod(destination_file, stat.S_IWRITE)
-                shutil.rmtree(destination_file)
-                logger.warning(f"Directory removed: {file_name} from <-- {destination_file}.")
+        if rel_path is not None:
+            pending_records.append((destination_dir, rel_path, source_mtime_ns, index_entries(comparison),
+                                    directory_digests.setdefault(rel_path, {})))
+        return sub_dirs
+
+
+    # Scan of directory planned next, prefetched by scan threads when enabled.
+    # Recorded index state is looked up here, SQLite connection belongs to this thread
+    def directory_scan_arguments(source_dir, listed_dir, tree_key):
+        recorded = state_index.directory_state(tree_key) if state_index is not None and tree_key is not None else None
+        return source_dir, listed_dir, rules, tree_key or "", recorded, scanner is not None, reserved_names(listed_dir)
+
+    # Trash is left out of the listing of destination root and of its source directory
+    def reserved_names(listed_dir):
+        if reaper is not None and listed_dir is not None and \
+                os.path.normpath(os.path.abspath(listed_dir)) == os.path.dirname(reaper.trash_dir):
+            return (TRASH_NAME,)
+        return ()
+
+    def directory_scan(source_dir, listed_dir, tree_key):
+        if scanner is not None and (source_dir, listed_dir) in scanner.pending:
+            return scanner.take((source_dir, listed_dir))
+        return scan_directory(*directory_scan_arguments(source_dir, listed_dir, tree_key))
+
+    # Destination is listed at listed_dir only while the plan with the move into it was not executed yet
+    def listed_directory(destination_dir, listed_dir=None, generation=None):
+        return destination_dir if listed_dir is None or generation != plan.generation else listed_dir
+
+    # Queue scans of directories near the top of traversal stack, the next one to be planned first
+    def prefetch_scans(stack):
+        for function, arguments in reversed(stack[-scanner.limit:]):
+            if function is not plan_directory:
+                continue
+            source_dir, listed_dir = arguments[0], listed_directory(arguments[1], *arguments[3:])
+            if (source_dir, listed_dir) not in scanner.pending:
+                scanner.submit((source_dir, listed_dir), scan_directory,
+                               *directory_scan_arguments(source_dir, listed_dir, relative_key(source_dir)))
+
+    # Iterative depth-first traversal over (source, destination, recursive) targets with explicit stack,
+    # yields after every planned directory, so memory depends on depth and width of tree, not its size
+    def plan_directories(targets):
+        stack = [(plan_directory, (source_dir, destination_dir, recursive)) for source_dir, destination_dir, recursive in reversed(targets)]
+        while stack:
+            if scanner is not None:
+                prefetch_scans(stack)
+            function, arguments = stack.pop()
+            stack.extend(reversed(function(*arguments)))
+            yield
+
+    # Complete plan of cycle without changing destination, used for dry run
+    def build_plan(targets):
+        plan.clear()
+        for _ in plan_directories(targets):
+            pass
+        plan_deferred_deletions()
+        copied_directories.clear()
+        return plan
+
+    # Plan removal of deferred deletions, the oldest first, until at most keep of them wait
+    def plan_deferred_deletions(keep=0):
+        while len(pending_deletions) > keep:
+            destination_file = next(iter(pending_deletions))
+            file_name, is_dir, key = pending_deletions.pop(destination_file)
+            plan.add("remove", None, destination_file, file_name, key=key, is_dir=is_dir)
+
+    def run_operation(operation):
+        kind, sorce_file, destination_file, file_name = (operation.kind, operation.source,
+                                                         operation.destination, operation.name)
+        if kind == "copy" and operation.get("in_tree"):
+            copy_tree_file_operation(sorce_file, destination_file)
+        elif kind == "copy":
+            copy_file_operation(sorce_file, destination_file, file_name)
+        elif kind == "update":
+            update_file_operation(sorce_file, destination_file, file_name, directory_digests.setdefault(operation.key, {}))
+        elif kind == "refresh":
+            refresh_file_operation(sorce_file, destination_file, file_name, operation.get("entry_key"), operation.get("digest"))
+        elif kind == "remove":
+            remove_operation(destination_file, file_name, operation.get("is_dir"))
+        elif kind == "mkdir":
+            make_directory_operation(sorce_file, destination_file, file_name,
+                                     operation.get("tree_root", False), operation.get("in_tree", False))
+        elif kind == "move":
+            move_operation(sorce_file, destination_file, operation.get("old_key"), operation.get("new_key"))
+
+    def run_batch(operations):
+        for operation in operations:
+            executor.run(run_operation, (operation,), operation.key)
+
+    # Execute plan phase by phase, moves and directories in order on this thread, deletes and files on workers
+    def execute_plan(plan):
+        for phase, operations in plan.phases():
+            if phase in ("move", "mkdir"):
+                run_batch(operations)
+                continue
+            for batch in plan.batches(operations) if phase == "files" else ([operation] for operation in operations):
+                executor.submit(run_batch, batch)
+            with cycle_stats.timed("wait"):
+                executor.drain()
+
+    # Execute planned part of cycle and record its directories, so their comparisons can be released
+    def flush_plan():
+        if scanner is not None:
+            scanner.reset()
+        execute_plan(plan)
+        plan.clear()
+        # Directory metadata is copied after contents, children before parents as shutil.copytree does
+        for root, target in reversed(copied_directories):
+            try:
+                shutil.copystat(root, target)
+            except FileNotFoundError:
+                # Creation of the directory failed, the failure is already logged
+                pass
+        copied_directories.clear()
+        if state_index is not None:
+            with cycle_stats.timed("index"):
+                for entry_key, source_stat, source_hash in index_updates:
+                    state_index.update_entry(entry_key, source_stat, source_hash)
+                for record in pending_records:
+                    if record[1] in executor.failed_keys:
+                        state_index.invalidate_directory(record[1])
+                    else:
+                        record_directory(*record)
+                    directory_digests.pop(record[1], None)
+        index_updates.clear()
+        pending_records.clear()
+
+    def clear_cycle_state():
+        if scanner is not None:
+            scanner.reset()
+        plan.clear()
+        planned_moves.clear()
+        pending_records.clear()
+        pending_deletions.clear()
+        directory_digests.clear()
+        index_updates.clear()
+        copied_directories.clear()
+        executor.failed_keys.clear()
+
+    # One synchronization cycle over (source, destination, recursive) targets,
+    # state index is committed only when whole cycle succeeded
+    def run_cycle(targets):
+        if LIMITS_FILE:
+            reload_limits()
+        cycle_stats.reset()
+        hashed_before, failures_before = digest_backend.bytes_hashed, executor.failures
+        try:
+            plan.clear()
+            # At most MAX_INFLIGHT_DIRS directories are planned before the plan is executed
+            for planned_dirs, _ in enumerate(plan_directories(targets), 1):
+                if stop_requested.is_set():
+                    # Safe point: what was planned is executed and recorded, the rest waits for next start
+                    logger.warning("Stop requested, cycle ends after operations planned so far.")
+                    break
+                if planned_dirs % MAX_INFLIGHT_DIRS == 0:
+                    plan_deferred_deletions(keep=MAX_PENDING_DELETIONS)
+                    flush_plan()
             else:
-                os.chmod(destination_file, stat.S_IWRITE)
-                os.remove(destination_file)
-                logger.warning(f"File removed: {file_name} from <-- {destination_file}.")
-                        
+                plan_deferred_deletions()
+            flush_plan()
+        except BaseException:
+            if state_index is not None:
+                state_index.rollback()
+            raise
+        finally:
+            clear_cycle_state()
+        if state_index is not None:
+            with cycle_stats.timed("index"):
+                state_index.commit()
+        if hash_cache is not None:
+            hash_cache.save()
+            logger.debug(f"Hash cache: {hash_cache.hits} hits, {hash_cache.misses} misses, {len(hash_cache.entries)} entries.")
+        if content_store is not None:
+            content_store.commit()
+            record_deduplication()
+        cycle_stats.durations["cycle"] = time.monotonic() - cycle_stats.started
+        cycle_stats.observe("bytes_hashed", digest_backend.bytes_hashed - hashed_before)
+        record_dropped_log_records()
+        metrics.record_cycle(cycle_stats, failed_operations=executor.failures - failures_before)
+        if STATUS_FILE:
+            metrics.write_status(STATUS_FILE)
+        if LOG_SUMMARY and cycle_stats.counts:
+            logger.info(f"Cycle summary: {cycle_stats.summary()}.")
+        # Log records of the cycle are written out before the next one starts
+        for handler in logger.handlers:
+            handler.flush()
+
+    # Records dropped by full log queue since last report, logged once the queue is written out so the warning has room
+    def record_dropped_log_records():
+        nonlocal log_records_dropped
+        for handler in logger.handlers:
+            handler.flush()
+        dropped = sum(handler.dropped for handler in logger.handlers if isinstance(handler, BoundedQueueHandler))
+        if dropped > log_records_dropped:
+            cycle_stats.observe("log_records_dropped", dropped - log_records_dropped)
+            logger.warning(f"Log queue was full, {dropped - log_records_dropped} log records were dropped (see --log_queue_size).")
+            log_records_dropped = dropped
+
+    # Bytes saved by deduplication in this cycle and copy time they would take at measured copy throughput
+    def record_deduplication():
+        nonlocal copy_throughput
+        copied_bytes = cycle_stats.bytes["files_copied"] + cycle_stats.bytes["files_copied_in_directories"]
+        if copied_bytes and cycle_stats.durations["copy"]:
+            copy_throughput = copied_bytes / cycle_stats.durations["copy"]
+        saved = cycle_stats.observed["dedup_bytes_saved"]
+        if saved:
+            seconds = saved / copy_throughput if copy_throughput else 0.0
+            cycle_stats.observe("dedup_seconds_avoided", seconds)
+            logger.info(f"Deduplication saved {saved} bytes, about {seconds:.2f} s of copying.")
+
+    # Dry run: plan of a full cycle, nothing in destination or state index is changed
+    def plan_synchronization(source_dir, destination_dir):
+        try:
+            return build_plan([(source_dir, destination_dir, True)]).take()
+        finally:
+            clear_cycle_state()
+
+    # Cycle under profiler only when profiling was requested for it
+    def start_cycle(targets):
+        if profiler.remaining:
+            with profiler.cycle():
+                run_cycle(targets)
+        else:
+            run_cycle(targets)
+
+    def one_way_synchronization(source_dir, destination_dir):
+        start_cycle([(source_dir, destination_dir, True)])
+
+    # Sync only entries of changed source directories (used by watch mode), parents before children
+    def partial_synchronization(source_dirs):
+        targets = []
+        for source_dir in sorted(source_dirs, key=lambda path: (path.count(os.sep), path)):
+            rel_path = os.path.relpath(source_dir, SOURCE_DIR_PATH)
+            if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep) or not os.path.isdir(source_dir):
+                continue
+            if rules.excluded_directory(relative_key(source_dir)):
+                continue
+            targets.append((source_dir, os.path.normpath(os.path.join(DESTINATION_DIR_PATH, rel_path)), False))
+        start_cycle(targets)
+
+    one_way_synchronization.partial_synchronization = partial_synchronization
+    # Release workers, files and threads at exit
+    def shutdown():
+        executor.shutdown()
+        if scanner is not None:
+            scanner.shutdown()
+        if reaper is not None:
+            reaper.shutdown()
+        if content_store is not None:
+            content_store.close()
+        digest_backend.shutdown()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if state_index is not None:
+            state_index.close()
+        for handler in logger.handlers:
+            handler.flush()
+
+    one_way_synchronization.plan = plan_synchronization
+    one_way_synchronization.stop_requested = stop_requested
+    one_way_synchronization.shutdown = shutdown
+    one_way_synchronization.reload_limits = reload_limits
+    one_way_synchronization.profiler = profiler
+    one_way_synchronization.cycle_stats = cycle_stats
+    one_way_synchronization.metrics = metrics
+    one_way_synchronization.metrics_server = metrics_server
     command_line_arguments_wrapper.one_way_synchronization_ = one_way_synchronization
     
     return one_way_synchronization
 
 
+# ------------------------------------------------------------------------------------
+# ------------------------------------------------------------------------------------
+# Periodic cycles of one source and destination pair until the scheduler is stopped
+def run_scheduled(one_way_synchronization, source_dir, destination_dir, scheduler, logger, status_file=None):
+    """
+    Interval between cycle starts adapts to changes and duration of the last cycle.
+    Failed cycle is logged and the next one runs as scheduled, so one broken pair does not stop the daemon.
+    """
+    one_way_synchronization.metrics.set_schedule(scheduler.interval, scheduler.next_run_timestamp())
+    while scheduler.wait():
+        started = time.monotonic()
+        try:
+            one_way_synchronization(source_dir, destination_dir)
+            changes = sum(one_way_synchronization.cycle_stats.counts.values())
+        except Exception as e:
+            logger.error(f"Synchronization cycle failed: {e}")
+            changes = 0
+        scheduler.update(started, time.monotonic() - started, changes)
+        one_way_synchronization.metrics.set_schedule(scheduler.interval, scheduler.next_run_timestamp())
+        if status_file:
+            one_way_synchronization.metrics.write_status(status_file)
+        logger.debug(f"Next cycle in {scheduler.interval:.2f} s.")
+
+# ------------------------------------------------------------------------------------
+# Config file of daemon running many sync jobs in one process
+DAEMON_OPTIONS = ("log_path", "workers", "queue_depth", "hash_nice", "idle_io",
+                  "read_limit", "write_limit", "metadata_limit", "limits_file")
+# Command line options a job may set for itself, besides name, source, destination and period
+JOB_OPTIONS = ("log_path", "min_period", "max_period", "filter_hidden_dirs_files", "exclude_from", "log_summary",
+               "log_max_bytes", "log_backups", "log_queue_size", "state_index", "state_index_path", "rebuild_index",
+               "verify_index", "compare", "delta_threshold", "delta_block_size", "resumable_threshold", "dedup",
+               "dedup_min_size", "dedup_table_path", "detect_moves", "move_min_size", "hash", "hash_method",
+               "hash_processes", "hash_parallel_threshold", "hash_cache", "hash_cache_path", "hash_cache_size",
+               "fast_delete", "trash_rate", "scan_workers", "queue_depth", "idle_io", "metrics_port", "metrics_host",
+               "status_file", "profile", "profile_mode", "profile_interval", "profile_dir", "max_inflight_dirs")
+JOB_NAME = re.compile(r"[A-Za-z0-9_.-]+")
+
+def load_daemon_config(path):
+    """
+    JSON object with daemon options (DAEMON_OPTIONS) and list "jobs". Every job has unique "name",
+    "source", "destination" and "period" in seconds, any other key is the command line option
+    of the job with the same name (JOB_OPTIONS), unknown keys and shared daemon options are rejected.
+    Log of a job defaults to '<name>.log' next to config file.
+    Return daemon options and list of (name, arguments) of jobs.
+    """
+    with open(path) as config_file:
+        config = json.load(config_file)
+    jobs = config.pop("jobs", [])
+    unknown = sorted(set(config) - set(DAEMON_OPTIONS))
+    if unknown:
+        raise ValueError(f"Unknown daemon options: {', '.join(unknown)}")
+    if not jobs:
+        raise ValueError("Config file defines no jobs")
+    config_dir = os.path.dirname(os.path.abspath(path))
+    job_arguments = []
+    for job in jobs:
+        job = dict(job)
+        name = job.pop("name", None)
+        if not isinstance(name, str) or not JOB_NAME.fullmatch(name):
+            raise ValueError(f"Invalid job name: {name!r}")
+        if name in (job_name for job_name, _ in job_arguments):
+            raise ValueError(f"Duplicate job name: {name}")
+        try:
+            arguments = argparse.Namespace(source_dir_path=job.pop("source"), destination_dir_path=job.pop("destination"),
+                                           sync_period=job.pop("period"))
+        except KeyError as e:
+            raise ValueError(f"Job {name} has no {e.args[0]}") from None
+        shared = sorted(set(job) & (set(DAEMON_OPTIONS) - set(JOB_OPTIONS)))
+        if shared:
+            raise ValueError(f"Job {name} sets daemon options, they belong to top level: {', '.join(shared)}")
+        unknown = sorted(set(job) - set(JOB_OPTIONS))
+        if unknown:
+            raise ValueError(f"Unknown options of job {name}: {', '.join(unknown)}")
+        arguments.log_path = job.pop("log_path", os.path.join(config_dir, f"{name}.log"))
+        arguments.filter_hidden_dirs_files = job.pop("filter_hidden_dirs_files", False)
+        vars(arguments).update(job)
+        job_arguments.append((name, arguments))
+    return config, job_arguments
+
+def run_daemon(config_path):
+    """
+    Every job runs its own scheduler in its own thread, so periods of jobs are independent,
+    while copy, hash and delete operations of all jobs share one worker pool and one I/O budget (THROTTLE).
+    Each job keeps its own plan, state index, hash cache, metrics and log. SIGTERM stops all jobs at a safe point.
+    """
+    options, jobs = load_daemon_config(config_path)
+    logger = setup_logger(options.get("log_path") or os.path.splitext(config_path)[0] + ".log")
+    workers = max(1, options.get("workers", 4) or 4)
+    hash_nice = options.get("hash_nice", 0) or 0
+    if options.get("idle_io", False):
+        try:
+            set_idle_io_priority()
+        except OSError as e:
+            logger.warning(f"Idle I/O priority is not available: {e}.")
+    pool = ThreadPoolExecutor(workers, thread_name_prefix="sync_worker", initializer=lower_thread_priority,
+                              initargs=(hash_nice,))
+    stopping = threading.Event()
+    synchronizations = []
+    threads = []
+    try:
+        for name, arguments in jobs:
+            # Shared limits are applied by every job, the same values each time
+            for option in ("read_limit", "write_limit", "metadata_limit", "limits_file", "hash_nice"):
+                setattr(arguments, option, options.get(option))
+            arguments.workers = workers
+            if getattr(arguments, "queue_depth", None) is None:
+                arguments.queue_depth = options.get("queue_depth") or workers
+            one_way_synchronization = command_line_arguments_wrapper(arguments, pool=pool, logger_name=f"sync_logger.{name}")
+            synchronizations.append(one_way_synchronization)
+            scheduler = AdaptiveScheduler(getattr(arguments, "min_period", None) or arguments.sync_period,
+                                          getattr(arguments, "max_period", None),
+                                          stopping=one_way_synchronization.stop_requested)
+            threads.append(threading.Thread(target=run_scheduled, name=f"sync_job_{name}",
+                                            args=(one_way_synchronization, arguments.source_dir_path,
+                                                  arguments.destination_dir_path, scheduler,
+                                                  logging.getLogger(f"sync_logger.{name}"),
+                                                  getattr(arguments, "status_file", None))))
+            logger.info(f"Job {name}: {arguments.source_dir_path} -> {arguments.destination_dir_path} "
+                        f"every {arguments.sync_period} s.")
+
+        def stop():
+            stopping.set()
+            for one_way_synchronization in synchronizations:
+                one_way_synchronization.stop_requested.set()
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop())
+        if options.get("limits_file") and hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda signum, frame: synchronizations[0].reload_limits(force=True))
+        # SIGUSR1 profiles next cycles of every job
+        def request_profiles(signum, frame):
+            for one_way_synchronization in synchronizations:
+                one_way_synchronization.profiler.request()
+
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, request_profiles)
+        for thread in threads:
+            thread.start()
+        # Main thread only waits, signals are delivered to it
+        while not stopping.wait(1.0) and any(thread.is_alive() for thread in threads):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for one_way_synchronization in synchronizations:
+            one_way_synchronization.stop_requested.set()
+        for thread in threads:
+            if thread.is_alive():
+                thread.join()
+        for one_way_synchronization in synchronizations:
+            one_way_synchronization.shutdown()
+        pool.shutdown(wait=True)
+        logger.info("Synchronization stopped.")
+        for handler in logger.handlers:
+            handler.flush()
+
     
 # ------------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------------
@@ -215,21 +3281,138 @@ def command_line_arguments_wrapper(args):
 if __name__ == '__main__':
     
     parser = argparse.ArgumentParser(prog="One_Way_Folder_Sync", description="......")
-    parser.add_argument("source_dir_path", help="Enter a valid path to your source directory.", type=str)
-    parser.add_argument("destination_dir_path", help="Enter a path where you want to store your destination folder.", type=str)
-    parser.add_argument("log_path", help="Enter a path where you want to store your log file.", type=str)
-    parser.add_argument("sync_period", help="Time for delaying and setting up a period of synchronization. Enter only int() type.", type=int)
+    parser.add_argument("source_dir_path", help="Enter a valid path to your source directory.", type=str, nargs="?")
+    parser.add_argument("destination_dir_path", help="Enter a path where you want to store your destination folder.", type=str, nargs="?")
+    parser.add_argument("log_path", help="Enter a path where you want to store your log file.", type=str, nargs="?")
+    parser.add_argument("sync_period", help="Time for delaying and setting up a period of synchronization. Enter only int() type.", type=int, nargs="?")
+    parser.add_argument("--config", help="Run as daemon with many sync jobs defined in this JSON file instead of one pair from arguments.", type=str)
+    parser.add_argument("--min_period", help="Shortest interval in seconds between cycle starts (default sync_period).", type=float)
+    parser.add_argument("--max_period", help="Longest interval in seconds between cycle starts when source is idle (default min_period).", type=float)
     parser.add_argument("--filter_hidden_dirs_files", help= "Optional argument for filtering out hidden files and directories.", action="store_true")
+    parser.add_argument("--exclude_from", help="Optional file with gitignore-style include/exclude patterns.", type=str)
+    parser.add_argument("--log_summary", help="Log one summary line with counts and bytes per cycle instead of one line per file.", action="store_true")
+    parser.add_argument("--log_max_bytes", help="Rotate log file when it reaches this size in bytes (0 disables rotation).", type=int, default=0)
+    parser.add_argument("--log_backups", help="Number of rotated log files to keep.", type=int, default=5)
+    parser.add_argument("--log_queue_size", help="Maximum number of log records waiting for the writer thread, newer ones are dropped.", type=int, default=10000)
+    parser.add_argument("--state_index", help="Keep persistent state index (SQLite file next to log) to skip unchanged directories.", action="store_true")
+    parser.add_argument("--state_index_path", help="Optional path of state index file instead of the one next to log.", type=str)
+    parser.add_argument("--rebuild_index", help="Drop state index at startup and rebuild it during next cycle.", action="store_true")
+    parser.add_argument("--compare", help="How files with different metadata are compared: full hashes or streaming with early exit.", choices=COMPARE_STRATEGIES, default="hash")
+    parser.add_argument("--delta_threshold", help="Minimal size in bytes of modified file patched with block level delta instead of full copy (0 disables).", type=int, default=0)
+    parser.add_argument("--delta_block_size", help="Block size in bytes used by delta transfer.", type=int, default=DELTA_BLOCK_SIZE)
+    parser.add_argument("--resumable_threshold", help="Minimal size in bytes of file copied through a checkpointed partial file which resumes after a crash (0 disables).", type=int, default=RESUMABLE_COPY_THRESHOLD)
+    parser.add_argument("--dedup", help="Store files whose content is already in destination as hard links or reflinks of it instead of copies.", choices=DEDUP_METHODS, default="off")
+    parser.add_argument("--dedup_min_size", help="Minimal size in bytes of file considered for deduplication.", type=int, default=64 * 1024)
+    parser.add_argument("--dedup_table_path", help="Optional path of content-address table (SQLite) instead of the one next to log.", type=str)
+    parser.add_argument("--detect_moves", help="Rename entries moved in source inside destination instead of copying them again.", action="store_true")
+    parser.add_argument("--move_min_size", help="Minimal size in bytes of file matched by size and hash when no inode history is available.", type=int, default=1024 * 1024)
+    parser.add_argument("--hash", help="Hash algorithm used for comparing files.", choices=HASH_ALGORITHMS, default="md5")
+    parser.add_argument("--hash_method", help="How files are read for hashing: hashlib.file_digest (auto), reused buffer or mmap.", choices=HASH_METHODS, default="auto")
+    parser.add_argument("--hash_processes", help="Number of processes hashing large files in parallel (0 hashes in place).", type=int, default=0)
+    parser.add_argument("--hash_parallel_threshold", help="Minimal file size in bytes hashed in the process pool.", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--hash_cache", help="Keep persistent cache of file digests (JSON file next to log).", action="store_true")
+    parser.add_argument("--hash_cache_path", help="Optional path of hash cache file instead of the one next to log.", type=str)
+    parser.add_argument("--hash_cache_size", help="Maximum number of cached digests, least recently used are evicted.", type=int, default=100000)
+    parser.add_argument("--workers", help="Number of threads running copy, hash-compare and delete operations.", type=int, default=1)
+    parser.add_argument("--fast_delete", help="Rename removed directories into trash next to destination and delete them in background.", action="store_true")
+    parser.add_argument("--trash_rate", help="Limit of entries per second deleted from trash by background reaper (0 is unlimited).", type=int, default=0)
+    parser.add_argument("--scan_workers", help="Number of threads listing and stating directories ahead of traversal, for network file systems (0 scans serially).", type=int, default=0)
+    parser.add_argument("--queue_depth", help="Maximum number of operations waiting for a worker (default 4 per worker).", type=int)
+    parser.add_argument("--watch", help="Sync changed directories right after inotify events instead of periodic full scans (Linux).", action="store_true")
+    parser.add_argument("--watch_debounce", help="Seconds without new events before a burst of changes is synced.", type=float, default=0.2)
+    parser.add_argument("--metrics_port", help="Serve metrics in Prometheus text format on this local port (0 disables).", type=int, default=0)
+    parser.add_argument("--metrics_host", help="Address the metrics endpoint listens on.", type=str, default="127.0.0.1")
+    parser.add_argument("--status_file", help="Optional path of JSON status file rewritten after every cycle.", type=str)
+    parser.add_argument("--read_limit", help="Limit of bytes read per second by copies, hashing and comparison (0 is unlimited).", type=int, default=0)
+    parser.add_argument("--write_limit", help="Limit of bytes written per second into destination (0 is unlimited).", type=int, default=0)
+    parser.add_argument("--metadata_limit", help="Limit of metadata operations per second: listings, creates, renames, deletes (0 is unlimited).", type=int, default=0)
+    parser.add_argument("--limits_file", help="JSON file with read_bytes_per_second, write_bytes_per_second and metadata_ops_per_second, reloaded when changed or on SIGHUP.", type=str)
+    parser.add_argument("--idle_io", help="Run with idle I/O scheduling class, disk time is used only when other processes do not need it (Linux).", action="store_true")
+    parser.add_argument("--hash_nice", help="Nice level added to CPU priority of sync worker threads and hashing processes.", type=int, default=0)
+    parser.add_argument("--profile", help="Profile this many first cycles, SIGUSR1 profiles as many next cycles at runtime (0 profiles only on SIGUSR1).", type=int, default=0)
+    parser.add_argument("--profile_mode", help="Sampled stacks of all threads or deterministic cProfile of the cycle thread.", choices=CycleProfiler.MODES, default="sample")
+    parser.add_argument("--profile_interval", help="Seconds between stack samples in sample mode.", type=float, default=0.005)
+    parser.add_argument("--profile_dir", help="Optional directory of profile files instead of the one next to log.", type=str)
+    parser.add_argument("--max_inflight_dirs", help="Number of directories planned before the plan is executed, bounds memory of large trees.", type=int, default=1000)
+    parser.add_argument("--dry_run", help="Only print plan of one full synchronization (operations, bytes, estimated time) and exit.", action="store_true")
+    parser.add_argument("--plan_file", help="With --dry_run write plan as JSON into this file instead of standard output.", type=str)
+    parser.add_argument("--plan_throughput", help="Assumed copy throughput in MiB/s used to estimate duration of dry run plan.", type=float, default=100.0)
+    parser.add_argument("--verify_index", help="Compare state index with disk at startup and rebuild it on any mismatch.", action="store_true")
     args = parser.parse_args()
+    if args.config:
+        try:
+            run_daemon(args.config)
+        except (OSError, ValueError) as e:
+            parser.error(f"config file {args.config}: {e}")
+        raise SystemExit(0)
+    if None in (args.source_dir_path, args.destination_dir_path, args.log_path, args.sync_period):
+        parser.error("source_dir_path, destination_dir_path, log_path and sync_period are required without --config")
     one_way_synchronization = command_line_arguments_wrapper(args)
-    
+    logger = logging.getLogger("sync_logger")
+
+    if args.dry_run:
+        plan = one_way_synchronization.plan(args.source_dir_path, args.destination_dir_path)
+        throughput = args.plan_throughput * 1024 * 1024
+        logger.info(f"Dry run plan: {json.dumps(plan.summary(throughput), sort_keys=True)}.")
+        if args.plan_file:
+            plan.dump(args.plan_file, throughput)
+        else:
+            print(json.dumps(plan.to_dict(throughput), indent=2))
+        for handler in logger.handlers:
+            handler.flush()
+        raise SystemExit(0)
+
+    watcher = None
+    if args.watch:
+        try:
+            if args.exclude_from:
+                watch_rules = FilterRules.from_file(args.exclude_from, hidden=args.filter_hidden_dirs_files)
+            else:
+                watch_rules = FilterRules(hidden=args.filter_hidden_dirs_files)
+            watcher = InotifyWatcher(args.source_dir_path, rules=watch_rules)
+        except OSError as e:
+            logger.error(f"Watch mode is not available: {e}. Falling back to periodic synchronization.")
+
+    scheduler = AdaptiveScheduler(args.min_period or args.sync_period, args.max_period,
+                                  stopping=one_way_synchronization.stop_requested)
+    # SIGTERM stops at a safe point: before the next directory of running cycle or while waiting for the next cycle
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+    # SIGHUP reloads throttle limits without restarting
+    if args.limits_file and hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: one_way_synchronization.reload_limits(force=True))
+    # SIGUSR1 profiles next cycles (--profile of them, at least one)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: one_way_synchronization.profiler.request())
+
     try:
-        while True:
-            # Delaying between periods of rerunning the script 
-            time.sleep(args.sync_period)
+        if watcher is not None:
+            # Initial full scan, afterwards only directories reported by inotify are synced
             one_way_synchronization(args.source_dir_path, args.destination_dir_path)
+            while not scheduler.stopping.is_set():
+                if watcher.failures:
+                    path, error = next(iter(watcher.failures.items()))
+                    logger.error(f"Watch of {len(watcher.failures)} directories failed, first {path}: {os.strerror(error)}. "
+                                 "Raise fs.inotify.max_user_watches to use watch mode. "
+                                 "Falling back to periodic synchronization.")
+                    break
+                changed = watcher.wait_for_changes(timeout=1.0, debounce=args.watch_debounce)
+                if changed is None:
+                    logger.warning("Watch event queue overflowed, running full synchronization.")
+                    watcher.rebuild()
+                    one_way_synchronization(args.source_dir_path, args.destination_dir_path)
+                elif changed:
+                    one_way_synchronization.partial_synchronization(changed)
+        run_scheduled(one_way_synchronization, args.source_dir_path, args.destination_dir_path, scheduler, logger,
+                      status_file=args.status_file)
     except KeyboardInterrupt:
         pass
+    finally:
+        if watcher is not None:
+            watcher.close()
+        one_way_synchronization.shutdown()
+        logger.info("Synchronization stopped.")
+        for handler in logger.handlers:
+            handler.flush()
     
 # ------------------------------------------------------------------------------------
 # Examples and explanation command line arguments for convinience.
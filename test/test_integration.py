@@ -1,10 +1,15 @@
 import os
+import json
+import logging
+import urllib.request
 import tempfile
 import shutil
 import pytest
 import time
+import threading
 from unittest import mock
 from pathlib import Path
+from src import main
 from src.main import command_line_arguments_wrapper 
 
 
@@ -123,7 +128,385 @@ def test_logging(args):
     assert "Directory copied" in log_content or "Directory created" in log_content
     
 
+
+def test_parallel_sync_matches_sequential(args, tmp_path):
+    # Prepare nested tree with stale and outdated entries in destination
+    for i in range(20):
+        os.makedirs(Path(args.source_dir_path) / "tree" / f"dir_{i % 4}", exist_ok=True)
+        (Path(args.source_dir_path) / "tree" / f"dir_{i % 4}" / f"file_{i}.txt").write_text(f"content {i}")
+    sequential_destination = tmp_path / "sequential"
+    shutil.copytree(args.destination_dir_path, sequential_destination)
+    (Path(args.destination_dir_path) / "stale.txt").write_text("stale")
+
+    sync_function = command_line_arguments_wrapper(args)
+    sync_function(args.source_dir_path, str(sequential_destination))
+
+    args.workers = 4
+    args.queue_depth = 2
+    parallel_function = command_line_arguments_wrapper(args)
+    parallel_function(args.source_dir_path, args.destination_dir_path)
+
+    def snapshot(root):
+        return sorted((str(path.relative_to(root)), path.read_bytes() if path.is_file() else None)
+                      for path in Path(root).rglob("*"))
+
+    assert snapshot(args.destination_dir_path) == snapshot(sequential_destination)
+
+def test_failed_operation_does_not_abort_cycle(args):
+    sync_function = command_line_arguments_wrapper(args)
+    original_copy_file = main.copy_file
+
+    def failing_copy_file(source, destination, *args):
+        if source.endswith("file1.txt"):
+            raise PermissionError("simulated failure")
+        return original_copy_file(source, destination, *args)
+
+    with mock.patch("src.main.copy_file", side_effect=failing_copy_file):
+        sync_function(args.source_dir_path, args.destination_dir_path)
+
+    # Other files are synced despite the failure, failed one is synced next cycle
+    assert os.path.exists(os.path.join(args.destination_dir_path, "file2.txt"))
+    assert not os.path.exists(os.path.join(args.destination_dir_path, "file1.txt"))
+    sync_function(args.source_dir_path, args.destination_dir_path)
+    assert os.path.exists(os.path.join(args.destination_dir_path, "file1.txt"))
+
     
+def test_copy_engine_falls_back_and_keeps_metadata(tmp_path):
+    source = tmp_path / "source.bin"
+    source.write_bytes(os.urandom(100000))
+    os.utime(source, ns=(1_000_000_000, 2_000_000_000))
+
+    method = main.copy_file(str(source), str(tmp_path / "copy.bin"))
+    assert method in ("reflink", "copy_file_range", "sendfile", "buffered")
+    assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
+    assert os.stat(tmp_path / "copy.bin").st_mtime_ns == 2_000_000_000
+
+    # Unsupported zero-copy methods end up in buffered copy
+    unsupported = OSError(main.errno.EXDEV, "cross device")
+    with mock.patch.object(main, "fcntl", None), \
+            mock.patch("src.main.os.copy_file_range", side_effect=unsupported, create=True), \
+            mock.patch("src.main.os.sendfile", side_effect=unsupported, create=True):
+        assert main.copy_file(str(source), str(tmp_path / "buffered.bin")) == "buffered"
+    assert (tmp_path / "buffered.bin").read_bytes() == source.read_bytes()
+
+def test_copy_engine_falls_back_when_nothing_is_copied(tmp_path):
+    source = tmp_path / "source.bin"
+    source.write_bytes(os.urandom(3 * 64 * 1024))
+
+    # Zero-copy method reporting end of file on its first call must not leave an empty destination
+    with mock.patch.object(main, "fcntl", None), \
+            mock.patch("src.main.os.copy_file_range", return_value=0, create=True), \
+            mock.patch("src.main.os.sendfile", return_value=0, create=True):
+        assert main.copy_file(str(source), str(tmp_path / "copy.bin")) == "buffered"
+        assert main.resumable_copy(str(source), str(tmp_path / "resumed.bin"),
+                                   checkpoint_interval=64 * 1024) == "pread/pwrite"
+    assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
+    assert (tmp_path / "resumed.bin").read_bytes() == source.read_bytes()
+
+def test_log_summary_mode(args):
+    args.log_summary = True
+    sync_function = command_line_arguments_wrapper(args)
+    sync_function(args.source_dir_path, args.destination_dir_path)
+
+    with open(args.log_path, "r") as log_file:
+        log_content = log_file.read()
+
+    # One aggregated line per cycle instead of one line per file
+    assert "File copied" not in log_content
+    assert "Cycle summary: 1 directories copied, 3 files copied, 1 files copied in directories" in log_content
+
+def test_phase_durations(args):
+    sync_function = command_line_arguments_wrapper(args)
+    sync_function(args.source_dir_path, args.destination_dir_path)
+    durations = sync_function.cycle_stats.durations
+    assert durations["copy"] > 0
+    assert durations["cycle"] >= durations["scan"]
+
+    # Durations of previous cycle are reset, unchanged tree is only scanned
+    sync_function(args.source_dir_path, args.destination_dir_path)
+    assert sync_function.cycle_stats.durations["copy"] == 0
+    assert sync_function.cycle_stats.durations["scan"] > 0
+
+def test_metrics_endpoint_and_status_file(args, tmp_path):
+    args.status_file = str(tmp_path / "status.json")
+    sync_function = command_line_arguments_wrapper(args)
+    sync_function(args.source_dir_path, args.destination_dir_path)
+    sync_function(args.source_dir_path, args.destination_dir_path)
+
+    with open(args.status_file) as status_file:
+        status = json.load(status_file)
+    assert status["totals"]["cycles"] == 2
+    assert status["totals"]["directories_listed"] > 0
+    assert status["totals"]["bytes_copied"] == sum(os.path.getsize(os.path.join(root, name))
+                                                   for root, _, names in os.walk(args.destination_dir_path) for name in names)
+
+    server = main.start_metrics_server(sync_function.metrics, port=0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            text = response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert "owfs_cycles_total 2" in text
+    assert 'owfs_cycle_duration_seconds_bucket{le="+Inf"} 2' in text
+    assert 'owfs_phase_duration_seconds_count{phase="copy"} 2' in text
+
+def test_dropped_log_records_are_reported(args, tmp_path):
+    args.status_file = str(tmp_path / "status.json")
+    sync_function = command_line_arguments_wrapper(args)
+    handler = next(handler for handler in logging.getLogger("sync_logger").handlers
+                   if isinstance(handler, main.BoundedQueueHandler))
+    # Records dropped on full queue during a cycle are reported once, at the end of that cycle
+    handler.dropped += 3
+    sync_function(args.source_dir_path, args.destination_dir_path)
+    sync_function(args.source_dir_path, args.destination_dir_path)
+
+    with open(args.status_file) as status_file:
+        assert json.load(status_file)["totals"]["log_records_dropped"] == 3
+    with open(args.log_path) as log_file:
+        assert log_file.read().count("3 log records were dropped") == 1
+
+def test_interrupted_copy_resumes_from_checkpoint(tmp_path):
+    source = tmp_path / "large.bin"
+    source.write_bytes(os.urandom(10 * 64 * 1024))
+    destination = tmp_path / "copy.bin"
+    destination.write_bytes(b"previous version")
+    original_copy_range = main.copy_range
+    copied_offsets = []
+
+    def crashing_copy_range(source_fd, destination_fd, offset, length):
+        copied_offsets.append(offset)
+        if copied_offsets == [0, 64 * 1024, 2 * 64 * 1024, 3 * 64 * 1024]:
+            raise OSError("simulated crash")
+        return original_copy_range(source_fd, destination_fd, offset, length)
+
+    with mock.patch("src.main.copy_range", side_effect=crashing_copy_range), mock.patch("src.main.fcntl", None):
+        with pytest.raises(OSError):
+            main.resumable_copy(str(source), str(destination), checkpoint_interval=64 * 1024)
+        # Destination keeps previous content, unfinished copy waits in hidden files next to it
+        assert destination.read_bytes() == b"previous version"
+        partial_path, checkpoint_path = main.partial_paths(str(destination))
+        assert os.path.exists(partial_path) and os.path.exists(checkpoint_path)
+        listing = tmp_path / "listing"
+        os.makedirs(listing)
+        for name in ("copy.bin", "large.bin"):
+            (listing / name).touch()
+        comparison = main.DirComparisonScan(str(listing), str(tmp_path))
+        assert sorted(comparison.partial_files) == sorted([os.path.basename(partial_path), os.path.basename(checkpoint_path)])
+        assert comparison.common == ["copy.bin", "large.bin"]
+
+        copied_offsets.clear()
+        assert main.resumable_copy(str(source), str(destination), checkpoint_interval=64 * 1024) == "resumed"
+    # Copy continued right after the last checkpoint
+    assert copied_offsets[0] == 3 * 64 * 1024
+    assert destination.read_bytes() == source.read_bytes()
+    assert os.stat(destination).st_mtime_ns == os.stat(source).st_mtime_ns
+    assert not os.path.exists(partial_path) and not os.path.exists(checkpoint_path)
+
+def test_resumable_copy_reports_fallback_method(tmp_path):
+    source = tmp_path / "large.bin"
+    source.write_bytes(os.urandom(3 * 64 * 1024))
+    destination = tmp_path / "copy.bin"
+
+    def unsupported_copy_file_range(*args):
+        raise OSError(main.errno.ENOSYS, "not supported")
+
+    with mock.patch("src.main.os.copy_file_range", side_effect=unsupported_copy_file_range, create=True), \
+            mock.patch("src.main.fcntl", None):
+        assert main.resumable_copy(str(source), str(destination), checkpoint_interval=64 * 1024) == "pread/pwrite"
+    assert destination.read_bytes() == source.read_bytes()
+
+def test_source_file_named_like_partial_copy_is_synced(args):
+    name = ".report.txt.owfs-partial"
+    with open(os.path.join(args.source_dir_path, name), "w") as f:
+        f.write("Real source file")
+    sync_function = command_line_arguments_wrapper(args)
+    sync_function(args.source_dir_path, args.destination_dir_path)
+    with open(os.path.join(args.destination_dir_path, name)) as f:
+        assert f.read() == "Real source file"
+    # Synced file is neither removed as an unfinished copy nor copied again
+    sync_function(args.source_dir_path, args.destination_dir_path)
+    assert not sync_function.cycle_stats.counts
+    assert os.path.exists(os.path.join(args.destination_dir_path, name))
+
+@pytest.fixture
+def dedup_args(args):
+    args.dedup = "hardlink"
+    args.dedup_min_size = 1024
+    return args
+
+def test_dedup_links_duplicates_and_breaks_links_on_change(dedup_args):
+    source, destination = Path(dedup_args.source_dir_path), Path(dedup_args.destination_dir_path)
+    os.makedirs(source / "vendor")
+    content = os.urandom(8192)
+    for path in ("a.bin", "b.bin", "vendor/c.bin"):
+        (source / path).write_bytes(content)
+    (source / "other.bin").write_bytes(os.urandom(8192))
+
+    sync_function = command_line_arguments_wrapper(dedup_args)
+    sync_function(str(source), str(destination))
+    # Content is copied once, both duplicates are links to it
+    assert os.stat(destination / "a.bin").st_nlink == 3
+    assert os.stat(destination / "other.bin").st_nlink == 1
+    assert (destination / "vendor" / "c.bin").read_bytes() == content
+    assert sync_function.cycle_stats.counts["files_deduplicated"] == 2
+    assert sync_function.cycle_stats.observed["dedup_bytes_saved"] == 2 * len(content)
+    assert sync_function.metrics.status()["totals"]["dedup_bytes_saved"] == 2 * len(content)
+
+    # Changed duplicate gets its own file, the other links keep the previous content
+    (source / "b.bin").write_bytes(b"changed" + content[7:])
+    os.utime(source / "b.bin", ns=(1, 1))
+    sync_function(str(source), str(destination))
+    sync_function.shutdown()
+    assert (destination / "b.bin").read_bytes() == (source / "b.bin").read_bytes()
+    assert (destination / "a.bin").read_bytes() == content
+    assert os.stat(destination / "a.bin").st_nlink == 2
+
+def test_dedup_finds_duplicates_among_many_files_of_same_size(dedup_args):
+    source, destination = Path(dedup_args.source_dir_path), Path(dedup_args.destination_dir_path)
+    blobs = [os.urandom(8192) for _ in range(40)]
+    for index, content in enumerate(blobs):
+        (source / f"blob{index}.bin").write_bytes(content)
+    sync_function = command_line_arguments_wrapper(dedup_args)
+    sync_function(str(source), str(destination))
+    # Every copy finds its blob, however many recorded files share its size
+    for index, content in enumerate(blobs):
+        (source / f"copy{index}.bin").write_bytes(content)
+    sync_function(str(source), str(destination))
+    sync_function.shutdown()
+    assert sync_function.cycle_stats.counts["files_deduplicated"] == len(blobs)
+    assert all(os.stat(destination / f"copy{index}.bin").st_nlink == 2 for index in range(len(blobs)))
+
+def test_dedup_removing_duplicate_keeps_mode_of_other_link(dedup_args):
+    source, destination = Path(dedup_args.source_dir_path), Path(dedup_args.destination_dir_path)
+    content = os.urandom(4096)
+    for name in ("a.bin", "b.bin"):
+        (source / name).write_bytes(content)
+        os.chmod(source / name, 0o644)
+
+    sync_function = command_line_arguments_wrapper(dedup_args)
+    sync_function(str(source), str(destination))
+    assert os.stat(destination / "a.bin").st_nlink == 2
+    os.remove(source / "b.bin")
+    sync_function(str(source), str(destination))
+    sync_function.shutdown()
+    assert not os.path.exists(destination / "b.bin")
+    assert os.stat(destination / "a.bin").st_mode == os.stat(source / "a.bin").st_mode == 0o100644
+
+def test_dedup_hard_links_are_not_compared_again(dedup_args):
+    source, destination = Path(dedup_args.source_dir_path), Path(dedup_args.destination_dir_path)
+    content = os.urandom(4096)
+    for index, name in enumerate(("a.bin", "b.bin")):
+        (source / name).write_bytes(content)
+        os.utime(source / name, ns=(10 ** 9 * (index + 1),) * 2)
+
+    sync_function = command_line_arguments_wrapper(dedup_args)
+    sync_function(str(source), str(destination))
+    assert os.stat(destination / "a.bin").st_nlink == 2
+    # The link has mtime of one source only, it is still not hashed or copied in later cycles
+    sync_function(str(source), str(destination))
+    assert sync_function.cycle_stats.observed["bytes_hashed"] == 0
+    assert not sync_function.cycle_stats.counts
+    # Changed source is synced again
+    (source / "b.bin").write_bytes(b"changed" + content[7:])
+    sync_function(str(source), str(destination))
+    sync_function.shutdown()
+    assert (destination / "b.bin").read_bytes() == (source / "b.bin").read_bytes()
+    assert (destination / "a.bin").read_bytes() == content
+
+@pytest.mark.parametrize("mode", ["sample", "cprofile"])
+def test_profile_next_cycle(args, tmp_path, mode):
+    args.profile_mode = mode
+    args.profile_interval = 0.001
+    args.profile_dir = str(tmp_path / "profiles")
+    sync_function = command_line_arguments_wrapper(args)
+    # Nothing is profiled until requested
+    sync_function(args.source_dir_path, args.destination_dir_path)
+    assert not os.path.exists(args.profile_dir)
+
+    sync_function.profiler.request()
+    sync_function(args.source_dir_path, args.destination_dir_path)
+    sync_function(args.source_dir_path, args.destination_dir_path)
+    names = sorted(os.listdir(args.profile_dir))
+    expected = {".collapsed", ".top.txt"} | ({".pstats"} if mode == "cprofile" else set())
+    assert {name[name.index("."):] for name in names} == expected
+    assert len({name[:name.index(".")] for name in names}) == 1
+    collapsed = Path(args.profile_dir, next(name for name in names if name.endswith(".collapsed"))).read_text()
+    for line in collapsed.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert stack and int(count) > 0
+    if mode == "cprofile":
+        assert "run_cycle (main.py:" in collapsed
+    assert sync_function.profiler.remaining == 0
+
+def test_daemon_runs_jobs_from_config(tmp_path):
+    jobs = []
+    for name in ("photos", "documents"):
+        source = tmp_path / f"{name}_source"
+        os.makedirs(source / "subdir")
+        (source / "subdir" / f"{name}.txt").write_text(name)
+        (source / ".hidden").write_text("hidden")
+        jobs.append({"name": name, "source": str(source), "destination": str(tmp_path / f"{name}_destination"),
+                     "period": 0.05, "filter_hidden_dirs_files": name == "photos"})
+    # Source of the third job is missing, its failing cycles must not stop the other jobs
+    jobs.append({"name": "broken", "source": str(tmp_path / "missing"), "destination": str(tmp_path / "broken_destination"),
+                 "period": 0.05})
+    config_path = tmp_path / "daemon.json"
+    config_path.write_text(json.dumps({"workers": 2, "log_path": str(tmp_path / "daemon.log"), "jobs": jobs}))
+
+    handlers = {}
+    with mock.patch("src.main.signal.signal", side_effect=lambda signum, handler: handlers.setdefault(signum, handler)):
+        daemon = threading.Thread(target=main.run_daemon, args=(str(config_path),))
+        daemon.start()
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and not all(os.path.exists(tmp_path / f"{name}_destination" / "subdir" / f"{name}.txt")
+                                                      for name in ("photos", "documents")):
+            time.sleep(0.05)
+        handlers[main.signal.SIGTERM](main.signal.SIGTERM, None)
+        daemon.join(timeout=10)
+    assert not daemon.is_alive()
+
+    # Filters and logs are kept per job
+    assert (tmp_path / "documents_destination" / "subdir" / "documents.txt").read_text() == "documents"
+    assert os.path.exists(tmp_path / "documents_destination" / ".hidden")
+    assert not os.path.exists(tmp_path / "photos_destination" / ".hidden")
+    assert "photos_destination" in (tmp_path / "photos.log").read_text()
+    assert "photos_destination" not in (tmp_path / "documents.log").read_text()
+    assert "Synchronization cycle failed" in (tmp_path / "broken.log").read_text()
+    assert "Synchronization stopped." in (tmp_path / "daemon.log").read_text()
+
+def test_daemon_config_errors(tmp_path):
+    config_path = tmp_path / "daemon.json"
+    config_path.write_text(json.dumps({"jobs": [{"name": "a", "source": "s", "destination": "d", "period": 1},
+                                                {"name": "a", "source": "s", "destination": "e", "period": 1}]}))
+    with pytest.raises(ValueError, match="Duplicate job name"):
+        main.load_daemon_config(str(config_path))
+    config_path.write_text(json.dumps({"threads": 2, "jobs": []}))
+    with pytest.raises(ValueError, match="Unknown daemon options: threads"):
+        main.load_daemon_config(str(config_path))
+    # Misspelled job options are not ignored, shared limits can not be set per job
+    config_path.write_text(json.dumps({"jobs": [{"name": "a", "source": "s", "destination": "d", "period": 1,
+                                                 "state_indx": True, "max_period": 60}]}))
+    with pytest.raises(ValueError, match="Unknown options of job a: state_indx"):
+        main.load_daemon_config(str(config_path))
+    config_path.write_text(json.dumps({"jobs": [{"name": "a", "source": "s", "destination": "d", "period": 1,
+                                                 "read_limit": 1000}]}))
+    with pytest.raises(ValueError, match="daemon options, they belong to top level: read_limit"):
+        main.load_daemon_config(str(config_path))
+
+def test_log_queue_never_blocks(tmp_path):
+    logger = main.setup_logger(str(tmp_path / "bounded.log"), queue_size=1)
+    handler = logger.handlers[-1]
+    handler.listener.stop()
+    # Writer thread is stopped, so the queue fills up and further records are dropped
+    for i in range(5):
+        logger.info(f"message {i}")
+    assert handler.dropped == 4
+    logger.removeHandler(handler)
+    handler.queue.get_nowait()
+    handler.close()
+
 
 # To see test results of code integration, run: pytest -v test_integration.py
 # 
@@ -5,7 +5,7 @@ import logging
 import stat
 import shutil
 import time
-from unittest.mock import MagicMock
+from argparse import Namespace
 from src.main import command_line_arguments_wrapper 
 
 class TestSyncLoad(unittest.TestCase):
@@ -17,12 +17,13 @@ class TestSyncLoad(unittest.TestCase):
         self.log_path = os.path.join(tempfile.gettempdir(), 'load_test_log.log')
 
         # Define args for command line arguments wrapper
-        self.args = MagicMock()
-        self.args.source_dir_path = self.source_dir
-        self.args.destination_dir_path = self.destination_dir
-        self.args.log_path = self.log_path
-        self.args.sync_period = 1  # sync every second
-        self.args.filter_hidden_dirs_files = False  # Include all files in the load test
+        self.args = Namespace(
+            source_dir_path=self.source_dir,
+            destination_dir_path=self.destination_dir,
+            log_path=self.log_path,
+            sync_period=1,  # sync every second
+            filter_hidden_dirs_files=False  # Include all files in the load test
+        )
 
     def tearDown(self):
         # Remove all handlers from the logger to close the log file
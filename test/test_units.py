@@ -4,9 +4,22 @@ import stat
 import tempfile
 import shutil
 import logging
+import filecmp
+import sys
+import hashlib
+import zlib
+import time
+import threading
+import pathlib
+import queue
+import ctypes
+import errno
 from unittest.mock import patch, MagicMock
 from argparse import Namespace
-from src.main import command_line_arguments_wrapper, md5_digest  
+from src.main import (command_line_arguments_wrapper, md5_digest, SyncStateIndex, DirComparisonScan,
+                      InotifyWatcher, HashCache, DigestBackend, init_hash_process, file_digest, HASH_ALGORITHMS, HASH_METHODS,
+                      files_differ, delta_sync_file, delta_instructions, weak_checksum, roll_checksum, FilterRules, SyncPlan,
+                      remove_tree, trash_path, TrashReaper, BoundedQueueHandler, LogQueueListener, AdaptiveScheduler, TokenBucket, THROTTLE)
 
 class TestSyncScript(unittest.TestCase):
 
@@ -120,5 +133,691 @@ class TestSyncScript(unittest.TestCase):
         md5_duplicate = md5_digest(duplicate_file)
         self.assertEqual(md5_source, md5_duplicate)
 
+    def test_state_index_skips_unchanged_directory(self):
+        # Sync with persistent state index stored in destination's sibling temp dir
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+        self.args.state_index = True
+        self.args.state_index_path = os.path.join(index_dir, "index.sqlite")
+        sync_func = command_line_arguments_wrapper(self.args)
+        sync_func(self.source_dir, self.destination_dir)
+
+        # Second cycle must not compare directories again when nothing changed
+        with patch("src.main.DirComparisonScan") as comparison:
+            sync_func(self.source_dir, self.destination_dir)
+            comparison.assert_not_called()
+
+            # Content change inside unchanged directory listing is still synced from index
+            with open(self.file1, 'w') as f:
+                f.write("Changed by index test")
+            sync_func(self.source_dir, self.destination_dir)
+            comparison.assert_not_called()
+        with open(os.path.join(self.destination_dir, "file1.txt"), 'r') as f:
+            self.assertEqual(f.read(), "Changed by index test")
+
+    def test_state_index_verify(self):
+        # Build index and then break destination behind its back
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+        self.args.state_index = True
+        self.args.state_index_path = os.path.join(index_dir, "index.sqlite")
+        self.args.filter_hidden_dirs_files = False
+        command_line_arguments_wrapper(self.args)(self.source_dir, self.destination_dir)
+        os.remove(os.path.join(self.destination_dir, "file1.txt"))
+
+        index = SyncStateIndex(self.args.state_index_path)
+        self.assertEqual(index.verify(self.source_dir, self.destination_dir), ["file1.txt"])
+        index.close()
+
+        # Verification at startup clears index, so next cycle restores destination
+        self.args.verify_index = True
+        sync_func = command_line_arguments_wrapper(self.args)
+        sync_func(self.source_dir, self.destination_dir)
+        self.assertTrue(os.path.exists(os.path.join(self.destination_dir, "file1.txt")))
+
+    def test_dir_comparison_scan_matches_dircmp(self):
+        # Build every kind of difference between both sides
+        for name in ("left_only.txt", "same.txt", "diff.txt", ".hidden_left"):
+            with open(os.path.join(self.source_dir, name), 'w') as f:
+                f.write(name)
+        for name in ("right_only.txt", "diff.txt", ".hidden_right"):
+            with open(os.path.join(self.destination_dir, name), 'w') as f:
+                f.write(name * 2)
+        shutil.copy2(os.path.join(self.source_dir, "same.txt"), os.path.join(self.destination_dir, "same.txt"))
+        for side in (self.source_dir, self.destination_dir):
+            os.makedirs(os.path.join(side, "common_dir"))
+        os.makedirs(os.path.join(self.source_dir, "funny"))
+        with open(os.path.join(self.destination_dir, "funny"), 'w') as f:
+            f.write("file on the right side")
+
+        expected = filecmp.dircmp(self.source_dir, self.destination_dir, ignore=[], hide=[])
+        comparison = DirComparisonScan(self.source_dir, self.destination_dir)
+        for attribute in ("left_only", "right_only", "common_dirs", "common_files", "common_funny",
+                          "diff_files", "same_files"):
+            self.assertEqual(sorted(getattr(comparison, attribute)), sorted(getattr(expected, attribute)), attribute)
+
+        # Listings keep packed stat fields, directories are not stat'd until asked for
+        listing = comparison.left_listing
+        self.assertEqual(listing.stat("same.txt").st_mtime_ns, os.stat(os.path.join(self.source_dir, "same.txt")).st_mtime_ns)
+        self.assertEqual(listing.stat("same.txt").st_size, len("same.txt"))
+        self.assertFalse(listing.stated[listing.find("common_dir")])
+        self.assertTrue(listing.is_dir("common_dir") and comparison.right_listing.is_file("funny"))
+        self.assertEqual(comparison.category("diff.txt"), DirComparisonScan.DIFF_FILE)
+        self.assertIsNone(comparison.category("right_only.txt"))
+
+        # Filtered mode leaves hidden source entries out, hidden destination entries are to be removed
+        filtered = DirComparisonScan(self.source_dir, self.destination_dir, rules=FilterRules(hidden=True))
+        self.assertNotIn(".hidden_file", filtered.left_only)
+        self.assertIn(".hidden_right", filtered.right_only)
+        self.assertEqual(filtered.left_only, ["file1.txt", "left_only.txt"])
+
+    def test_hash_cache_hits_until_file_changes(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        cache_path = os.path.join(cache_dir, "hashes.json")
+        cache = HashCache(cache_path, max_entries=2)
+        digest = md5_digest(self.file1, cache=cache)
+        self.assertEqual(md5_digest(self.file1, cache=cache), digest)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Changed signature is a miss, the stale entry is evicted as least recently used
+        with open(self.file1, 'w') as f:
+            f.write("Changed content of file")
+        md5_digest(self.file1, cache=cache)
+        md5_digest(self.hidden_file, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        self.assertEqual(len(cache.entries), 2)
+
+        # Cache survives restart
+        cache.save()
+        restored = HashCache(cache_path, max_entries=2)
+        self.assertEqual(md5_digest(self.file1, cache=restored), md5_digest(self.file1))
+        self.assertEqual(restored.hits, 1)
+
+    def test_digest_backends_agree(self):
+        empty_file = os.path.join(self.source_dir, "empty.bin")
+        open(empty_file, 'wb').close()
+        for path in (self.file1, empty_file):
+            with open(path, 'rb') as f:
+                content = f.read()
+            for algorithm in HASH_ALGORITHMS:
+                for method in HASH_METHODS:
+                    self.assertEqual(file_digest(path, algorithm, method, buffer_size=4),
+                                     hashlib.new(algorithm, content).hexdigest(), (algorithm, method))
+
+        # Large files of a pair are hashed in the process pool
+        backend = DigestBackend("blake2b", processes=2, parallel_threshold=1)
+        self.addCleanup(backend.shutdown)
+        # Processes are not forked from this process with its running threads
+        self.assertIn(backend.pool._mp_context.get_start_method(), ("forkserver", "spawn"))
+        # Hashing process does not throttle again what the parent already paid for
+        self.addCleanup(THROTTLE.configure, read_bytes_per_second=0)
+        THROTTLE.configure(read_bytes_per_second=1000)
+        with patch("src.main.lower_thread_priority"):
+            init_hash_process(0, False)
+        self.assertFalse(THROTTLE.limited("read_bytes_per_second"))
+        self.assertEqual(backend.digest_pair(self.file1, empty_file),
+                         (file_digest(self.file1, "blake2b"), file_digest(empty_file, "blake2b")))
+
+    def test_streaming_compare_stops_at_first_difference(self):
+        first = os.path.join(self.source_dir, "first.bin")
+        second = os.path.join(self.destination_dir, "second.bin")
+        with open(first, 'wb') as f:
+            f.write(b"a" * 10 + b"b" * 10)
+        shutil.copy(first, second)
+        self.assertFalse(files_differ(first, second, block_size=4))
+
+        # Size mismatch needs no reading at all
+        with open(second, 'ab') as f:
+            f.write(b"c")
+        with patch("builtins.open") as mocked_open:
+            self.assertTrue(files_differ(first, second))
+            mocked_open.assert_not_called()
+
+        # Difference in the first block is found after one block of each file
+        with open(second, 'wb') as f:
+            f.write(b"x" + b"a" * 9 + b"b" * 10)
+        self.assertTrue(files_differ(first, second, block_size=4))
+
+        # Streaming strategy syncs updated file as well
+        self.args.compare = "stream"
+        sync_func = command_line_arguments_wrapper(self.args)
+        sync_func(self.source_dir, self.destination_dir)
+        with open(self.file1, 'w') as f:
+            f.write("Sample conten!")
+        sync_func(self.source_dir, self.destination_dir)
+        with open(os.path.join(self.destination_dir, "file1.txt")) as f:
+            self.assertEqual(f.read(), "Sample conten!")
+
+    def test_rolling_checksum_matches_adler32(self):
+        data = os.urandom(300)
+        a, b = weak_checksum(data[:100])
+        for i in range(200):
+            a, b = roll_checksum(a, b, data[i], data[i + 100], 100)
+            self.assertEqual(b << 16 | a, zlib.adler32(data[i + 1:i + 101]))
+
+    def test_delta_sync_rewrites_changed_ranges_only(self):
+        base = os.urandom(64 * 1024)
+        source = os.path.join(self.source_dir, "large.bin")
+        destination = os.path.join(self.destination_dir, "large.bin")
+        cases = {
+            "append": (base + b"appended line", 13),
+            "change_block": (base[:4096] + os.urandom(1024) + base[5120:], 1024),
+            "insert": (base[:5000] + b"shifted" + base[5000:], len(base) + 7),
+        }
+        for name, (content, expected_written) in cases.items():
+            with open(destination, 'wb') as f:
+                f.write(base)
+            with open(source, 'wb') as f:
+                f.write(content)
+            self.assertEqual(delta_sync_file(source, destination, block_size=1024), expected_written, name)
+            with open(destination, 'rb') as f:
+                self.assertEqual(f.read(), content, name)
+
+        # Completely different content is left for a plain copy
+        with open(source, 'wb') as f:
+            f.write(os.urandom(len(base)))
+        self.assertIsNone(delta_sync_file(source, destination, block_size=1024))
+
+    def test_delta_stops_rolling_after_unmatched_blocks(self):
+        base = os.urandom(256 * 1024)
+        rewritten = os.urandom(len(base))
+        with patch("src.main.roll_checksum", side_effect=roll_checksum) as rolled:
+            self.assertIsNone(delta_instructions(rewritten, base, 1024, 0.5))
+        # Only the first unmatched blocks are rolled byte by byte
+        self.assertLessEqual(rolled.call_count, 8 * 1024)
+
+        # Long rewritten range in the middle is still patched, unchanged blocks after it are found again
+        content = base[:10 * 1024] + os.urandom(40 * 1024) + base[50 * 1024:]
+        instructions = delta_instructions(content, base, 1024, 0.5)
+        self.assertEqual(sum(length for _, offset, length in instructions if offset is None), 40 * 1024)
+
+    def test_moved_directory_is_renamed_in_destination(self):
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+        self.args.state_index = True
+        self.args.state_index_path = os.path.join(index_dir, "index.sqlite")
+        self.args.detect_moves = True
+        archive = os.path.join(self.source_dir, "archive", "2023")
+        os.makedirs(archive)
+        with open(os.path.join(archive, "report.txt"), 'w') as f:
+            f.write("Archived report")
+        os.makedirs(os.path.join(self.source_dir, "old"))
+        sync_func = command_line_arguments_wrapper(self.args)
+        sync_func(self.source_dir, self.destination_dir)
+        # Copied directories were recorded in the index, the next cycle does not list them again
+        sync_func(self.source_dir, self.destination_dir)
+        self.assertEqual(sync_func.cycle_stats.observed["directories_listed"], 0)
+
+        # Directory moved to another parent is renamed by inode history, nothing is copied
+        os.rename(archive, os.path.join(self.source_dir, "old", "2023"))
+        with patch("src.main.copy_file") as copy_file, patch("src.main.shutil.copytree") as copytree:
+            sync_func(self.source_dir, self.destination_dir)
+            copy_file.assert_not_called()
+            copytree.assert_not_called()
+        self.assertTrue(os.path.exists(os.path.join(self.destination_dir, "old", "2023", "report.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.destination_dir, "archive", "2023")))
+
+    def test_created_destination_is_recorded_in_index(self):
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+        self.args.state_index = True
+        self.args.state_index_path = os.path.join(index_dir, "index.sqlite")
+        os.makedirs(os.path.join(self.source_dir, "docs", "2024"))
+        with open(os.path.join(self.source_dir, "docs", "2024", "notes.txt"), 'w') as f:
+            f.write("Notes")
+        shutil.rmtree(self.destination_dir)
+        sync_func = command_line_arguments_wrapper(self.args)
+        sync_func(self.source_dir, self.destination_dir)
+        self.assertTrue(os.path.exists(os.path.join(self.destination_dir, "docs", "2024", "notes.txt")))
+        # The cycle after the initial one is served from the index
+        sync_func(self.source_dir, self.destination_dir)
+        self.assertEqual(sync_func.cycle_stats.observed["directories_listed"], 0)
+        self.assertFalse(sync_func.cycle_stats.counts)
+
+    def test_entry_moved_into_new_directory_is_renamed(self):
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+        self.args.state_index = True
+        self.args.state_index_path = os.path.join(index_dir, "index.sqlite")
+        self.args.detect_moves = True
+        os.makedirs(os.path.join(self.source_dir, "inbox", "photos"))
+        with open(os.path.join(self.source_dir, "inbox", "photos", "a.jpg"), 'wb') as f:
+            f.write(os.urandom(2 * 1024 * 1024))
+        with open(os.path.join(self.source_dir, "inbox", "b.jpg"), 'wb') as f:
+            f.write(os.urandom(1024))
+        sync_func = command_line_arguments_wrapper(self.args)
+        sync_func(self.source_dir, self.destination_dir)
+
+        # File and directory moved into directories which do not exist in destination yet
+        os.makedirs(os.path.join(self.source_dir, "2024", "march"))
+        os.rename(os.path.join(self.source_dir, "inbox", "b.jpg"), os.path.join(self.source_dir, "2024", "march", "b.jpg"))
+        os.rename(os.path.join(self.source_dir, "inbox", "photos"), os.path.join(self.source_dir, "2024", "photos"))
+        with patch("src.main.copy_file") as copy_file:
+            sync_func(self.source_dir, self.destination_dir)
+            copy_file.assert_not_called()
+        sync_func.shutdown()
+        self.assertEqual(sync_func.cycle_stats.counts["entries_moved"], 2)
+        self.assertTrue(os.path.exists(os.path.join(self.destination_dir, "2024", "march", "b.jpg")))
+        self.assertTrue(os.path.exists(os.path.join(self.destination_dir, "2024", "photos", "a.jpg")))
+        self.assertEqual(os.listdir(os.path.join(self.destination_dir, "inbox")), [])
+
+    def test_renamed_file_is_matched_by_size_and_hash(self):
+        self.args.detect_moves = True
+        self.args.move_min_size = 1
+        sync_func = command_line_arguments_wrapper(self.args)
+        sync_func(self.source_dir, self.destination_dir)
+
+        os.rename(self.file1, os.path.join(self.source_dir, "renamed.txt"))
+        with patch("src.main.copy_file") as copy_file:
+            sync_func(self.source_dir, self.destination_dir)
+            copy_file.assert_not_called()
+        self.assertEqual(os.listdir(self.destination_dir), ["renamed.txt"])
+
+    def test_filter_rules_gitignore_syntax(self):
+        rules = FilterRules(["*.log", "!keep.log", "build/", "/top.txt", "docs/**/*.tmp", "data/**"])
+        self.assertTrue(rules.excluded("nested/debug.log"))
+        self.assertFalse(rules.excluded("keep.log"))
+        self.assertTrue(rules.excluded("src/build", is_dir=True))
+        self.assertFalse(rules.excluded("build"))
+        self.assertTrue(rules.excluded("top.txt"))
+        self.assertFalse(rules.excluded("nested/top.txt"))
+        self.assertTrue(rules.excluded("docs/a/b/c.tmp"))
+        self.assertTrue(rules.excluded("data/file.bin"))
+        self.assertFalse(rules.excluded("data", is_dir=True))
+        self.assertTrue(rules.excluded_directory("src/build/nested"))
+
+    def test_restart_with_filtering_removes_only_excluded_entries(self):
+        # Destination synced without filtering holds hidden file and excluded directory
+        rules_path = os.path.join(self.source_dir, ".syncignore")
+        with open(rules_path, 'w') as f:
+            f.write("# generated files\ncache/\n")
+        os.makedirs(os.path.join(self.source_dir, "cache"))
+        self.args.filter_hidden_dirs_files = False
+        command_line_arguments_wrapper(self.args)(self.source_dir, self.destination_dir)
+        kept_file = os.path.join(self.destination_dir, "file1.txt")
+        kept_inode = os.stat(kept_file).st_ino
+
+        # Restart with filtering keeps everything else in place
+        self.args.filter_hidden_dirs_files = True
+        self.args.exclude_from = rules_path
+        sync_func = command_line_arguments_wrapper(self.args)
+        self.assertEqual(os.stat(kept_file).st_ino, kept_inode)
+        sync_func(self.source_dir, self.destination_dir)
+        self.assertEqual(os.listdir(self.destination_dir), ["file1.txt"])
+        self.assertEqual(os.stat(kept_file).st_ino, kept_inode)
+
+    def test_path_objects_are_accepted_as_options(self):
+        rules_path = pathlib.Path(self.source_dir) / ".syncignore"
+        rules_path.write_text("file1.txt\n")
+        self.args.exclude_from = rules_path
+        command_line_arguments_wrapper(self.args)(self.source_dir, self.destination_dir)
+        self.assertEqual(os.listdir(self.destination_dir), [])
+
+    def test_sync_plan_orders_operations_for_throughput(self):
+        plan = SyncPlan()
+        plan.add("copy", "s/big", "d/big", "big", size=SyncPlan.SMALL_FILE_SIZE, inode=1)
+        plan.add("copy", "s/c/small", "d/c/small", "small", size=10, inode=9)
+        plan.add("mkdir", "s/c/e", "d/c/e", "e")
+        plan.add("mkdir", "s/c", "d/c", "c")
+        plan.add("update", "s/other", "d/other", "other", size=20, inode=3)
+        plan.add("remove", None, "d/stale", "stale", is_dir=False)
+        plan.add("move", "d/old", "d/new", "new", old_key=None, new_key=None)
+        phases = [(phase, [operation.name for operation in operations]) for phase, operations in plan.phases()]
+        # Deletes before directory creation, parents first, small files grouped and sorted by inode
+        self.assertEqual(phases, [("move", ["new"]), ("remove", ["stale"]), ("mkdir", ["c", "e"]),
+                                  ("files", ["other", "small", "big"])])
+        files = dict(plan.phases())["files"]
+        self.assertEqual([[operation.name for operation in batch] for batch in plan.batches(files)],
+                         [["other", "small"], ["big"]])
+        self.assertEqual(plan.summary(throughput=1)["bytes_to_copy"], SyncPlan.SMALL_FILE_SIZE + 10)
+
+    def test_sync_plan_keeps_compact_columns(self):
+        plan = SyncPlan()
+        for index in range(1000):
+            plan.add("copy", f"s/dir/file{index}", f"d/dir/file{index}", f"file{index}", key="dir", size=index, inode=index)
+        plan.add("move", "d/old/name", "d/dir/renamed", "renamed", key="dir", old_key="old/name", new_key="dir/renamed")
+        plan.add("remove", None, "d/dir/stale", "stale", key="dir", is_dir=True)
+        plan.add("mkdir", "s/source_root", "d/destination_root/", "")
+        # Directory strings are stored once, only the move and the renamed root carry a dict of fields
+        self.assertEqual(plan.directories, ["s/dir", "d/dir", "d/old", "s", "d/destination_root"])
+        self.assertEqual(sorted(plan.fields), [1000, 1002])
+        self.assertEqual(len(plan.names), sum(len(f"file{index}") for index in range(1000)) + len("renamedstale"))
+        move, remove, mkdir = list(plan)[1000:]
+        self.assertEqual((move.source, move.destination, move.name, move.get("old_key")), ("d/old/name", "d/dir/renamed", "renamed", "old/name"))
+        self.assertEqual((remove.source, remove.destination, remove.get("is_dir"), remove.get("in_tree")), (None, "d/dir/stale", True, False))
+        self.assertEqual((mkdir.source, mkdir.destination), ("s/source_root", "d/destination_root/"))
+        self.assertEqual(remove.to_dict(), {"kind": "remove", "source": None, "destination": "d/dir/stale", "name": "stale",
+                                            "key": "dir", "size": 0, "inode": 0, "is_dir": True})
+
+        # Taken plan keeps its operations, the original starts empty in the next generation
+        taken = plan.take()
+        self.assertEqual((len(taken), len(plan), plan.generation), (1003, 0, 1))
+        self.assertEqual([operation.destination for operation in taken][999], "d/dir/file999")
+
+    def test_dry_run_plan_does_not_change_destination(self):
+        os.makedirs(os.path.join(self.source_dir, "subdir"))
+        with open(os.path.join(self.source_dir, "subdir", "nested.txt"), 'w') as f:
+            f.write("Nested")
+        with open(os.path.join(self.destination_dir, "stale.txt"), 'w') as f:
+            f.write("Stale")
+        sync_func = command_line_arguments_wrapper(self.args)
+        plan = sync_func.plan(self.source_dir, self.destination_dir)
+        self.assertEqual(os.listdir(self.destination_dir), ["stale.txt"])
+        self.assertEqual(plan.summary()["operations"], {"copy": 2, "mkdir": 1, "remove": 1})
+        self.assertEqual(plan.to_dict()["operations"][0]["kind"], "remove")
+
+        # Applying the same cycle afterwards gives the planned result
+        sync_func(self.source_dir, self.destination_dir)
+        self.assertEqual(sorted(os.listdir(self.destination_dir)), ["file1.txt", "subdir"])
+
+    def test_parallel_scan_plans_like_serial_scan(self):
+        for top in range(5):
+            for sub in range(top * 3):
+                directory = os.path.join(self.source_dir, f"top{top}", f"sub{sub}")
+                os.makedirs(directory)
+                for index in range(sub + 1):
+                    with open(os.path.join(directory, f"file{index}.txt"), 'w') as f:
+                        f.write(f"{top} {sub} {index}")
+        self.args.state_index = True
+        self.args.state_index_path = os.path.join(self.destination_dir + ".index", "index.sqlite")
+        os.makedirs(os.path.dirname(self.args.state_index_path))
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.args.state_index_path))
+        serial = command_line_arguments_wrapper(self.args)
+        initial_plan = serial.plan(self.source_dir, self.destination_dir).to_dict()
+        serial(self.source_dir, self.destination_dir)
+        serial.shutdown()
+        # Changes spread over the tree, planned partly from state index and partly from listings
+        with open(os.path.join(self.source_dir, "top4", "sub7", "file0.txt"), 'w') as f:
+            f.write("changed content")
+        shutil.rmtree(os.path.join(self.destination_dir, "top3", "sub2"))
+        os.remove(os.path.join(self.source_dir, "top2", "sub5", "file3.txt"))
+        serial = command_line_arguments_wrapper(self.args)
+        serial_plan = serial.plan(self.source_dir, self.destination_dir).to_dict()
+        serial.shutdown()
+
+        self.args.scan_workers = 4
+        self.args.max_inflight_dirs = 3
+        parallel = command_line_arguments_wrapper(self.args)
+        self.assertEqual(parallel.plan(self.source_dir, self.destination_dir).to_dict(), serial_plan)
+        self.assertEqual(len(serial_plan["operations"]), 6)
+        # Without index, into an empty destination
+        self.args.state_index = False
+        shutil.rmtree(self.destination_dir)
+        self.args.scan_workers = 0
+        serial_plan = command_line_arguments_wrapper(self.args).plan(self.source_dir, self.destination_dir).to_dict()
+        self.assertEqual(len(serial_plan["operations"]), len(initial_plan["operations"]))
+        self.args.scan_workers = 4
+        parallel = command_line_arguments_wrapper(self.args)
+        self.assertEqual(parallel.plan(self.source_dir, self.destination_dir).to_dict(), serial_plan)
+        parallel(self.source_dir, self.destination_dir)
+        parallel.shutdown()
+        self.assertFalse(filecmp.dircmp(self.source_dir, self.destination_dir).diff_files)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.destination_dir, "top4"))), sorted(f"sub{sub}" for sub in range(12)))
+
+    def test_fast_delete_moves_tree_into_trash(self):
+        stale = os.path.join(self.destination_dir, "stale")
+        for index in range(20):
+            os.makedirs(os.path.join(stale, f"sub{index}"))
+            with open(os.path.join(stale, f"sub{index}", "file.txt"), 'w') as f:
+                f.write("Stale")
+        # Tree left in trash by a previous run is deleted after start
+        trash_dir = trash_path(self.destination_dir)
+        self.assertEqual(os.path.dirname(trash_dir), os.path.abspath(self.destination_dir))
+        os.makedirs(os.path.join(trash_dir, "leftover", "nested"))
+        self.args.fast_delete = True
+        removing_threads = []
+
+        def recording_remove_tree(path, **kwargs):
+            removing_threads.append(threading.current_thread().name)
+            return remove_tree(path, **kwargs)
+
+        with patch("src.main.remove_tree", side_effect=recording_remove_tree):
+            sync_func = command_line_arguments_wrapper(self.args)
+            sync_func(self.source_dir, self.destination_dir)
+            self.assertEqual(sorted(os.listdir(self.destination_dir)), [".owfs-trash", "file1.txt"])
+            deadline = time.monotonic() + 10
+            while os.listdir(trash_dir) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            # Trash is not part of the synchronized tree
+            sync_func(self.source_dir, self.destination_dir)
+            self.assertFalse(sync_func.cycle_stats.counts)
+            sync_func.shutdown()
+        self.assertEqual(os.listdir(trash_dir), [])
+        # Nothing was deleted on the sync thread
+        self.assertEqual(set(removing_threads), {"trash_reaper"})
+
+    def test_log_handler_closes_with_full_queue(self):
+        writing, released = threading.Event(), threading.Event()
+        written = []
+
+        class SlowHandler(logging.Handler):
+            def emit(self, record):
+                writing.set()
+                released.wait()
+                written.append(record.getMessage())
+
+        log_queue = queue.Queue(maxsize=2)
+        listener = LogQueueListener(log_queue, SlowHandler())
+        handler = BoundedQueueHandler(log_queue, listener)
+        listener.start()
+        logger = logging.getLogger("full_queue_logger")
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        # Listener is stuck writing the first record while the queue fills up
+        logger.warning("message 0")
+        writing.wait()
+        for index in range(1, 10):
+            logger.warning(f"message {index}")
+        self.assertTrue(log_queue.full())
+        threading.Timer(0.1, released.set).start()
+        handler.close()
+        # Queued records were written and listener thread has ended
+        self.assertIsNone(listener._thread)
+        self.assertEqual(len(written) + handler.dropped, 10)
+
+    def test_trash_names_are_unique_across_threads(self):
+        trees = []
+        for index in range(64):
+            tree = os.path.join(self.destination_dir, f"tree{index}")
+            os.makedirs(os.path.join(tree, "nested"))
+            trees.append(tree)
+        trash_dir = trash_path(self.destination_dir)
+        reaper = TrashReaper(trash_dir, MagicMock())
+        reaper.shutdown()
+        # Same timestamp for every rename, names differ only by sequence number
+        with patch("src.main.time.time_ns", return_value=0):
+            threads = [threading.Thread(target=lambda part: [self.assertTrue(reaper.discard(tree)) for tree in part],
+                                        args=(trees[start::4],)) for start in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(os.listdir(trash_dir)), len(trees))
+        self.assertFalse(reaper.logger.warning.called)
+
+    def test_remove_tree_stops_and_resumes(self):
+        tree = os.path.join(self.destination_dir, "tree")
+        for index in range(5):
+            os.makedirs(os.path.join(tree, f"sub{index}"))
+            open(os.path.join(tree, f"sub{index}", "file"), 'w').close()
+        stopping = threading.Event()
+        removed = []
+
+        def pace():
+            removed.append(1)
+            if len(removed) == 2:
+                stopping.set()
+
+        self.assertFalse(remove_tree(tree, stopping=stopping, pace=pace))
+        self.assertTrue(os.path.isdir(tree))
+        self.assertTrue(remove_tree(tree, pace=pace))
+        self.assertFalse(os.path.exists(tree))
+        self.assertEqual(len(removed), 5)
+
+    def test_copied_tree_metadata_is_applied_per_flushed_plan(self):
+        self.args.max_inflight_dirs = 2
+        self.args.filter_hidden_dirs_files = False
+        directories = []
+        for top in range(3):
+            for sub in range(3):
+                directory = os.path.join(self.source_dir, "tree", f"top{top}", f"sub{sub}")
+                os.makedirs(directory)
+                with open(os.path.join(directory, "file.txt"), 'w') as f:
+                    f.write("content")
+        for root, dirs, _ in os.walk(os.path.join(self.source_dir, "tree"), topdown=False):
+            os.utime(root, ns=(10 ** 9, 10 ** 9 * (len(directories) + 1)))
+            directories.append(os.path.relpath(root, self.source_dir))
+        copystat_calls = []
+        original_copystat = shutil.copystat
+
+        def recording_copystat(source, target):
+            if os.path.isdir(target):
+                existing = [directory for directory in directories
+                            if os.path.isdir(os.path.join(self.destination_dir, directory))]
+                copystat_calls.append((os.path.relpath(target, self.destination_dir), len(existing)))
+            original_copystat(source, target)
+
+        sync_func = command_line_arguments_wrapper(self.args)
+        with patch("src.main.shutil.copystat", side_effect=recording_copystat):
+            sync_func(self.source_dir, self.destination_dir)
+        for directory in directories:
+            self.assertEqual(os.stat(os.path.join(self.destination_dir, directory)).st_mtime_ns,
+                             os.stat(os.path.join(self.source_dir, directory)).st_mtime_ns, directory)
+        # Metadata is copied as plans are flushed, not at the end of the cycle when the whole tree exists
+        self.assertEqual(sorted(name for name, _ in copystat_calls), sorted(directories))
+        self.assertLess(copystat_calls[0][1], len(directories))
+
+    def test_tree_deeper_than_recursion_limit(self):
+        self.args.max_inflight_dirs = 100
+        deepest = self.source_dir
+        for _ in range(sys.getrecursionlimit() + 50):
+            deepest = os.path.join(deepest, "d")
+            os.mkdir(deepest)
+        with open(os.path.join(deepest, "leaf.txt"), 'w') as f:
+            f.write("Leaf")
+        sync_func = command_line_arguments_wrapper(self.args)
+        sync_func(self.source_dir, self.destination_dir)
+        leaf = os.path.join(self.destination_dir, os.path.relpath(deepest, self.source_dir), "leaf.txt")
+        self.assertTrue(os.path.exists(leaf))
+        sync_func(self.source_dir, self.destination_dir)
+        self.assertEqual(sync_func.cycle_stats.counts, {})
+
+        # Removal of the deep tree from destination is iterative as well
+        remove_tree(os.path.join(self.source_dir, "d"))
+        sync_func(self.source_dir, self.destination_dir)
+        self.assertEqual(os.listdir(self.destination_dir), ["file1.txt"])
+
+    def test_adaptive_scheduler_interval(self):
+        scheduler = AdaptiveScheduler(2, 8)
+        started = time.monotonic()
+        # Idle cycles stretch the interval up to the maximum, changes shrink it back
+        for expected in (3, 4.5, 6.75, 8):
+            scheduler.update(started, 0.1, changes=0)
+            self.assertEqual(scheduler.interval, expected)
+        scheduler.update(started, 0.1, changes=5)
+        self.assertEqual(scheduler.interval, 4)
+        self.assertAlmostEqual(scheduler.next_run, started + 4)
+        # Cycle is followed by an idle gap at least as long as itself while twice its duration fits max_interval
+        scheduler.update(started, 3, changes=5)
+        self.assertEqual(scheduler.interval, 6)
+        self.assertGreaterEqual(scheduler.next_run - (started + 3), 3)
+        # Long cycle is followed right away and never overlaps with the next one
+        scheduler.update(started, 30, changes=5)
+        self.assertEqual(scheduler.interval, 8)
+        self.assertGreaterEqual(scheduler.next_run, started + 8)
+        scheduler.stop()
+        self.assertFalse(scheduler.wait())
+
+    def test_stop_request_ends_cycle_at_directory_boundary(self):
+        for name in ("a", "b"):
+            os.makedirs(os.path.join(self.source_dir, name, "inner"))
+            with open(os.path.join(self.source_dir, name, "inner", "file.txt"), 'w') as f:
+                f.write(name)
+        sync_func = command_line_arguments_wrapper(self.args)
+        sync_func.stop_requested.set()
+        sync_func(self.source_dir, self.destination_dir)
+        # Only entries of the first planned directory were synced
+        self.assertEqual(sorted(os.listdir(self.destination_dir)), ["a", "b", "file1.txt"])
+        self.assertEqual(os.listdir(os.path.join(self.destination_dir, "a")), [])
+        sync_func.stop_requested.clear()
+        sync_func(self.source_dir, self.destination_dir)
+        self.assertTrue(os.path.exists(os.path.join(self.destination_dir, "b", "inner", "file.txt")))
+
+    def test_token_bucket_limits_rate(self):
+        bucket = TokenBucket(rate=1000)
+        self.assertEqual(bucket.consume(1000), 0)
+        # Request above the burst is let through and paid back by waiting
+        started = time.monotonic()
+        bucket.consume(300)
+        self.assertGreaterEqual(time.monotonic() - started, 0.25)
+        bucket.set_rate(0)
+        self.assertEqual(bucket.consume(10 ** 9), 0)
+
+    def test_throttle_limits_are_reloaded_at_runtime(self):
+        self.addCleanup(THROTTLE.configure, read_bytes_per_second=0, write_bytes_per_second=0, metadata_ops_per_second=0)
+        limits_path = os.path.join(self.source_dir, "limits.json")
+        with open(limits_path, 'w') as f:
+            f.write('{"write_bytes_per_second": 200000}')
+        with open(os.path.join(self.source_dir, "large.bin"), 'wb') as f:
+            f.write(os.urandom(300000))
+        self.args.limits_file = limits_path
+        sync_func = command_line_arguments_wrapper(self.args)
+        self.assertEqual(THROTTLE.limits()["write_bytes_per_second"], 200000)
+        waited = THROTTLE.waited
+        sync_func(self.source_dir, self.destination_dir)
+        self.assertGreater(THROTTLE.waited, waited)
+
+        with open(limits_path, 'w') as f:
+            f.write('{"write_bytes_per_second": 0, "metadata_ops_per_second": 50}')
+        sync_func.reload_limits(force=True)
+        self.assertEqual(THROTTLE.limits(), {"read_bytes_per_second": 0, "write_bytes_per_second": 0,
+                                             "metadata_ops_per_second": 50})
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is available on Linux only")
+    def test_watch_mode_syncs_changed_directory(self):
+        sub_dir = os.path.join(self.source_dir, "subdir")
+        os.makedirs(sub_dir)
+        sync_func = command_line_arguments_wrapper(self.args)
+        sync_func(self.source_dir, self.destination_dir)
+        watcher = InotifyWatcher(self.source_dir, rules=FilterRules(hidden=True))
+        self.addCleanup(watcher.close)
+
+        # Burst of changes in one directory is coalesced into that directory only
+        for i in range(5):
+            with open(os.path.join(sub_dir, f"new_{i}.txt"), 'w') as f:
+                f.write("watched content")
+        changed = watcher.wait_for_changes(timeout=5, debounce=0.1)
+        self.assertEqual(changed, {sub_dir})
+
+        sync_func.partial_synchronization(changed)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.destination_dir, "subdir"))),
+                         [f"new_{i}.txt" for i in range(5)])
+
+        # Directories created later are watched as well
+        os.makedirs(os.path.join(sub_dir, "nested"))
+        self.assertEqual(watcher.wait_for_changes(timeout=5, debounce=0.1), {sub_dir})
+        with open(os.path.join(sub_dir, "nested", "deep.txt"), 'w') as f:
+            f.write("deep")
+        self.assertEqual(watcher.wait_for_changes(timeout=5, debounce=0.1), {os.path.join(sub_dir, "nested")})
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is available on Linux only")
+    def test_watch_reports_directories_it_cannot_watch(self):
+        os.makedirs(os.path.join(self.source_dir, "full", "deeper"))
+        watcher = InotifyWatcher(self.source_dir)
+        self.addCleanup(watcher.close)
+        self.assertEqual(watcher.failures, {})
+
+        # Kernel limit of watches is reached while a new tree is added
+        def exhausted_add_watch(fd, path, mask):
+            ctypes.set_errno(errno.ENOSPC)
+            return -1
+
+        with patch.object(watcher, "libc", MagicMock(inotify_add_watch=exhausted_add_watch)):
+            watcher.add_tree(os.path.join(self.source_dir, "full"))
+        self.assertEqual(watcher.failures, {os.path.join(self.source_dir, "full"): errno.ENOSPC,
+                                            os.path.join(self.source_dir, "full", "deeper"): errno.ENOSPC})
+
 if __name__ == '__main__':
     unittest.main()